@@ -4,15 +4,27 @@ from telegram.ext import (
     CommandHandler,
     CallbackQueryHandler,
     ContextTypes,
+    MessageHandler,
+    filters,
     Application
 )
 from telegram.constants import ParseMode
-from database import Database
-from claude_client import ClaudeClient
+import csv
+import html
+import io
+import json
+import logging
+import re
+from app_context import get_app
+from quotas import LIMIT_KEYS, QuotaManager, default_limits, parse_limits
+from router import parse_rules
+from storage import Storage
 import config
 
-db = Database()
-claude_client = ClaudeClient()
+logger = logging.getLogger(__name__)
+
+# Largest user list accepted by /import
+MAX_IMPORT_BYTES = 1024 * 1024
 
 
 def _build_model_keyboard(models: list, active_model: str) -> tuple:
@@ -34,8 +46,134 @@ def _build_model_keyboard(models: list, active_model: str) -> tuple:
     return text, InlineKeyboardMarkup(keyboard)
 
 
+# Users per page in the admin user list
+PAGE_SIZE = 20
+
+# Short filter keys (callback data is limited to 64 bytes): label, status, active days
+USER_FILTERS = {
+    "all": ("Все", "all", None),
+    "auth": ("✅ Авторизованы", "authorized", None),
+    "pend": ("⏳ Ожидают", "pending", None),
+    "adm": ("👑 Админы", "admin", None),
+    "act": ("🕐 Активны 7 дн.", "all", 7),
+}
+
+
+def _users_callback(view: str, filter_key: str, direction: str = "0", cursor: tuple = None) -> str:
+    """Callback data for a user list page: view (l = list, m = manage), filter and cursor."""
+    data = f"admin_users:{view}:{filter_key}:{direction}"
+    if cursor:
+        data += f":{cursor[0]}:{cursor[1]}"
+    return data
+
+
+def _users_page(db: Storage, data: str, notice: str = "") -> tuple:
+    """Render one page of the user list from its callback data. Returns (text, markup)."""
+    parts = data.split(":")
+    view, filter_key, direction = parts[1], parts[2], parts[3]
+    cursor = (int(parts[4]), int(parts[5])) if len(parts) == 6 else None
+    label, status, active_days = USER_FILTERS.get(filter_key, USER_FILTERS["all"])
+
+    after = cursor if direction == "n" else None
+    before = cursor if direction == "p" else None
+    # One extra row tells whether another page follows in the direction of travel
+    users = db.get_users_page(status, active_days, after=after, before=before, limit=PAGE_SIZE + 1)
+    more = len(users) > PAGE_SIZE
+    if more:
+        users = users[1:] if before else users[:PAGE_SIZE]
+    has_prev = more if before else after is not None
+    has_next = bool(users) if before else more
+
+    counts = db.get_user_counts()
+    # Status filters are among the totals; only an activity window needs its own count
+    matching = db.count_users(status, active_days) if active_days else counts[status]
+    title = "👥 <b>Список пользователей</b>" if view == "l" else "🔧 <b>Управление пользователями</b>"
+    text = (
+        f"{notice}{title}\n\n"
+        f"Всего: {counts['all']:,} · ✅ {counts['authorized']:,} · "
+        f"⏳ {counts['pending']:,} · 👑 {counts['admin']:,}\n"
+        f"Фильтр: {label} ({matching:,})\n\n"
+    )
+
+    keyboard = []
+    for user in users:
+        name = html.escape(user['first_name'] or "Unknown")
+        username = f"@{html.escape(user['username'])}" if user['username'] else ""
+        badge = " 👑" if user['is_admin'] else (" ✅" if user['is_authorized'] else " ⏳")
+        text += f"• {name} {username}{badge}\n  ID: <code>{user['user_id']}</code>\n"
+        if view != "m":
+            continue
+        button_name = user['first_name'] or "Unknown"
+        if not user['is_authorized']:
+            keyboard.append([InlineKeyboardButton(
+                f"✅ Авторизовать {button_name}", callback_data=f"admin_auth_{user['user_id']}"
+            )])
+        elif not user['is_admin']:
+            keyboard.append([InlineKeyboardButton(
+                f"❌ Деавторизовать {button_name}", callback_data=f"admin_deauth_{user['user_id']}"
+            )])
+    if not users:
+        text += "Никого не найдено.\n"
+
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton(
+            "◀️", callback_data=_users_callback(view, filter_key, "p", users[0]['cursor'] if users else cursor)
+        ))
+    if has_next:
+        navigation.append(InlineKeyboardButton(
+            "▶️", callback_data=_users_callback(view, filter_key, "n", users[-1]['cursor'])
+        ))
+    if navigation:
+        keyboard.append(navigation)
+
+    filters = [
+        InlineKeyboardButton(("• " if key == filter_key else "") + name, callback_data=_users_callback(view, key))
+        for key, (name, _, _) in USER_FILTERS.items()
+    ]
+    keyboard.append(filters[:3])
+    keyboard.append(filters[3:])
+    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="admin_back")])
+    return text, InlineKeyboardMarkup(keyboard)
+
+
+def _format_limits(limits: dict) -> str:
+    parts = []
+    for key in LIMIT_KEYS:
+        if key in limits:
+            value = limits[key]
+            parts.append(f"{key}={value:,}" if value or key == "weight" else f"{key}=∞")
+    return ", ".join(parts)
+
+
+def _limits_text(quotas: QuotaManager) -> str:
+    """Current token budgets: config defaults and the admin's overrides."""
+    overrides = quotas.overrides()
+    lines = [
+        "⏱ <b>Лимиты токенов</b>\n",
+        f"Одновременных генераций: {quotas.scheduler.slots}, очередь — по справедливой доле между пользователями\n",
+        f"Пользователи: {_format_limits({**default_limits('user'), **overrides.get('users', {})})}",
+        f"Чаты: {_format_limits({**default_limits('chat'), **overrides.get('chats', {})})}",
+    ]
+    personal = [(target, values) for target, values in overrides.items() if target not in ("users", "chats")]
+    if personal:
+        lines.append("\n<b>Индивидуальные:</b>")
+        lines.extend(f"<code>{html.escape(target)}</code>: {_format_limits(values)}" for target, values in personal)
+    lines.append(
+        "\nhour/day — токенов за час/сутки, concurrent — одновременных генераций (остальные ждут в очереди), "
+        "weight — доля в очереди; concurrent и weight — только для пользователей; 0 — без ограничения.\n\n"
+        "<code>/limits users hour=200000 day=1000000 concurrent=1</code>\n"
+        "<code>/limits chats hour=500000</code>\n"
+        "<code>/limits user &lt;id&gt; day=0 weight=3</code>\n"
+        "<code>/limits chat &lt;id&gt; hour=50000</code>\n"
+        "<code>/limits user &lt;id&gt; reset</code> — убрать индивидуальные лимиты"
+    )
+    return "\n".join(lines)
+
+
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show admin panel with buttons."""
+    db = get_app(context).db
     user_id = update.effective_user.id
 
     if not db.is_admin(user_id):
@@ -49,6 +187,7 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("🔧 Управление пользователями", callback_data="admin_manage_users")],
         [InlineKeyboardButton("💬 Системный промпт", callback_data="admin_prompt_menu")],
         [InlineKeyboardButton("🤖 Сменить модель", callback_data="admin_model")],
+        [InlineKeyboardButton("⏱ Лимиты токенов", callback_data="admin_limits")],
     ]
 
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -62,6 +201,8 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle admin panel callbacks."""
+    app = get_app(context)
+    db = app.db
     query = update.callback_query
     await query.answer()
 
@@ -71,36 +212,11 @@ async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("❌ У вас нет прав администратора.")
         return
 
-    if query.data == "admin_users":
-        users = db.get_all_users()
-
-        users_text = "👥 <b>Список пользователей</b>\n\n"
-
-        authorized_users = [u for u in users if u['is_authorized']]
-        unauthorized_users = [u for u in users if not u['is_authorized']]
-
-        if authorized_users:
-            users_text += "<b>Авторизованные:</b>\n"
-            for user in authorized_users:
-                name = user['first_name'] or "Unknown"
-                username = f"@{user['username']}" if user['username'] else ""
-                admin_badge = " 👑" if user['is_admin'] else ""
-                users_text += f"• {name} {username}{admin_badge}\n  ID: <code>{user['user_id']}</code>\n"
-            users_text += "\n"
-
-        if unauthorized_users:
-            users_text += "<b>Ожидают авторизации:</b>\n"
-            for user in unauthorized_users:
-                name = user['first_name'] or "Unknown"
-                username = f"@{user['username']}" if user['username'] else ""
-                users_text += f"• {name} {username}\n  ID: <code>{user['user_id']}</code>\n"
-
-        users_text += f"\n<b>Всего пользователей:</b> {len(users)}"
-
-        keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="admin_back")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        await query.edit_message_text(users_text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+    if query.data == "admin_users" or query.data.startswith("admin_users:"):
+        data = query.data if query.data != "admin_users" else _users_callback("l", "all")
+        context.user_data["admin_users_page"] = data
+        text, reply_markup = _users_page(db, data)
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
     elif query.data == "admin_stats":
         stats = db.get_total_usage()
@@ -141,60 +257,26 @@ async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text(pricing_text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
     elif query.data == "admin_manage_users":
-        users = db.get_all_users()
-        unauthorized_users = [u for u in users if not u['is_authorized']]
-        authorized_users = [u for u in users if u['is_authorized'] and not u['is_admin']]
-
-        manage_text = "🔧 <b>Управление пользователями</b>\n\n"
-
-        keyboard = []
-
-        if unauthorized_users:
-            manage_text += "<b>Ожидают авторизации:</b>\n"
-            for user in unauthorized_users:
-                name = user['first_name'] or "Unknown"
-                username = f"@{user['username']}" if user['username'] else ""
-                manage_text += f"• {name} {username}\n  ID: <code>{user['user_id']}</code>\n"
-                keyboard.append([InlineKeyboardButton(
-                    f"✅ Авторизовать {name}",
-                    callback_data=f"admin_auth_{user['user_id']}"
-                )])
-            manage_text += "\n"
+        data = _users_callback("m", "pend")
+        context.user_data["admin_users_page"] = data
+        text, reply_markup = _users_page(db, data)
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+
+    elif query.data.startswith("admin_auth_") or query.data.startswith("admin_deauth_"):
+        authorize = query.data.startswith("admin_auth_")
+        target_user_id = int(query.data.rsplit("_", 1)[1])
+        if authorize:
+            db.authorize_user(target_user_id)
+            notice = f"✅ Пользователь <code>{target_user_id}</code> авторизован.\n\n"
+        elif target_user_id == config.ADMIN_USER_ID:
+            notice = "❌ Нельзя деавторизовать главного администратора!\n\n"
         else:
-            manage_text += "Нет пользователей, ожидающих авторизации.\n\n"
-
-        if authorized_users:
-            manage_text += "<b>Авторизованные пользователи:</b>\n"
-            for user in authorized_users:
-                name = user['first_name'] or "Unknown"
-                username = f"@{user['username']}" if user['username'] else ""
-                manage_text += f"• {name} {username}\n  ID: <code>{user['user_id']}</code>\n"
-                keyboard.append([InlineKeyboardButton(
-                    f"❌ Деавторизовать {name}",
-                    callback_data=f"admin_deauth_{user['user_id']}"
-                )])
-
-        keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="admin_back")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        await query.edit_message_text(manage_text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
-
-    elif query.data.startswith("admin_auth_"):
-        target_user_id = int(query.data.replace("admin_auth_", ""))
-        db.authorize_user(target_user_id)
-        await query.answer(f"✅ Пользователь {target_user_id} авторизован!", show_alert=True)
-        # Refresh the management menu
-        await admin_callback(update, context)
-
-    elif query.data.startswith("admin_deauth_"):
-        target_user_id = int(query.data.replace("admin_deauth_", ""))
-        if target_user_id == config.ADMIN_USER_ID:
-            await query.answer("❌ Нельзя деавторизовать главного администратора!", show_alert=True)
-            return
-        db.deauthorize_user(target_user_id)
-        await query.answer(f"✅ Пользователь {target_user_id} деавторизован!", show_alert=True)
-        # Refresh the management menu
-        await admin_callback(update, context)
+            db.deauthorize_user(target_user_id)
+            notice = f"✅ Пользователь <code>{target_user_id}</code> деавторизован.\n\n"
+        # Redraw the page the button was on
+        data = context.user_data.get("admin_users_page") or _users_callback("m", "pend")
+        text, reply_markup = _users_page(db, data, notice)
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
     elif query.data == "admin_prompt_menu":
         current_prompt = db.get_setting('system_prompt')
@@ -240,13 +322,19 @@ async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif query.data == "admin_model":
         active_model = db.get_setting('active_model') or config.CLAUDE_MODEL
-        models = await claude_client.get_available_models()
+        models = await app.claude.get_available_models()
         if not models:
             await query.answer("❌ Не удалось получить список моделей от Anthropic", show_alert=True)
             return
         text, markup = _build_model_keyboard(models, active_model)
         await query.edit_message_text(text, reply_markup=markup, parse_mode=ParseMode.HTML)
 
+    elif query.data == "admin_limits":
+        keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="admin_back")]]
+        await query.edit_message_text(
+            _limits_text(app.quotas), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.HTML
+        )
+
     elif query.data == "admin_back":
         # Return to main admin menu
         keyboard = [
@@ -256,6 +344,7 @@ async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             [InlineKeyboardButton("🔧 Управление пользователями", callback_data="admin_manage_users")],
             [InlineKeyboardButton("💬 Системный промпт", callback_data="admin_prompt_menu")],
             [InlineKeyboardButton("🤖 Сменить модель", callback_data="admin_model")],
+            [InlineKeyboardButton("⏱ Лимиты токенов", callback_data="admin_limits")],
         ]
 
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -267,118 +356,199 @@ async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
+def _parse_user_ids(args: list) -> tuple:
+    """User IDs from command arguments separated by spaces or commas. Returns (ids, invalid)."""
+    ids, invalid = [], []
+    for token in re.split(r"[\s,;]+", " ".join(args)):
+        if not token:
+            continue
+        try:
+            ids.append(int(token))
+        except ValueError:
+            invalid.append(token)
+    return list(dict.fromkeys(ids)), invalid
+
+
+def _parse_user_file(text: str) -> tuple:
+    """Users from a CSV or plain list: user_id[,username,first_name,last_name] per line.
+
+    Commas, semicolons and tabs are accepted as separators and a header line is
+    skipped. Returns (rows, invalid line count).
+    """
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    rows, invalid = {}, 0
+    for line_no, fields in enumerate(csv.reader(io.StringIO(text), dialect), 1):
+        fields = [field.strip() for field in fields]
+        if not fields or not fields[0]:
+            continue
+        try:
+            user_id = int(fields[0])
+        except ValueError:
+            if line_no > 1:
+                invalid += 1
+            continue
+        names = [(fields[i] if i < len(fields) else "") or None for i in (1, 2, 3)]
+        if names[0]:
+            names[0] = names[0].lstrip("@") or None
+        rows[user_id] = (user_id, *names)
+    return list(rows.values()), invalid
+
+
+def _bulk_summary(action: str, updated: list, missing: list, skipped: list, invalid: list) -> str:
+    """Reply text for a bulk authorize/deauthorize."""
+    lines = [f"✅ {action}: <b>{len(updated)}</b>"]
+    if missing:
+        shown = ", ".join(f"<code>{uid}</code>" for uid in missing[:20])
+        more = f" и ещё {len(missing) - 20}" if len(missing) > 20 else ""
+        lines.append(f"⚠️ Не найдены в базе ({len(missing)}): {shown}{more}\n"
+                     "Они должны сначала написать боту /start, или загрузите их через /import")
+    if skipped:
+        lines.append("⏭ Главный администратор пропущен")
+    if invalid:
+        lines.append(f"❌ Некорректные ID: {html.escape(', '.join(invalid[:20]))}")
+    return "\n".join(lines)
+
+
 async def authorize_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Authorize a user by ID."""
+    """Authorize one or many users by ID in one transaction."""
+    db = get_app(context).db
     user_id = update.effective_user.id
 
     if not db.is_admin(user_id):
         await update.message.reply_text("❌ У вас нет прав администратора.")
         return
 
-    if not context.args or len(context.args) != 1:
+    target_ids, invalid = _parse_user_ids(context.args or [])
+    if not target_ids:
         await update.message.reply_text(
-            "❌ Использование: <code>/authorize &lt;user_id&gt;</code>\n"
-            "Пример: <code>/authorize 123456789</code>",
+            "❌ Использование: <code>/authorize &lt;user_id&gt; [user_id ...]</code>\n"
+            "Пример: <code>/authorize 123456789</code> или <code>/authorize 111, 222, 333</code>\n"
+            "Список из файла: отправьте CSV с подписью /import",
             parse_mode=ParseMode.HTML
         )
         return
 
-    try:
-        target_user_id = int(context.args[0])
-    except ValueError:
-        await update.message.reply_text("❌ Некорректный ID пользователя.")
-        return
-
-    # Check if user exists in database
-    users = db.get_all_users()
-    user_exists = any(u['user_id'] == target_user_id for u in users)
-
-    if not user_exists:
-        await update.message.reply_text(
-            f"⚠️ Пользователь с ID <code>{target_user_id}</code> не найден в базе.\n"
-            "Пользователь должен сначала написать боту команду /start",
-            parse_mode=ParseMode.HTML
-        )
-        return
+    found = db.set_users_authorized(target_ids, True)
 
-    db.authorize_user(target_user_id)
-    await update.message.reply_text(
-        f"✅ Пользователь <code>{target_user_id}</code> авторизован.",
-        parse_mode=ParseMode.HTML
-    )
+    if len(target_ids) == 1 and not invalid:
+        if found:
+            text = f"✅ Пользователь <code>{target_ids[0]}</code> авторизован."
+        else:
+            text = (f"⚠️ Пользователь с ID <code>{target_ids[0]}</code> не найден в базе.\n"
+                    "Пользователь должен сначала написать боту команду /start")
+    else:
+        found_set = set(found)
+        missing = [uid for uid in target_ids if uid not in found_set]
+        text = _bulk_summary("Авторизовано", found, missing, [], invalid)
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML)
 
 
 async def deauthorize_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Deauthorize a user by ID."""
+    """Deauthorize one or many users by ID in one transaction."""
+    db = get_app(context).db
     user_id = update.effective_user.id
 
     if not db.is_admin(user_id):
         await update.message.reply_text("❌ У вас нет прав администратора.")
         return
 
-    if not context.args or len(context.args) != 1:
+    target_ids, invalid = _parse_user_ids(context.args or [])
+    if not target_ids:
         await update.message.reply_text(
-            "❌ Использование: <code>/deauthorize &lt;user_id&gt;</code>\n"
+            "❌ Использование: <code>/deauthorize &lt;user_id&gt; [user_id ...]</code>\n"
             "Пример: <code>/deauthorize 123456789</code>",
             parse_mode=ParseMode.HTML
         )
         return
 
-    try:
-        target_user_id = int(context.args[0])
-    except ValueError:
-        await update.message.reply_text("❌ Некорректный ID пользователя.")
-        return
-
-    if target_user_id == config.ADMIN_USER_ID:
+    skipped = [uid for uid in target_ids if uid == config.ADMIN_USER_ID]
+    if skipped and len(target_ids) == 1:
         await update.message.reply_text("❌ Нельзя деавторизовать главного администратора.")
         return
+    target_ids = [uid for uid in target_ids if uid != config.ADMIN_USER_ID]
 
-    db.deauthorize_user(target_user_id)
-    await update.message.reply_text(
-        f"✅ Пользователь <code>{target_user_id}</code> деавторизован.",
-        parse_mode=ParseMode.HTML
-    )
+    found = db.set_users_authorized(target_ids, False)
 
+    if len(target_ids) == 1 and not invalid and not skipped:
+        text = f"✅ Пользователь <code>{target_ids[0]}</code> деавторизован."
+    else:
+        found_set = set(found)
+        missing = [uid for uid in target_ids if uid not in found_set]
+        text = _bulk_summary("Деавторизовано", found, missing, skipped, invalid)
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML)
 
-async def list_users_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """List all users."""
+
+async def import_users_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Create and authorize users from a CSV/text file in one transaction.
+
+    The file is either attached with the caption /import or replied to with /import.
+    """
+    db = get_app(context).db
     user_id = update.effective_user.id
 
     if not db.is_admin(user_id):
         await update.message.reply_text("❌ У вас нет прав администратора.")
         return
 
-    users = db.get_all_users()
+    message = update.message
+    document = message.document or (message.reply_to_message and message.reply_to_message.document)
+    if not document:
+        await message.reply_text(
+            "📥 <b>Импорт пользователей</b>\n\n"
+            "Отправьте файл CSV или TXT с подписью <code>/import</code> "
+            "(или ответьте <code>/import</code> на сообщение с файлом).\n\n"
+            "Одна строка — один пользователь:\n"
+            "<code>user_id[,username,first_name,last_name]</code>\n"
+            "Разделители: запятая, точка с запятой или табуляция; строка заголовка пропускается.",
+            parse_mode=ParseMode.HTML
+        )
+        return
 
-    users_text = "👥 <b>Список всех пользователей</b>\n\n"
+    if document.file_size and document.file_size > MAX_IMPORT_BYTES:
+        await message.reply_text(f"❌ Файл слишком большой (максимум {MAX_IMPORT_BYTES // 1024} КБ).")
+        return
 
-    authorized_users = [u for u in users if u['is_authorized']]
-    unauthorized_users = [u for u in users if not u['is_authorized']]
+    file = await document.get_file()
+    data = await file.download_as_bytearray()
+    try:
+        text = bytes(data).decode("utf-8-sig")
+    except UnicodeDecodeError:
+        await message.reply_text("❌ Файл должен быть в кодировке UTF-8.")
+        return
 
-    if authorized_users:
-        users_text += "<b>Авторизованные:</b>\n"
-        for user in authorized_users:
-            name = user['first_name'] or "Unknown"
-            username = f"@{user['username']}" if user['username'] else ""
-            admin_badge = " 👑" if user['is_admin'] else ""
-            users_text += f"• {name} {username}{admin_badge}\n  ID: <code>{user['user_id']}</code>\n"
-        users_text += "\n"
+    rows, invalid = _parse_user_file(text)
+    if not rows:
+        await message.reply_text("❌ В файле не найдено ни одного ID пользователя.")
+        return
 
-    if unauthorized_users:
-        users_text += "<b>Ожидают авторизации:</b>\n"
-        for user in unauthorized_users:
-            name = user['first_name'] or "Unknown"
-            username = f"@{user['username']}" if user['username'] else ""
-            users_text += f"• {name} {username}\n  ID: <code>{user['user_id']}</code>\n"
+    imported = db.import_users(rows, authorize=True)
+    logger.info(f"Admin {user_id} imported {imported} users from {document.file_name}")
 
-    users_text += f"\n<b>Всего пользователей:</b> {len(users)}"
+    text = f"✅ Импортировано и авторизовано: <b>{imported}</b>"
+    if invalid:
+        text += f"\n❌ Пропущено некорректных строк: {invalid}"
+    await message.reply_text(text, parse_mode=ParseMode.HTML)
 
-    await update.message.reply_text(users_text, parse_mode=ParseMode.HTML)
+
+async def list_users_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """List users, one page at a time."""
+    db = get_app(context).db
+    user_id = update.effective_user.id
+
+    if not db.is_admin(user_id):
+        await update.message.reply_text("❌ У вас нет прав администратора.")
+        return
+
+    text, reply_markup = _users_page(db, _users_callback("l", "all"))
+    await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
 
 async def total_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show total usage statistics."""
+    db = get_app(context).db
     user_id = update.effective_user.id
 
     if not db.is_admin(user_id):
@@ -397,11 +567,19 @@ async def total_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         f"Используемая модель: <code>{db.get_setting('active_model') or config.CLAUDE_MODEL}</code>"
     )
 
+    by_model = db.get_usage_by_model(7)
+    if by_model:
+        stats_text += "\n\n<b>По моделям за 7 дней:</b>\n" + "\n".join(
+            f"<code>{row['model']}</code>: {row['requests']:,} запр., ${row['cost']:.4f}"
+            for row in by_model
+        )
+
     await update.message.reply_text(stats_text, parse_mode=ParseMode.HTML)
 
 
 async def set_prompt_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Set system prompt for all conversations."""
+    db = get_app(context).db
     user_id = update.effective_user.id
 
     if not db.is_admin(user_id):
@@ -438,6 +616,7 @@ async def set_prompt_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def show_prompt_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show current system prompt."""
+    db = get_app(context).db
     user_id = update.effective_user.id
 
     if not db.is_admin(user_id):
@@ -455,8 +634,128 @@ async def show_prompt_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("ℹ️ Системный промпт не установлен.")
 
 
+async def routing_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/routing — show or change the model routing rules."""
+    app = get_app(context)
+    db = app.db
+    user_id = update.effective_user.id
+
+    if not db.is_admin(user_id):
+        await update.message.reply_text("❌ У вас нет прав администратора.")
+        return
+
+    # Rules are JSON, so take the raw text rather than whitespace-split args
+    argument = update.message.text.partition(" ")[2].strip()
+
+    if argument.lower() == "off":
+        db.set_setting('routing_rules', '[]')
+        await update.message.reply_text("✅ Маршрутизация отключена: все запросы идут в активную модель.")
+        return
+    if argument.lower() == "reset":
+        db.set_setting('routing_rules', '')
+        await update.message.reply_text("✅ Восстановлены правила маршрутизации по умолчанию.")
+        return
+    if argument:
+        try:
+            rules = parse_rules(argument)
+        except ValueError as e:
+            await update.message.reply_text(f"❌ Ошибка в правилах: {e}")
+            return
+        db.set_setting('routing_rules', json.dumps(rules, ensure_ascii=False))
+        await update.message.reply_text(f"✅ Сохранено правил: {len(rules)}")
+        return
+
+    active_model = db.get_setting('active_model') or config.CLAUDE_MODEL
+    rules = app.router.rules()
+    text = (
+        "🔀 <b>Маршрутизация моделей</b>\n\n"
+        f"Активная модель: <code>{active_model}</code>\n"
+        f"Лёгкая модель (light): <code>{config.ROUTER_LIGHT_MODEL or '—'}</code>\n\n"
+        "Правила (первое подходящее побеждает, иначе — активная модель):\n"
+        f"<pre>{html.escape(json.dumps(rules, ensure_ascii=False, indent=1))}</pre>\n"
+        "Подсказки в начале сообщения: <code>!fast</code> — лёгкая модель, <code>!smart</code> — активная.\n\n"
+        "<code>/routing [JSON]</code> — задать правила\n"
+        "<code>/routing off</code> — отключить\n"
+        "<code>/routing reset</code> — правила по умолчанию"
+    )
+    by_model = db.get_usage_by_model(7)
+    if by_model:
+        text += "\n\n<b>Запросы по моделям за 7 дней:</b>\n" + "\n".join(
+            f"<code>{row['model']}</code>: {row['requests']:,} запр., ${row['cost']:.4f}"
+            for row in by_model
+        )
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+
+
+async def limits_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/limits — show or change token budgets for users and chats."""
+    app = get_app(context)
+    db = app.db
+    user_id = update.effective_user.id
+
+    if not db.is_admin(user_id):
+        await update.message.reply_text("❌ У вас нет прав администратора.")
+        return
+
+    args = list(context.args or [])
+    if not args:
+        await update.message.reply_text(_limits_text(app.quotas), parse_mode=ParseMode.HTML)
+        return
+
+    scope = args.pop(0).lower()
+    if scope in ("users", "chats"):
+        target = scope
+    elif scope in ("user", "chat") and args and args[0].lstrip("-").isdigit():
+        target = f"{scope}:{int(args.pop(0))}"
+    else:
+        await update.message.reply_text(
+            "❌ Укажите, чьи лимиты менять: <code>users</code>, <code>chats</code>, "
+            "<code>user &lt;id&gt;</code> или <code>chat &lt;id&gt;</code>.",
+            parse_mode=ParseMode.HTML
+        )
+        return
+
+    overrides = dict(app.quotas.overrides())
+    if [arg.lower() for arg in args] == ["reset"]:
+        overrides.pop(target, None)
+    else:
+        values = dict(overrides.get(target, {}))
+        for arg in args:
+            key, _, value = arg.partition("=")
+            if key.lower() not in LIMIT_KEYS or not value.isdigit():
+                await update.message.reply_text(
+                    f"❌ Не понял «{html.escape(arg)}». Ожидается key=число, key: {', '.join(LIMIT_KEYS)}.",
+                    parse_mode=ParseMode.HTML
+                )
+                return
+            if target.startswith("chat") and key.lower() in ("concurrent", "weight"):
+                await update.message.reply_text(
+                    f"❌ {html.escape(key.lower())} задаётся только для пользователей; "
+                    "для чатов — hour и day.",
+                    parse_mode=ParseMode.HTML
+                )
+                return
+            values[key.lower()] = int(value)
+        overrides[target] = values
+
+    raw = json.dumps(overrides, ensure_ascii=False)
+    try:
+        parse_limits(raw)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {html.escape(str(e))}", parse_mode=ParseMode.HTML)
+        return
+    db.set_setting('quota_limits', raw)
+    logger.info(f"Admin {user_id} set quota limits for {target}: {overrides.get(target)}")
+    await update.message.reply_text(
+        f"✅ Лимиты <code>{html.escape(target)}</code> сохранены.\n\n" + _limits_text(app.quotas),
+        parse_mode=ParseMode.HTML
+    )
+
+
 async def model_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """/model command — show model selection for admin."""
+    app = get_app(context)
+    db = app.db
     user_id = update.effective_user.id
 
     if not db.is_admin(user_id):
@@ -464,7 +763,7 @@ async def model_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     active_model = db.get_setting('active_model') or config.CLAUDE_MODEL
-    models = await claude_client.get_available_models()
+    models = await app.claude.get_available_models()
 
     if not models:
         await update.message.reply_text(
@@ -480,6 +779,7 @@ async def model_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def set_model_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle model selection button press."""
+    db = get_app(context).db
     query = update.callback_query
     await query.answer()
 
@@ -504,10 +804,16 @@ def register_admin_handlers(application: Application):
     application.add_handler(CommandHandler("admin", admin_panel))
     application.add_handler(CommandHandler("authorize", authorize_user_command))
     application.add_handler(CommandHandler("deauthorize", deauthorize_user_command))
+    application.add_handler(CommandHandler("import", import_users_command))
+    application.add_handler(MessageHandler(
+        filters.Document.ALL & filters.CaptionRegex(r"^/import(@\w+)?(\s|$)"), import_users_command
+    ))
     application.add_handler(CommandHandler("users", list_users_command))
     application.add_handler(CommandHandler("totalstats", total_stats_command))
     application.add_handler(CommandHandler("setprompt", set_prompt_command))
     application.add_handler(CommandHandler("showprompt", show_prompt_command))
     application.add_handler(CommandHandler("model", model_command))
+    application.add_handler(CommandHandler("routing", routing_command))
+    application.add_handler(CommandHandler("limits", limits_command))
     application.add_handler(CallbackQueryHandler(admin_callback, pattern="^admin_"))
     application.add_handler(CallbackQueryHandler(set_model_callback, pattern="^setmodel_"))
@@ -0,0 +1,66 @@
+"""Services shared by all handlers, created once per process.
+
+main() (or each worker process) builds one AppContext and passes it to
+build_application(), which stores it in ``application.bot_data``; handlers
+reach it with ``get_app(context)``. Importing bot.py or admin.py no longer
+opens the database or creates an Anthropic client.
+"""
+import logging
+from typing import TYPE_CHECKING, Optional
+
+from telegram.ext import ContextTypes
+
+import config
+from batches import BatchManager
+from media_groups import MediaGroupCollector
+from pipeline import Pipeline
+from quotas import QuotaManager
+from router import ModelRouter
+from storage import Storage, create_storage
+from summarizer import Summarizer
+
+if TYPE_CHECKING:
+    from claude_client import ClaudeClient
+
+logger = logging.getLogger(__name__)
+
+BOT_DATA_KEY = "app"
+
+
+class AppContext:
+    """Storage, Claude client and the services built on top of them."""
+
+    def __init__(self, db: Storage, claude: "ClaudeClient"):
+        self.db = db
+        self.claude = claude
+        self.router = ModelRouter(db)
+        self.summarizer: Optional[Summarizer] = Summarizer(
+            db, claude, config.SUMMARY_MODEL,
+            keep_turns=config.SUMMARY_KEEP_TURNS,
+            max_tokens=config.SUMMARY_MAX_TOKENS,
+        ) if config.SUMMARY_MODEL else None
+        self.quotas = QuotaManager(db)
+        self.pipeline = Pipeline(db, claude, self.summarizer, self.router, quotas=self.quotas)
+        self.media_groups = MediaGroupCollector(config.MEDIA_GROUP_WAIT)
+        self.batches: Optional[BatchManager] = BatchManager(
+            db, claude, poll_interval=config.BATCH_POLL_SECONDS, max_items=config.BATCH_MAX_ITEMS
+        ) if config.BATCH_POLL_SECONDS > 0 else None
+
+    def close(self):
+        """Stop background summarization and release connection pools."""
+        if self.summarizer:
+            self.summarizer.shutdown()
+        self.claude.close()
+        self.db.close()
+
+
+def create_app_context() -> AppContext:
+    """Open storage (running pending schema migrations) and the Claude client."""
+    # anthropic is the heaviest import; the ingress process of WORKERS mode never needs it
+    from claude_client import ClaudeClient
+    return AppContext(create_storage(), ClaudeClient())
+
+
+def get_app(context: ContextTypes.DEFAULT_TYPE) -> AppContext:
+    """The AppContext of the application handling this update."""
+    return context.bot_data[BOT_DATA_KEY]
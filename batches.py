@@ -0,0 +1,361 @@
+"""Offline batch jobs through the Anthropic Message Batches API.
+
+For bulk work that does not need an immediate answer — summarizing a
+pile of documents, translating many texts — a user collects items and
+submits them as one batch, billed at half the regular price:
+
+    /batch <prompt>   start a job; every text or text file sent next is an item
+    /batchrun         submit the collected items
+    /batchcancel      drop a collecting job or cancel a submitted one
+    /batches          list recent jobs
+
+A background poller checks submitted batches every BATCH_POLL_SECONDS,
+stores the results, logs their cost at batch pricing and sends them to
+the chat. A job is claimed in storage before delivery, so its results
+are sent once even when several processes poll.
+"""
+import asyncio
+import html
+import io
+import logging
+from typing import Dict, Optional
+
+from telegram import Update
+from telegram.constants import ParseMode
+from telegram.ext import ApplicationHandlerStop, CommandHandler, ContextTypes, MessageHandler, filters
+
+import config
+import documents
+import media
+import metrics
+from pipeline import build_system_prompt, convert_markdown_to_html, split_message
+
+logger = logging.getLogger(__name__)
+
+# Results of jobs up to this size are sent as messages, larger ones as a file
+INLINE_RESULTS = 5
+
+STATUS_LABELS = {
+    "collecting": "📥 сбор",
+    "submitted": "⏳ в обработке",
+    "canceling": "⏳ отменяется",
+    "delivering": "📤 отправка",
+    "ended": "✅ готов",
+    "failed": "❌ ошибка",
+    "cancelled": "🚫 отменён",
+}
+
+
+class BatchManager:
+    """Collects batch items, submits jobs and delivers their results."""
+
+    def __init__(self, db, claude, poll_interval: float = 60, max_items: int = 500):
+        self.db = db
+        self.claude = claude
+        self.poll_interval = poll_interval
+        self.max_items = max_items
+        self._poller: Optional[asyncio.Task] = None
+
+    def register_handlers(self, application):
+        """Add the batch commands and the item collector (which runs before the regular handlers)."""
+        application.add_handler(CommandHandler("batch", self.batch_command))
+        application.add_handler(CommandHandler("batchrun", self.run_command))
+        application.add_handler(CommandHandler("batchcancel", self.cancel_command))
+        application.add_handler(CommandHandler("batches", self.list_command))
+        application.add_handler(
+            MessageHandler((filters.TEXT & ~filters.COMMAND) | filters.Document.ALL, self.collect_item),
+            group=-1,
+        )
+
+    def collecting_job(self, user_id: int, chat_id: int) -> Optional[int]:
+        """Id of the job collecting items in a chat, if any.
+
+        Read from storage on every message (the status index narrows it to
+        the few open jobs), so a job started, run or cancelled by another
+        bot instance on a shared database is seen at once.
+        """
+        jobs = self.db.get_batch_jobs(user_id, chat_id, statuses=["collecting"], limit=1)
+        return jobs[0]["id"] if jobs else None
+
+    async def batch_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /batch <prompt>."""
+        user_id = update.effective_user.id
+        chat_id = update.effective_chat.id
+        if not self.db.is_authorized(user_id):
+            await update.message.reply_text("❌ У вас нет доступа к боту.")
+            return
+
+        if self.collecting_job(user_id, chat_id):
+            await update.message.reply_text(
+                "📥 Пакет уже собирается. Отправьте /batchrun для запуска или /batchcancel для отмены."
+            )
+            return
+
+        prompt = " ".join(context.args) if context.args else ""
+        if not prompt:
+            await update.message.reply_text(
+                "Использование: /batch &lt;задание&gt;\n\n"
+                "Затем отправьте тексты или документы — каждый станет отдельным элементом пакета. "
+                "Пакет обрабатывается в фоне (обычно до часа) и стоит вдвое дешевле.",
+                parse_mode=ParseMode.HTML
+            )
+            return
+
+        job_id = self.db.create_batch_job(user_id, chat_id, prompt)
+        await update.message.reply_text(
+            f"📥 Пакет #{job_id} создан.\n\n"
+            "Отправляйте тексты или документы, затем /batchrun для запуска. "
+            "/batchcancel — отменить."
+        )
+
+    async def collect_item(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Add a text or document to the chat's collecting job; other handlers are skipped."""
+        message = update.message
+        if message is None or update.effective_user is None:
+            return
+        user_id = update.effective_user.id
+        chat_id = update.effective_chat.id
+        job_id = self.collecting_job(user_id, chat_id)
+        if job_id is None:
+            return
+
+        if message.document:
+            document = message.document
+            rejection = documents.check_document(document)
+            if rejection:
+                await message.reply_text(rejection)
+                raise ApplicationHandlerStop
+            fmt = documents.detect_format(document.mime_type, document.file_name)
+            doc_file = await document.get_file()
+            with await media.download(doc_file, spill_bytes=0) as doc:
+                try:
+                    if not doc.path:
+                        raise documents.ExtractionError(documents.ERROR_TEXTS["empty"])
+                    content, _ = await documents.read_document(doc.path, fmt)
+                except documents.ExtractionError as e:
+                    await message.reply_text(str(e))
+                    raise ApplicationHandlerStop
+            title = document.file_name or f"document-{document.file_unique_id}"
+        else:
+            content = message.text
+            title = content[:40].replace("\n", " ") + ("…" if len(content) > 40 else "")
+
+        job = self.db.get_batch_jobs(user_id, chat_id, statuses=["collecting"], limit=1)
+        if job and job[0]["item_count"] >= self.max_items:
+            await message.reply_text(f"❌ В пакете не больше {self.max_items} элементов. Отправьте /batchrun.")
+            raise ApplicationHandlerStop
+
+        count = self.db.add_batch_item(job_id, title, content)
+        await message.reply_text(f"➕ Добавлено в пакет #{job_id}: {count}")
+        raise ApplicationHandlerStop
+
+    async def run_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /batchrun: submit the collecting job."""
+        user_id = update.effective_user.id
+        chat_id = update.effective_chat.id
+        if not self.db.is_authorized(user_id):
+            await update.message.reply_text("❌ У вас нет доступа к боту.")
+            return
+
+        job_id = self.collecting_job(user_id, chat_id)
+        if job_id is None:
+            await update.message.reply_text("Нет собираемого пакета. Начните с /batch &lt;задание&gt;",
+                                            parse_mode=ParseMode.HTML)
+            return
+
+        items = self.db.get_batch_items(job_id)
+        if not items:
+            await update.message.reply_text("📭 Пакет пуст — отправьте хотя бы один текст или файл.")
+            return
+
+        job = self.db.get_batch_jobs(user_id, chat_id, statuses=["collecting"], limit=1)[0]
+        model = self.db.get_setting('active_model') or config.CLAUDE_MODEL
+        system_prompt = build_system_prompt(model, self.db.get_setting('system_prompt'))
+        requests = [{
+            "custom_id": f"item-{item['id']}",
+            "params": {
+                "model": model,
+                "max_tokens": config.MAX_TOKENS,
+                "system": system_prompt,
+                "messages": [{
+                    "role": "user",
+                    "content": f"Document content:\n\n{item['content']}\n\n{job['prompt']}",
+                }],
+            },
+        } for item in items]
+
+        try:
+            batch_id = await asyncio.to_thread(self.claude.create_batch, requests)
+        except Exception as e:
+            logger.error(f"User {user_id} - Batch #{job_id} submit failed: {e}")
+            await update.message.reply_text("❌ Не удалось отправить пакет. Попробуйте /batchrun ещё раз позже.")
+            return
+
+        self.db.update_batch_job(job_id, "submitted", batch_id=batch_id, model=model)
+        metrics.BATCH_JOBS.inc(result="submitted")
+        logger.info(f"User {user_id} - Batch #{job_id} submitted as {batch_id}: {len(items)} items, model {model}")
+        await update.message.reply_text(
+            f"🚀 Пакет #{job_id} отправлен: {len(items)} элем.\n"
+            "Результаты придут сюда, как только будут готовы."
+        )
+
+    async def cancel_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /batchcancel: drop the collecting job, or cancel the latest submitted one."""
+        user_id = update.effective_user.id
+        chat_id = update.effective_chat.id
+        if not self.db.is_authorized(user_id):
+            await update.message.reply_text("❌ У вас нет доступа к боту.")
+            return
+
+        job_id = self.collecting_job(user_id, chat_id)
+        if job_id is not None:
+            self.db.update_batch_job(job_id, "cancelled", expected_status="collecting")
+            await update.message.reply_text(f"🚫 Пакет #{job_id} отменён.")
+            return
+
+        jobs = self.db.get_batch_jobs(user_id, chat_id, statuses=["submitted"], limit=1)
+        if not jobs:
+            await update.message.reply_text("Нет пакетов для отмены.")
+            return
+
+        job = jobs[0]
+        try:
+            await asyncio.to_thread(self.claude.cancel_batch, job["batch_id"])
+        except Exception as e:
+            logger.error(f"User {user_id} - Batch #{job['id']} cancel failed: {e}")
+            await update.message.reply_text("❌ Не удалось отменить пакет.")
+            return
+        self.db.update_batch_job(job["id"], "canceling", expected_status="submitted")
+        await update.message.reply_text(
+            f"🚫 Пакет #{job['id']} отменяется. Уже готовые результаты придут сюда."
+        )
+
+    async def list_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /batches: the user's recent jobs."""
+        user_id = update.effective_user.id
+        if not self.db.is_authorized(user_id):
+            await update.message.reply_text("❌ У вас нет доступа к боту.")
+            return
+
+        jobs = self.db.get_batch_jobs(user_id, limit=10)
+        if not jobs:
+            await update.message.reply_text("Пакетов пока нет. Начните с /batch &lt;задание&gt;",
+                                            parse_mode=ParseMode.HTML)
+            return
+
+        lines = ["📦 <b>Ваши пакеты</b>\n"]
+        for job in jobs:
+            line = (f"#{job['id']} {STATUS_LABELS.get(job['status'], job['status'])} — "
+                    f"{job['item_count']} элем.")
+            if job["status"] == "ended":
+                line += f", готово {job['succeeded']}, ${job['cost_usd']:.4f}"
+            prompt = job["prompt"][:50] + ("…" if len(job["prompt"]) > 50 else "")
+            lines.append(f"{line}\n<i>{html.escape(prompt)}</i>")
+        await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
+    def start(self, bot):
+        """Start polling submitted batches."""
+        if self._poller is None:
+            self._poller = asyncio.get_running_loop().create_task(self._poll_loop(bot))
+
+    async def stop(self):
+        if self._poller is not None:
+            self._poller.cancel()
+            try:
+                await self._poller
+            except asyncio.CancelledError:
+                pass
+            self._poller = None
+
+    async def _poll_loop(self, bot):
+        while True:
+            try:
+                await self.poll_once(bot)
+            except Exception as e:
+                logger.error(f"Batch polling failed: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    async def poll_once(self, bot) -> int:
+        """Deliver every submitted job whose batch has ended; returns how many were delivered."""
+        delivered = 0
+        jobs = await asyncio.to_thread(self.db.get_batch_jobs, statuses=["submitted", "canceling"], limit=1000)
+        for job in jobs:
+            try:
+                status = await asyncio.to_thread(self.claude.get_batch, job["batch_id"])
+            except Exception as e:
+                logger.warning(f"Batch #{job['id']} status check failed: {e}")
+                continue
+            if status["processing_status"] != "ended":
+                continue
+            # Claim the job so that only one process delivers it
+            if not self.db.update_batch_job(job["id"], "delivering", expected_status=job["status"]):
+                continue
+            try:
+                await self.deliver(bot, job)
+                delivered += 1
+            except Exception as e:
+                self.db.update_batch_job(job["id"], "failed")
+                metrics.BATCH_JOBS.inc(result="failed")
+                logger.error(f"Batch #{job['id']} delivery failed: {e}")
+        return delivered
+
+    async def deliver(self, bot, job: Dict):
+        """Store a finished job's results, log their cost and send them to the chat."""
+        results = await asyncio.to_thread(self.claude.get_batch_results, job["batch_id"])
+        items = {f"item-{item['id']}": item for item in self.db.get_batch_items(job["id"])}
+        model = job["model"]
+
+        rows, delivered = [], []
+        succeeded = failed = 0
+        total_cost = 0.0
+        for result in results:
+            item = items.get(result["custom_id"])
+            if item is None:
+                continue
+            cost = 0.0
+            if result["status"] == "succeeded":
+                succeeded += 1
+                cost = self.db.log_usage(job["user_id"], model, result["input_tokens"],
+                                         result["output_tokens"], batch=True)
+                total_cost += cost
+                metrics.TOKENS.inc(result["input_tokens"], model=model, direction="input")
+                metrics.TOKENS.inc(result["output_tokens"], model=model, direction="output")
+                metrics.COST.inc(cost, model=model)
+                text = result["text"]
+            else:
+                failed += 1
+                text = result["error"] or result["status"]
+            rows.append((item["id"], result["status"], text,
+                         result["input_tokens"], result["output_tokens"], cost))
+            delivered.append((item["title"], result["status"], text))
+        self.db.save_batch_results(rows)
+
+        status = "cancelled" if job["status"] == "canceling" else "ended"
+        self.db.update_batch_job(job["id"], status, results=(succeeded, failed, total_cost))
+        metrics.BATCH_JOBS.inc(result=status)
+        logger.info(
+            f"User {job['user_id']} - Batch #{job['id']} {status}: {succeeded} succeeded, {failed} failed, "
+            f"Cost: ${total_cost:.4f}"
+        )
+
+        summary = (f"📦 Пакет #{job['id']} готов: {succeeded} из {len(items)} успешно, "
+                   f"стоимость ${total_cost:.4f}")
+        if len(delivered) > INLINE_RESULTS:
+            report = "\n\n".join(f"## {title}\n\n{text if outcome == 'succeeded' else f'❌ {text}'}"
+                                 for title, outcome, text in delivered)
+            await bot.send_document(job["chat_id"], document=io.BytesIO(report.encode("utf-8")),
+                                    filename=f"batch-{job['id']}.md", caption=summary)
+            return
+
+        await bot.send_message(job["chat_id"], summary)
+        for title, outcome, text in delivered:
+            if outcome != "succeeded":
+                await bot.send_message(job["chat_id"], f"❌ {title}: {text}")
+                continue
+            body = f"📄 <b>{html.escape(title)}</b>\n\n{convert_markdown_to_html(text)}"
+            for chunk in split_message(body):
+                try:
+                    await bot.send_message(job["chat_id"], chunk, parse_mode=ParseMode.HTML)
+                except Exception as e:
+                    logger.warning(f"Batch #{job['id']} HTML send failed, sending plain text: {e}")
+                    await bot.send_message(job["chat_id"], chunk)
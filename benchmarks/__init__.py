@@ -0,0 +1,6 @@
+"""Offline benchmarks for the bot.
+
+Run from the repository root, e.g.:
+
+    python -m benchmarks.e2e --requests 200 --concurrency 8
+"""
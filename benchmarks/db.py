@@ -0,0 +1,389 @@
+"""Database micro-benchmarks at production data sizes.
+
+    python -m benchmarks.db --sizes 10k,1m
+    python -m benchmarks.db --sizes 10m --data-dir /var/tmp/bench-db --threads 8
+    python -m benchmarks.db --sizes 1m --json after.json --compare before.json
+
+For every size the users, conversations and usage_stats tables are
+filled with synthetic rows (one user per 100 rows, at least 100), then
+every public Database method is timed single-threaded and from
+concurrent threads. The SQL each method runs is captured through a
+trace callback and its EXPLAIN QUERY PLAN is reported, so schema and
+connection changes can be judged on numbers.
+
+Populated databases are kept in --data-dir and reused by later runs.
+Write benchmarks add a few rows per run; delete the files for a clean
+baseline.
+"""
+import argparse
+import inspect
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+from benchmarks.harness import git_commit, load_json, percentile, write_json  # also puts the repo on sys.path
+
+from database import Database  # noqa: E402
+
+DAY = 86_400
+MODELS = ["claude-3-5-sonnet-20241022", "claude-3-haiku-20240307", "claude-3-opus-20240229"]
+
+# Words mixed into every history turn so full-text search has frequent and rare words to match
+VOCABULARY = [f"term{i}" for i in range(1000)]
+
+
+def parse_size(value: str) -> int:
+    value = value.strip().lower()
+    multiplier = {"k": 1_000, "m": 1_000_000}.get(value[-1], 1)
+    return int(float(value.rstrip("km")) * multiplier)
+
+
+def user_count(rows: int) -> int:
+    return max(100, rows // 100)
+
+
+def populate(path: str, rows: int, content_len: int, seed: int):
+    """Create a database with synthetic users, conversations and usage rows."""
+    Database(path)  # creates the schema exactly as the bot does
+    rng = random.Random(seed)
+    users = user_count(rows)
+    now = time.time()
+    filler = ("lorem ipsum dolor sit amet " * (content_len // 27 + 1))[:content_len]
+
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA journal_mode=MEMORY")
+
+    def timestamp(max_age: float) -> str:
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(now - rng.random() * max_age))
+
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO users (user_id, username, first_name, is_authorized, is_admin, created_at, last_active) "
+            "VALUES (?, ?, ?, ?, 0, ?, ?)",
+            ((100 + i, f"user{i}", f"User {i}", int(rng.random() < 0.8), timestamp(365 * DAY), timestamp(30 * DAY))
+             for i in range(users)),
+        )
+
+    batch = 100_000
+    for table, make_row, sql in (
+        ("conversations",
+         lambda: (100 + int(rng.paretovariate(1.2)) % users, None, rng.choice(("user", "assistant")),
+                  f"{VOCABULARY[int(rng.paretovariate(1.0)) % 1000]} {rng.choice(VOCABULARY)} {filler}",
+                  timestamp(30 * DAY)),
+         "INSERT INTO conversations (user_id, chat_id, role, content, timestamp) VALUES (?, ?, ?, ?, ?)"),
+        ("usage_stats",
+         lambda: (100 + int(rng.paretovariate(1.2)) % users, rng.choice(MODELS), rng.randint(50, 5000),
+                  rng.randint(20, 2000), rng.random() * 0.05, timestamp(90 * DAY)),
+         "INSERT INTO usage_stats (user_id, model, input_tokens, output_tokens, cost_usd, timestamp) "
+         "VALUES (?, ?, ?, ?, ?, ?)"),
+    ):
+        done = 0
+        while done < rows:
+            count = min(batch, rows - done)
+            if table == "conversations":
+                # Private chats: chat_id == user_id
+                data = [(u, u, role, content, ts) for u, _, role, content, ts in (make_row() for _ in range(count))]
+            else:
+                data = [make_row() for _ in range(count)]
+            with conn:
+                conn.executemany(sql, data)
+            done += count
+            print(f"\r  {table}: {done:,}/{rows:,}", end="", file=sys.stderr)
+        print(file=sys.stderr)
+
+    # Hot user with recent history, the common case for get_conversation_history
+    with conn:
+        conn.executemany(
+            "INSERT INTO conversations (user_id, chat_id, role, content) VALUES (100, 100, ?, ?)",
+            [(("user", "assistant")[i % 2], filler) for i in range(40)],
+        )
+        # A collecting batch job with a few items
+        job_id = conn.execute(
+            "INSERT INTO batch_jobs (user_id, chat_id, prompt) VALUES (100, 100, 'Summarize')"
+        ).lastrowid
+        conn.executemany(
+            "INSERT INTO batch_items (job_id, title, content) VALUES (?, ?, ?)",
+            [(job_id, f"doc{i}.txt", filler) for i in range(20)],
+        )
+        conn.execute("UPDATE batch_jobs SET item_count = 20 WHERE id = ?", (job_id,))
+    conn.close()
+
+
+class TracingDatabase(Database):
+    """Database whose connections report executed SQL to a callback."""
+
+    def __init__(self, db_path: str):
+        self.statements: List[str] = []
+        self.capture = False
+        super().__init__(db_path)
+
+    def get_connection(self):
+        conn = super().get_connection()
+        if self.capture:
+            conn.set_trace_callback(self.statements.append)
+        return conn
+
+
+def benchmark_cases(rows: int) -> Dict[str, Callable[[Database, random.Random], Tuple]]:
+    """Argument factories for each public Database method."""
+    users = user_count(rows)
+    hot_user = 100
+    # Pareto-distributed history: user 101 owns the largest chat
+    heavy_user = 101
+
+    def any_user(rng):
+        return 100 + rng.randrange(users)
+
+    return {
+        "is_authorized": lambda db, rng: (any_user(rng),),
+        "is_admin": lambda db, rng: (any_user(rng),),
+        "add_user": lambda db, rng: (any_user(rng), "bench", "Bench", None),
+        "authorize_user": lambda db, rng: (any_user(rng),),
+        "deauthorize_user": lambda db, rng: (100 + users - 1,),
+        "get_all_users": lambda db, rng: (),
+        "get_user": lambda db, rng: (any_user(rng),),
+        "set_users_authorized": lambda db, rng: ([any_user(rng) for _ in range(50)], True),
+        "import_users": lambda db, rng: ([(100 + users + i, None, f"Import {i}", None) for i in range(50)],),
+        "get_users_page": lambda db, rng: ("pending", None, db.get_users_page("pending", limit=20)[-1]["cursor"],
+                                           None, 21),
+        "count_users": lambda db, rng: ("pending",),
+        "get_user_counts": lambda db, rng: (),
+        "log_usage": lambda db, rng: (any_user(rng), MODELS[0], 500, 200),
+        "get_total_usage": lambda db, rng: (),
+        "get_user_usage": lambda db, rng: (any_user(rng),),
+        "get_usage_by_model": lambda db, rng: (7,),
+        "iter_usage": lambda db, rng: (any_user(rng),),
+        "get_tokens_since": lambda db, rng: (3600, any_user(rng)),
+        "add_message_to_history": lambda db, rng: (hot_user, hot_user, "user", "benchmark message"),
+        "add_messages_to_history": lambda db, rng: ([(hot_user, hot_user, "user", "benchmark message"),
+                                                     (hot_user, hot_user, "assistant", "benchmark reply")],),
+        "get_conversation_history": lambda db, rng: (hot_user, hot_user, 10),
+        "get_recent_turns": lambda db, rng: (hot_user, hot_user, 20),
+        "search_history": lambda db, rng: (heavy_user, heavy_user, rng.choice(("term1", "term5 lorem", "term99")),
+                                           5, 0),
+        "iter_conversations": lambda db, rng: (any_user(rng),),
+        "clear_conversation_history": lambda db, rng: (any_user(rng), -1),
+        "get_turns_since": lambda db, rng: (hot_user, hot_user, 0),
+        "get_summary": lambda db, rng: (hot_user, hot_user),
+        "save_summary": lambda db, rng: (hot_user, hot_user, "benchmark summary",
+                                         db.get_turns_since(hot_user, hot_user, 0, 1)[-1][0]),
+        "get_setting": lambda db, rng: ("system_prompt",),
+        "set_setting": lambda db, rng: ("bench_setting", str(rng.random())),
+        "create_batch_job": lambda db, rng: (hot_user, hot_user, "benchmark prompt"),
+        "get_batch_jobs": lambda db, rng: (None, None, ["submitted", "canceling"], 1000),
+        "update_batch_job": lambda db, rng: (1, "collecting", "collecting"),
+        "add_batch_item": lambda db, rng: (1, "bench.txt", "benchmark item"),
+        "get_batch_items": lambda db, rng: (1,),
+        "save_batch_results": lambda db, rng: ([(1, "succeeded", "benchmark result", 500, 200, 0.001)],),
+    }
+
+
+def public_methods() -> List[str]:
+    return [name for name, member in inspect.getmembers(Database, inspect.isfunction)
+            if not name.startswith("_") and name not in ("get_connection", "init_database", "close")]
+
+
+# Literals in traced SQL, which arrives with the bound values filled in
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def statement_shape(sql: str) -> str:
+    """SQL text with literals replaced, so every row of an executemany is one statement."""
+    return " ".join(LITERALS.sub("?", sql).split())
+
+
+def query_plans(path: str, statements: List[str]) -> List[str]:
+    """EXPLAIN QUERY PLAN for captured SELECT/UPDATE/DELETE/INSERT statements, once per statement text."""
+    conn = sqlite3.connect(path)
+    plans = []
+    shapes: Dict[str, str] = {}
+    for sql in statements:
+        if sql.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE", "INSERT")):
+            shapes.setdefault(statement_shape(sql), sql)
+    for sql in shapes.values():
+        try:
+            rows = conn.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+        except sqlite3.Error as e:
+            plans.append(f"{' '.join(sql.split())[:120]}\n      (plan unavailable: {e})")
+            continue
+        detail = "; ".join(row[-1] for row in rows) or "no plan"
+        plans.append(f"{' '.join(sql.split())[:120]}\n      -> {detail}")
+    conn.close()
+    return plans
+
+
+def call(fn, args):
+    """Call a method; export iterators are drained so every batch is timed."""
+    result = fn(*args)
+    if inspect.isgenerator(result):
+        for _ in result:
+            pass
+
+
+def time_single(db: Database, method: str, make_args, iterations: int, seed: int) -> List[float]:
+    rng = random.Random(seed)
+    fn = getattr(db, method)
+    timings = []
+    for _ in range(iterations):
+        args = make_args(db, rng)
+        start = time.perf_counter()
+        call(fn, args)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def time_concurrent(db: Database, method: str, make_args, iterations: int, threads: int,
+                    seed: int) -> Tuple[List[float], int, float]:
+    timings: List[float] = []
+    errors = 0
+    lock = threading.Lock()
+
+    def worker(index: int):
+        nonlocal errors
+        rng = random.Random(seed + index)
+        fn = getattr(db, method)
+        local = []
+        local_errors = 0
+        for _ in range(iterations):
+            args = make_args(db, rng)
+            start = time.perf_counter()
+            try:
+                call(fn, args)
+            except sqlite3.Error:
+                local_errors += 1
+                continue
+            local.append(time.perf_counter() - start)
+        with lock:
+            timings.extend(local)
+            errors += local_errors
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(worker, range(threads)))
+    return timings, errors, time.perf_counter() - start
+
+
+def stats(timings: List[float], elapsed: float = None) -> Dict:
+    total = elapsed if elapsed is not None else sum(timings)
+    return {
+        "p50_us": round(percentile(timings, 50) * 1e6, 1),
+        "p95_us": round(percentile(timings, 95) * 1e6, 1),
+        "ops_per_s": round(len(timings) / total, 1) if total else 0.0,
+    }
+
+
+def run_size(path: str, rows: int, args) -> Dict:
+    db = TracingDatabase(path)
+    cases = benchmark_cases(rows)
+    results = {}
+
+    for method in public_methods():
+        make_args = cases.get(method)
+        if make_args is None:
+            print(f"  {method}: no benchmark case, skipped", file=sys.stderr)
+            continue
+
+        # Capture the SQL of one call for the query plan
+        db.statements.clear()
+        db.capture = True
+        getattr(db, method)(*make_args(db, random.Random(args.seed)))
+        db.capture = False
+        plans = query_plans(path, db.statements)
+
+        iterations = args.iterations if method != "get_all_users" else max(5, args.iterations // 20)
+        single = time_single(db, method, make_args, iterations, args.seed)
+        concurrent, errors, elapsed = time_concurrent(db, method, make_args, max(1, iterations // args.threads),
+                                                      args.threads, args.seed)
+        results[method] = {
+            "single": stats(single),
+            "concurrent": {**stats(concurrent, elapsed), "errors": errors},
+            "plans": plans,
+        }
+    return results
+
+
+def print_results(rows: int, results: Dict, threads: int, show_plans: bool):
+    print(f"\n== {rows:,} rows ({user_count(rows):,} users) ==")
+    print(f"{'method':<30}{'p50 us':>10}{'p95 us':>10}{'ops/s':>10}   "
+          f"{f'x{threads} ops/s':>12}{'p95 us':>10}{'errors':>8}")
+    for method, r in results.items():
+        s, c = r["single"], r["concurrent"]
+        print(f"{method:<30}{s['p50_us']:>10.1f}{s['p95_us']:>10.1f}{s['ops_per_s']:>10.0f}   "
+              f"{c['ops_per_s']:>12.0f}{c['p95_us']:>10.1f}{c['errors']:>8}")
+    if show_plans:
+        print("\nquery plans:")
+        for method, r in results.items():
+            for plan in r["plans"]:
+                print(f"  {method}: {plan}")
+
+
+def compare_results(current: Dict, baseline: Dict, max_regression: float) -> bool:
+    ok = True
+    print(f"\nComparison with {baseline.get('commit') or 'baseline'} (single-thread p95):")
+    for size, methods in current["sizes"].items():
+        for method, r in methods.items():
+            base = baseline.get("sizes", {}).get(size, {}).get(method)
+            if not base:
+                continue
+            before, after = base["single"]["p95_us"], r["single"]["p95_us"]
+            change = (after - before) / before * 100 if before else 0.0
+            flag = "  REGRESSION" if change > max_regression else ""
+            ok = ok and not flag
+            print(f"  {size:>10} {method:<30}{before:>10.1f}{after:>10.1f}{change:>+9.1f}%{flag}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Database methods at production data sizes.")
+    parser.add_argument("--sizes", default="10k,1m", help="Rows per table, e.g. 10k,1m,10m")
+    parser.add_argument("--data-dir", help="Keep populated databases here and reuse them")
+    parser.add_argument("--iterations", type=int, default=200, help="Calls per method (single-threaded)")
+    parser.add_argument("--threads", type=int, default=8, help="Threads for the concurrent run")
+    parser.add_argument("--content-len", type=int, default=200, help="Characters per stored message")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--no-plans", action="store_true", help="Do not print query plans")
+    parser.add_argument("--json", help="Write results to this file")
+    parser.add_argument("--compare", help="Compare with a previous --json result")
+    parser.add_argument("--max-regression", type=float, default=20.0, help="Allowed p95 regression, %%")
+    args = parser.parse_args()
+
+    tmp = None
+    data_dir = args.data_dir
+    if not data_dir:
+        tmp = tempfile.TemporaryDirectory(prefix="bot-db-bench-")
+        data_dir = tmp.name
+    os.makedirs(data_dir, exist_ok=True)
+
+    output = {"commit": git_commit(), "params": vars(args), "sizes": {}}
+    try:
+        for size in args.sizes.split(","):
+            rows = parse_size(size)
+            path = os.path.join(data_dir, f"bench_{rows}.db")
+            if not os.path.exists(path):
+                print(f"Populating {path} with {rows:,} rows per table...", file=sys.stderr)
+                start = time.perf_counter()
+                populate(path, rows, args.content_len, args.seed)
+                print(f"  done in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+            results = run_size(path, rows, args)
+            output["sizes"][str(rows)] = results
+            print_results(rows, results, args.threads, not args.no_plans)
+    finally:
+        if tmp is not None:
+            tmp.cleanup()
+
+    if args.json:
+        write_json(args.json, output)
+    if args.compare and not compare_results(output, load_json(args.compare), args.max_regression):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""End-to-end benchmark: synthetic updates through bot.py against local stand-ins.
+
+    python -m benchmarks.e2e --requests 200 --concurrency 8 --json results.json
+    python -m benchmarks.e2e --compare results.json     # fails on p95 regressions
+
+Runs fully offline. The update mix, sizes and stand-in behaviour are
+seeded, so results from different commits on the same machine are
+comparable.
+"""
+import argparse
+import asyncio
+import platform
+import random
+import sys
+import time
+
+from benchmarks.harness import (
+    ADMIN_USER_ID,
+    BotHarness,
+    compare,
+    git_commit,
+    load_json,
+    run,
+    summarize,
+    write_json,
+)
+from benchmarks.standins import StandinConfig
+
+KINDS = ("text", "photo", "document", "voice")
+
+
+def parse_mix(value: str) -> dict:
+    """Parse 'text=70,photo=10,document=10,voice=10' into weights."""
+    mix = {}
+    for part in value.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError(f"unknown kind {kind!r}, expected one of {', '.join(KINDS)}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+async def benchmark(args) -> int:
+    harness = BotHarness(
+        telegram=StandinConfig(args.telegram_latency, args.error_rate, args.seed),
+        anthropic=StandinConfig(0.0, args.error_rate, args.seed + 1),
+        whisper=StandinConfig(args.whisper_latency, args.error_rate, args.seed + 2),
+        claude_ttft=args.claude_ttft,
+        claude_token_rate=args.claude_token_rate,
+        output_tokens=args.output_tokens,
+        trace_malloc=args.tracemalloc,
+    )
+    await harness.start()
+    try:
+        rng = random.Random(args.seed)
+        users = [ADMIN_USER_ID + 1 + i for i in range(args.chats)]
+        harness.authorize(users)
+
+        kinds = list(args.mix)
+        weights = [args.mix[k] for k in kinds]
+        plan = []
+        for _ in range(args.requests):
+            kind = rng.choices(kinds, weights)[0]
+            user_id = rng.choice(users)
+            plan.append((kind, harness.make_update(kind, user_id, user_id, file_size={
+                "photo": args.photo_size, "document": args.document_size, "voice": args.voice_size,
+            }.get(kind, 0))))
+
+        # Warm-up: one of each kind, not measured
+        for kind in kinds:
+            await harness.process(harness.make_update(kind, users[0], users[0]))
+
+        latencies = {kind: [] for kind in kinds}
+        queue: asyncio.Queue = asyncio.Queue()
+        for item in plan:
+            queue.put_nowait(item)
+
+        async def worker():
+            while True:
+                try:
+                    kind, update = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                latencies[kind].append(await harness.process(update))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+
+        all_latencies = [x for values in latencies.values() for x in values]
+        result = {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "params": {k: v for k, v in vars(args).items() if k not in ("json", "compare")},
+            "elapsed_s": round(elapsed, 3),
+            "throughput_rps": round(len(all_latencies) / elapsed, 3),
+            "latency": {"all": summarize(all_latencies),
+                        **{kind: summarize(values) for kind, values in latencies.items() if values}},
+            "memory": harness.memory(),
+            "counters": harness.counters(),
+        }
+    finally:
+        await harness.stop()
+
+    print(f"commit {result['commit']}  {args.requests} requests, concurrency {args.concurrency}, "
+          f"{args.chats} chats")
+    print(f"elapsed {result['elapsed_s']:.2f}s  throughput {result['throughput_rps']:.2f} req/s")
+    print(f"{'kind':<12}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, stats in result["latency"].items():
+        print(f"{name:<12}{stats['count']:>7}{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}"
+              f"{stats['p99_ms']:>10.1f}{stats['max_ms']:>10.1f}")
+    print("memory  " + "  ".join(f"{k}={v}" for k, v in result["memory"].items()))
+    print("counters  " + "  ".join(f"{k}={v}" for k, v in result["counters"].items()))
+
+    if args.json:
+        write_json(args.json, result)
+    if args.compare:
+        if not compare(result, load_json(args.compare), args.max_regression):
+            return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end bot benchmark against local stand-ins.")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent in-flight updates")
+    parser.add_argument("--chats", type=int, default=10, help="Distinct users/private chats")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("text=70,photo=10,document=10,voice=10"))
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--photo-size", type=int, default=200_000)
+    parser.add_argument("--document-size", type=int, default=50_000)
+    parser.add_argument("--voice-size", type=int, default=30_000)
+    parser.add_argument("--claude-ttft", type=float, default=0.3, help="Seconds before the first token")
+    parser.add_argument("--claude-token-rate", type=float, default=200.0, help="Output tokens per second")
+    parser.add_argument("--output-tokens", type=int, default=150)
+    parser.add_argument("--telegram-latency", type=float, default=0.02, help="Seconds per Bot API call")
+    parser.add_argument("--whisper-latency", type=float, default=0.5, help="Seconds per transcription")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Injected 5xx probability per call")
+    parser.add_argument("--tracemalloc", action="store_true", help="Also report Python heap peak (slower)")
+    parser.add_argument("--json", help="Write results to this file")
+    parser.add_argument("--compare", help="Compare with a previous --json result")
+    parser.add_argument("--max-regression", type=float, default=10.0, help="Allowed p95 regression, %%")
+    sys.exit(run(benchmark(parser.parse_args())))
+
+
+if __name__ == "__main__":
+    main()
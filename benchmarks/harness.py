@@ -0,0 +1,326 @@
+"""Run bot.py's handlers against local stand-ins.
+
+BotHarness starts the Telegram, Anthropic and Whisper stand-ins, points
+the bot at them through environment variables (before ``bot`` is
+imported), and feeds Telegram updates straight into the application's
+handlers, timing each one.
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from benchmarks.standins import (  # noqa: E402
+    BOT_USER,
+    AnthropicStandin,
+    StandinConfig,
+    TelegramStandin,
+    WhisperStandin,
+)
+
+ADMIN_USER_ID = 1
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Linear-interpolated percentile, q in [0, 100]."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * q / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(latencies: List[float]) -> Dict:
+    """Latency summary in milliseconds."""
+    return {
+        "count": len(latencies),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2) if latencies else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(max(latencies) * 1000, 2) if latencies else 0.0,
+    }
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MB (Linux reports KB)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def standin_counters(telegram: TelegramStandin, anthropic: AnthropicStandin, whisper: WhisperStandin) -> Dict:
+    return {
+        "telegram_requests": telegram.requests,
+        "telegram_messages": telegram.messages_sent,
+        "telegram_chat_actions": telegram.chat_actions,
+        "error_replies": telegram.error_replies,
+        "claude_requests": anthropic.requests,
+        "whisper_requests": whisper.requests,
+        "injected_errors": telegram.injected_errors + anthropic.injected_errors + whisper.injected_errors,
+    }
+
+
+def _serve_standins(conn, telegram: StandinConfig, anthropic: StandinConfig, whisper: StandinConfig,
+                    anthropic_options: Dict):
+    """Child process of StandinProcess: serve until told to stop, answering counter queries."""
+    standins = (TelegramStandin(telegram), AnthropicStandin(anthropic, **anthropic_options), WhisperStandin(whisper))
+    for standin in standins:
+        standin.start()
+    conn.send([standin.url for standin in standins])
+    while conn.recv() == "counters":
+        conn.send(standin_counters(*standins))
+    for standin in standins:
+        standin.stop()
+
+
+class StandinProcess:
+    """The stand-ins served from a child process, so their buffers don't count as the bot's memory."""
+
+    def __init__(self, telegram: StandinConfig, anthropic: StandinConfig, whisper: StandinConfig,
+                 anthropic_options: Dict):
+        context = multiprocessing.get_context("spawn")
+        self._conn, child = context.Pipe()
+        self._process = context.Process(
+            target=_serve_standins, args=(child, telegram, anthropic, whisper, anthropic_options), daemon=True
+        )
+        self._process.start()
+        self.urls: List[str] = self._conn.recv()
+
+    def counters(self) -> Dict:
+        self._conn.send("counters")
+        return self._conn.recv()
+
+    def stop(self):
+        self._conn.send("stop")
+        self._process.join(5)
+
+
+class BotHarness:
+    """Owns the stand-ins, a temporary database and the bot application.
+
+    With ``isolate_standins`` the stand-ins run in a child process (see
+    StandinProcess) and are reachable only through counters().
+    """
+
+    def __init__(self, telegram: StandinConfig = None, anthropic: StandinConfig = None,
+                 whisper: StandinConfig = None, claude_ttft: float = 0.3,
+                 claude_token_rate: float = 100.0, output_tokens: int = 150,
+                 trace_malloc: bool = False, isolate_standins: bool = False):
+        anthropic_options = {"ttft": claude_ttft, "token_rate": claude_token_rate, "output_tokens": output_tokens}
+        self.standin_process: Optional[StandinProcess] = None
+        if isolate_standins:
+            self._standin_configs = (telegram, anthropic, whisper, anthropic_options)
+            self.telegram = self.anthropic = self.whisper = None
+        else:
+            self.telegram = TelegramStandin(telegram)
+            self.anthropic = AnthropicStandin(anthropic, **anthropic_options)
+            self.whisper = WhisperStandin(whisper)
+        self.trace_malloc = trace_malloc
+        self.tmpdir = tempfile.TemporaryDirectory(prefix="bot-bench-")
+        self.application = None
+        self.app = None
+        self.bot_module = None
+        self._update_id = 0
+
+    async def start(self):
+        if self.telegram is None:
+            self.standin_process = StandinProcess(*self._standin_configs)
+            telegram_url, anthropic_url, whisper_url = self.standin_process.urls
+        else:
+            for standin in (self.telegram, self.anthropic, self.whisper):
+                standin.start()
+            telegram_url, anthropic_url, whisper_url = self.telegram.url, self.anthropic.url, self.whisper.url
+
+        os.environ.update({
+            "TELEGRAM_BOT_TOKEN": "123456:BENCH",
+            "TELEGRAM_API_URL": telegram_url,
+            "CLAUDE_API_KEY": "bench-key",
+            "ANTHROPIC_BASE_URL": anthropic_url,
+            "WHISPER_URL": whisper_url,
+            "ADMIN_USER_ID": str(ADMIN_USER_ID),
+            "DATABASE_PATH": os.path.join(self.tmpdir.name, "bench.db"),
+            "METRICS_PORT": "0",
+        })
+        os.environ.pop("TRACE_FILE", None)
+
+        import bot  # noqa: E402 — configuration is read at import time
+        self.bot_module = bot
+        logging.getLogger().setLevel(logging.WARNING)
+
+        self.app = bot.create_app_context()
+        self.application = bot.build_application(self.app)
+        await self.application.initialize()
+
+        if self.trace_malloc:
+            tracemalloc.start()
+
+    async def stop(self):
+        if self.trace_malloc and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        if self.application is not None:
+            await self.application.shutdown()
+        if self.app is not None:
+            self.app.close()
+        if self.standin_process is not None:
+            self.standin_process.stop()
+        else:
+            for standin in (self.telegram, self.anthropic, self.whisper):
+                standin.stop()
+        self.tmpdir.cleanup()
+
+    def authorize(self, user_ids):
+        """Register and authorize synthetic users."""
+        db = self.app.db
+        for user_id in user_ids:
+            db.add_user(user_id, f"user{user_id}", "Bench", None)
+            db.authorize_user(user_id)
+
+    def make_update(self, kind: str, user_id: int, chat_id: int, text: str = "",
+                    file_size: int = 0, chat_type: str = "private", file_name: str = "notes.txt",
+                    mime_type: str = "text/plain", mention: bool = False, reply_to_bot: bool = False,
+                    duration: int = 0, media_group: Optional[str] = None) -> Dict:
+        """Build a Bot API update dict for a text, photo, document or voice message.
+
+        ``mention`` prefixes the text or caption with an @mention of the bot;
+        ``reply_to_bot`` makes the message a reply to an earlier bot message;
+        ``media_group`` makes a photo or document part of an album.
+        """
+        self._update_id += 1
+        message = {
+            "message_id": self._update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": chat_type},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench", "username": f"user{user_id}"},
+        }
+        if kind == "text":
+            text = text or "Расскажи коротко, что такое бенчмарк?"
+        if mention:
+            handle = f"@{BOT_USER['username']}"
+            text = f"{handle} {text}".strip()
+            entities_key = "entities" if kind == "text" else "caption_entities"
+            message[entities_key] = [{"type": "mention", "offset": 0, "length": len(handle)}]
+        if reply_to_bot:
+            message["reply_to_message"] = {
+                "message_id": max(1, self._update_id - 1),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": chat_type},
+                "from": BOT_USER,
+                "text": "...",
+            }
+
+        if kind == "text":
+            message["text"] = text
+        elif kind == "photo":
+            size = file_size or 200_000
+            message["photo"] = [
+                {"file_id": f"thumb-{size // 20}", "file_unique_id": f"t{self._update_id}",
+                 "width": 90, "height": 90, "file_size": size // 20},
+                {"file_id": f"photo-{size}", "file_unique_id": f"p{self._update_id}",
+                 "width": 1280, "height": 960, "file_size": size},
+            ]
+            if text:
+                message["caption"] = text
+        elif kind == "document":
+            size = file_size or 50_000
+            message["document"] = {"file_id": f"doc-{size}", "file_unique_id": f"d{self._update_id}",
+                                   "file_name": file_name, "mime_type": mime_type, "file_size": size}
+            if text:
+                message["caption"] = text
+        elif kind == "voice":
+            size = file_size or 30_000
+            message["voice"] = {"file_id": f"voice-{size}", "file_unique_id": f"v{self._update_id}",
+                                "duration": duration or max(1, size // 6000), "mime_type": "audio/ogg",
+                                "file_size": size}
+            if text:
+                message["caption"] = text
+        else:
+            raise ValueError(f"Unknown update kind: {kind}")
+        if media_group:
+            message["media_group_id"] = media_group
+        return {"update_id": self._update_id, "message": message}
+
+    async def process(self, update_data: Dict) -> float:
+        """Run one update through the application's handlers; returns seconds taken."""
+        from telegram import Update
+
+        update = Update.de_json(update_data, self.application.bot)
+        start = time.perf_counter()
+        # Through the update processor, as in production: chats in parallel, each in order
+        await self.application.update_processor.process_update(update, self.application.process_update(update))
+        return time.perf_counter() - start
+
+    def memory(self) -> Dict:
+        result = {"peak_rss_mb": round(peak_rss_mb(), 1)}
+        if self.trace_malloc and tracemalloc.is_tracing():
+            _, peak = tracemalloc.get_traced_memory()
+            result["tracemalloc_peak_mb"] = round(peak / 1_000_000, 2)
+        return result
+
+    def counters(self) -> Dict:
+        if self.standin_process is not None:
+            return self.standin_process.counters()
+        return standin_counters(self.telegram, self.anthropic, self.whisper)
+
+
+def compare(current: Dict, baseline: Dict, max_regression: float) -> bool:
+    """Print a comparison table; returns False if any p95 regressed beyond max_regression %."""
+    ok = True
+    print(f"\nComparison with {baseline.get('commit') or 'baseline'}:")
+    print(f"{'':<12}{'metric':<16}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, stats in current["latency"].items():
+        base = baseline.get("latency", {}).get(name)
+        if not base:
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms"):
+            before, after = base[metric], stats[metric]
+            change = (after - before) / before * 100 if before else 0.0
+            flag = ""
+            if metric == "p95_ms" and change > max_regression:
+                flag = "  REGRESSION"
+                ok = False
+            print(f"{name:<12}{metric:<16}{before:>12.1f}{after:>12.1f}{change:>+9.1f}%{flag}")
+    before, after = baseline.get("throughput_rps", 0), current["throughput_rps"]
+    change = (after - before) / before * 100 if before else 0.0
+    print(f"{'all':<12}{'throughput_rps':<16}{before:>12.2f}{after:>12.2f}{change:>+9.1f}%")
+    return ok
+
+
+def load_json(path: str) -> Dict:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_json(path: str, data: Dict):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+
+
+def run(coro):
+    """asyncio.run wrapper that keeps KeyboardInterrupt quiet."""
+    try:
+        return asyncio.run(coro)
+    except KeyboardInterrupt:
+        return 130
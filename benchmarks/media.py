@@ -0,0 +1,156 @@
+"""Memory benchmark: concurrent media uploads through bot.py against local stand-ins.
+
+    python -m benchmarks.media --size 5000000 --concurrency 8 --json results.json
+    python -m benchmarks.media --kinds photo --compare results.json   # fails on memory regressions
+
+Each kind runs in a fresh interpreter, with the stand-ins in a child
+process of their own, so the figures are the bot's alone: growth of peak
+RSS over the idle bot, the Python heap peak (tracemalloc), and the heap
+peak per in-flight upload as a multiple of the file size — roughly the
+number of whole copies of each file held at once.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import subprocess
+import sys
+import tracemalloc
+
+from benchmarks.harness import (
+    ADMIN_USER_ID,
+    ROOT,
+    BotHarness,
+    git_commit,
+    load_json,
+    peak_rss_mb,
+    run,
+    write_json,
+)
+
+KINDS = ("photo", "voice", "document")
+
+# Documents are cut to DOCUMENT_MAX_CHARS anyway; keep them to 1 MB
+MAX_DOCUMENT_SIZE = 1_000_000
+
+
+async def measure(kind: str, size: int, uploads: int, concurrency: int) -> dict:
+    """Upload `uploads` files of one kind, `concurrency` at a time, from different users."""
+    harness = BotHarness(claude_ttft=0.05, claude_token_rate=5000, trace_malloc=True, isolate_standins=True)
+    await harness.start()
+    try:
+        users = [ADMIN_USER_ID + 1 + i for i in range(concurrency)]
+        harness.authorize(users)
+
+        # Warm-up with a small file, not measured
+        await harness.process(harness.make_update(kind, users[0], users[0], file_size=1000))
+        baseline_rss = peak_rss_mb()
+        tracemalloc.reset_peak()
+
+        queue: asyncio.Queue = asyncio.Queue()
+        for i in range(uploads):
+            user_id = users[i % concurrency]
+            queue.put_nowait(harness.make_update(kind, user_id, user_id, file_size=size))
+
+        async def worker():
+            while not queue.empty():
+                await harness.process(queue.get_nowait())
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        _, heap_peak = tracemalloc.get_traced_memory()
+        counters = harness.counters()
+    finally:
+        await harness.stop()
+
+    return {
+        "size": size,
+        "uploads": uploads,
+        "concurrency": concurrency,
+        "rss_growth_mb": round(peak_rss_mb() - baseline_rss, 1),
+        "heap_peak_mb": round(heap_peak / 1_000_000, 1),
+        "copies_per_upload": round(heap_peak / concurrency / size, 2),
+        "error_replies": counters["error_replies"],
+    }
+
+
+def run_kind(kind: str, args) -> dict:
+    """Measure one kind in a fresh interpreter, so peak RSS starts from zero."""
+    size = min(args.size, MAX_DOCUMENT_SIZE) if kind == "document" else args.size
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.media", "--measure", kind, "--size", str(size),
+         "--uploads", str(args.uploads), "--concurrency", str(args.concurrency)],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def compare(current: dict, baseline: dict, max_regression: float) -> bool:
+    """Print a comparison table; returns False if any peak grew beyond max_regression %."""
+    ok = True
+    print(f"\nComparison with {baseline.get('commit') or 'baseline'}:")
+    print(f"{'kind':<12}{'metric':<20}{'baseline':>12}{'current':>12}{'change':>10}")
+    for kind, stats in current["kinds"].items():
+        base = baseline.get("kinds", {}).get(kind)
+        if not base:
+            continue
+        for metric in ("rss_growth_mb", "heap_peak_mb", "copies_per_upload"):
+            before, after = base[metric], stats[metric]
+            change = (after - before) / before * 100 if before else 0.0
+            flag = ""
+            if metric != "copies_per_upload" and change > max_regression:
+                flag = "  REGRESSION"
+                ok = False
+            print(f"{kind:<12}{metric:<20}{before:>12.2f}{after:>12.2f}{change:>+9.1f}%{flag}")
+    return ok
+
+
+def benchmark(args) -> int:
+    result = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "params": {k: v for k, v in vars(args).items() if k not in ("json", "compare", "measure")},
+        "kinds": {kind: run_kind(kind, args) for kind in args.kinds},
+    }
+
+    print(f"commit {result['commit']}  {args.uploads} uploads per kind, concurrency {args.concurrency}")
+    print(f"{'kind':<12}{'size MB':>9}{'RSS growth MB':>15}{'heap peak MB':>14}{'copies/upload':>15}")
+    for kind, stats in result["kinds"].items():
+        print(f"{kind:<12}{stats['size'] / 1_000_000:>9.1f}{stats['rss_growth_mb']:>15.1f}"
+              f"{stats['heap_peak_mb']:>14.1f}{stats['copies_per_upload']:>15.2f}")
+
+    if args.json:
+        write_json(args.json, result)
+    if args.compare:
+        if not compare(result, load_json(args.compare), args.max_regression):
+            return 1
+    return 0
+
+
+def parse_kinds(value: str) -> list:
+    kinds = [kind.strip() for kind in value.split(",") if kind.strip()]
+    for kind in kinds:
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError(f"unknown kind {kind!r}, expected one of {', '.join(KINDS)}")
+    return kinds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory use of concurrent media uploads.")
+    parser.add_argument("--kinds", type=parse_kinds, default=list(KINDS))
+    parser.add_argument("--size", type=int, default=5_000_000, help="File size in bytes (documents: at most 1 MB)")
+    parser.add_argument("--uploads", type=int, default=16, help="Uploads per kind")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent in-flight uploads")
+    parser.add_argument("--json", help="Write results to this file")
+    parser.add_argument("--compare", help="Compare with a previous --json result")
+    parser.add_argument("--max-regression", type=float, default=10.0, help="Allowed peak growth, %%")
+    parser.add_argument("--measure", choices=KINDS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(run(measure(args.measure, args.size, args.uploads, args.concurrency))))
+        return
+    sys.exit(benchmark(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""Replay a traffic recording against local stand-ins.
+
+    python -m benchmarks.replay recording.jsonl                 # real speed
+    python -m benchmarks.replay recording.jsonl --speed 10      # 10x faster
+    python -m benchmarks.replay recording.jsonl --fanout 1,2,4,8 --slo-ms 15000
+
+Recordings come from the bot with RECORD_FILE set (see recorder.py).
+Each recorded chat is mapped to a synthetic chat; ``--fanout N`` clones
+every chat N times, multiplying the load while keeping its shape. For
+each fanout level the replayer reports latency (measured from the time
+the update was due, so falling behind shows up as latency), throughput
+and whether p95 stayed within the SLO.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from typing import Dict, List
+
+from benchmarks.harness import (
+    ADMIN_USER_ID,
+    BotHarness,
+    compare,
+    git_commit,
+    load_json,
+    percentile,
+    run,
+    summarize,
+    write_json,
+)
+from benchmarks.standins import LOREM, StandinConfig
+
+FILLER = LOREM * 4
+
+
+def load_recording(path: str, limit: int = 0) -> List[Dict]:
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    records.sort(key=lambda r: r["ts"])
+    return records[:limit] if limit else records
+
+
+def synthetic_text(length: int) -> str:
+    """Filler text of the recorded length."""
+    if length <= 0:
+        return ""
+    return (FILLER * (length // len(FILLER) + 1))[:length]
+
+
+class ChatMap:
+    """Maps anonymized chat/user hashes to synthetic IDs, per fanout copy."""
+
+    def __init__(self):
+        self._ids: Dict[tuple, int] = {}
+
+    def get(self, kind: str, key: str, copy: int, group: bool = False) -> int:
+        ident = (kind, key, copy)
+        if ident not in self._ids:
+            value = 10_000 + len(self._ids)
+            self._ids[ident] = -value if group else value
+        return self._ids[ident]
+
+
+def build_plan(harness: BotHarness, records: List[Dict], fanout: int, speed: float, chats: ChatMap):
+    """Turn recorded entries into (due offset, kind, update) tuples."""
+    start_ts = records[0]["ts"] if records else 0
+    plan = []
+    unauthorized = set()
+    users = set()
+    for copy in range(fanout):
+        for r in records:
+            group = r.get("chat_type") not in (None, "private")
+            user_id = chats.get("user", r["user"], copy)
+            chat_id = user_id if not group else chats.get("chat", r["chat"], copy, group=True)
+            if r.get("outcome") == "unauthorized":
+                unauthorized.add(user_id)
+            else:
+                users.add(user_id)
+
+            kind = r["kind"]
+            length = r.get("text_len", r.get("caption_len", 0))
+            update = harness.make_update(
+                kind, user_id, chat_id,
+                text=synthetic_text(length),
+                file_size=r.get("file_size") or 0,
+                chat_type=r.get("chat_type", "private"),
+                file_name=f"file{r.get('file_ext', '.txt')}",
+                mime_type=r.get("mime_type") or "text/plain",
+                mention=bool(r.get("mention")),
+                reply_to_bot=bool(r.get("reply_to_bot")),
+                duration=r.get("duration") or 0,
+                media_group=f"{r['media_group']}-{copy}" if r.get("media_group") else None,
+            )
+            due = (r["ts"] - start_ts) / speed if speed > 0 else 0.0
+            plan.append((due, kind, update))
+    plan.sort(key=lambda item: item[0])
+    return plan, users - unauthorized
+
+
+def recorded_latency(records: List[Dict]) -> Dict:
+    """Production latency per kind from the recorded stage timings."""
+    by_kind: Dict[str, List[float]] = {}
+    for r in records:
+        stages = r.get("stages_ms")
+        if stages and r.get("outcome") == "ok":
+            by_kind.setdefault(r["kind"], []).append(sum(stages.values()) / 1000)
+    return {kind: summarize(values) for kind, values in by_kind.items()}
+
+
+async def replay_level(harness: BotHarness, plan, max_concurrency: int) -> Dict:
+    latencies: Dict[str, List[float]] = {}
+    lateness: List[float] = []
+    semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+    start = time.perf_counter()
+
+    async def fire(due: float, kind: str, update: Dict):
+        delay = start + due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if semaphore is not None:
+            async with semaphore:
+                await _process(due, kind, update)
+        else:
+            await _process(due, kind, update)
+
+    async def _process(due: float, kind: str, update: Dict):
+        lateness.append(max(0.0, time.perf_counter() - start - due))
+        await harness.process(update)
+        latencies.setdefault(kind, []).append(time.perf_counter() - start - due)
+
+    await asyncio.gather(*(fire(*item) for item in plan))
+    elapsed = time.perf_counter() - start
+
+    all_latencies = [x for values in latencies.values() for x in values]
+    return {
+        "updates": len(plan),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(plan) / elapsed, 3) if elapsed else 0.0,
+        "start_lag_p95_ms": round(percentile(lateness, 95) * 1000, 2),
+        "latency": {"all": summarize(all_latencies),
+                    **{kind: summarize(values) for kind, values in sorted(latencies.items())}},
+    }
+
+
+async def replay(args) -> int:
+    records = load_recording(args.recording, args.limit)
+    if not records:
+        print(f"No records in {args.recording}")
+        return 1
+
+    harness = BotHarness(
+        telegram=StandinConfig(args.telegram_latency, args.error_rate, args.seed),
+        anthropic=StandinConfig(0.0, args.error_rate, args.seed + 1),
+        whisper=StandinConfig(args.whisper_latency, args.error_rate, args.seed + 2),
+        claude_ttft=args.claude_ttft,
+        claude_token_rate=args.claude_token_rate,
+        output_tokens=args.output_tokens,
+    )
+    await harness.start()
+    chats = ChatMap()
+    levels = {}
+    try:
+        for fanout in args.fanout:
+            plan, users = build_plan(harness, records, fanout, args.speed, chats)
+            harness.authorize(sorted(u for u in users if u != ADMIN_USER_ID))
+            result = await replay_level(harness, plan, args.max_concurrency)
+            result["chats"] = len({u["message"]["chat"]["id"] for _, _, u in plan})
+            result["sustained"] = result["latency"]["all"]["p95_ms"] <= args.slo_ms
+            levels[str(fanout)] = result
+    finally:
+        await harness.stop()
+
+    span = records[-1]["ts"] - records[0]["ts"]
+    print(f"commit {git_commit()}  {len(records)} recorded updates over {span:.0f}s, "
+          f"speed {'max' if args.speed <= 0 else f'{args.speed:g}x'}")
+
+    recorded = recorded_latency(records)
+    if recorded:
+        print("\nrecorded (production stage timings):")
+        for kind, stats in recorded.items():
+            print(f"  {kind:<10}{stats['count']:>7}  p50 {stats['p50_ms']:>9.1f}ms  p95 {stats['p95_ms']:>9.1f}ms")
+
+    print(f"\n{'fanout':>6}{'chats':>7}{'updates':>9}{'rps':>8}{'p50 ms':>10}{'p95 ms':>10}"
+          f"{'p99 ms':>10}{'lag p95':>10}  SLO {args.slo_ms:.0f}ms")
+    for fanout, result in levels.items():
+        stats = result["latency"]["all"]
+        print(f"{fanout:>6}{result['chats']:>7}{result['updates']:>9}{result['throughput_rps']:>8.2f}"
+              f"{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}"
+              f"{result['start_lag_p95_ms']:>10.1f}  {'ok' if result['sustained'] else 'FAIL'}")
+
+    sustained = [int(f) for f, r in levels.items() if r["sustained"]]
+    if sustained:
+        best = max(sustained)
+        print(f"\nHighest sustained fanout: {best} ({levels[str(best)]['chats']} concurrent chats)")
+
+    output = {
+        "commit": git_commit(),
+        "recording": args.recording,
+        "params": {k: v for k, v in vars(args).items() if k not in ("json", "compare")},
+        "recorded": recorded,
+        "levels": levels,
+    }
+    if args.json:
+        write_json(args.json, output)
+    if args.compare:
+        baseline = load_json(args.compare)
+        ok = True
+        for fanout, result in levels.items():
+            base = baseline.get("levels", {}).get(fanout)
+            if base:
+                print(f"\nfanout {fanout}:", end="")
+                ok = compare({**result, "commit": output["commit"]},
+                             {**base, "commit": baseline.get("commit")}, args.max_regression) and ok
+        if not ok:
+            return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded traffic against local stand-ins.")
+    parser.add_argument("recording", help="JSONL file written with RECORD_FILE")
+    parser.add_argument("--speed", type=float, default=1.0, help="Time multiplier; 0 sends everything at once")
+    parser.add_argument("--fanout", type=lambda v: [int(x) for x in v.split(",")], default=[1],
+                        help="Comma-separated chat multipliers to try, e.g. 1,2,4,8")
+    parser.add_argument("--max-concurrency", type=int, default=0, help="Cap on in-flight updates (0 = none)")
+    parser.add_argument("--limit", type=int, default=0, help="Only replay the first N records")
+    parser.add_argument("--slo-ms", type=float, default=15000, help="p95 latency target per fanout level")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--claude-ttft", type=float, default=0.5)
+    parser.add_argument("--claude-token-rate", type=float, default=80.0)
+    parser.add_argument("--output-tokens", type=int, default=300)
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument("--whisper-latency", type=float, default=1.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--json", help="Write results to this file")
+    parser.add_argument("--compare", help="Compare with a previous --json result")
+    parser.add_argument("--max-regression", type=float, default=10.0, help="Allowed p95 regression, %%")
+    sys.exit(run(replay(parser.parse_args())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,456 @@
+"""Local stand-ins for the Telegram Bot API, Anthropic Messages API and Whisper.
+
+Each stand-in is a small threaded HTTP server with configurable latency,
+token rate and error injection, so the bot can be driven end to end
+without network access. Randomness is seeded for repeatable runs.
+"""
+import json
+import random
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+BOT_USER = {"id": 999_000, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+LOREM = (
+    "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor "
+    "incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud "
+    "exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat. "
+)
+
+
+class StandinConfig:
+    """Behaviour knobs shared by the stand-ins."""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, seed: int = 0):
+        self.latency = latency          # seconds added to every request
+        self.error_rate = error_rate    # probability of an injected 5xx
+        self.seed = seed
+
+
+class _StandinServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler, standin: "Standin"):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.standin = standin
+
+    def handle_error(self, request, client_address):
+        # Clients hang up mid-response when the bot cancels a request
+        # (e.g. the typing indicator); that is expected, not an error.
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def standin(self) -> "Standin":
+        return self.server.standin
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def send_json(self, status: int, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_bytes(status, body, "application/json")
+
+    def send_bytes(self, status: int, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.standin.before_request()
+        self.standin.handle(self, "GET", b"")
+
+    def do_POST(self):
+        body = self.read_body()
+        self.standin.before_request()
+        self.standin.handle(self, "POST", body)
+
+
+class Standin:
+    """Base class: owns the server thread, latency and error injection."""
+
+    def __init__(self, config: Optional[StandinConfig] = None):
+        self.config = config or StandinConfig()
+        self.random = random.Random(self.config.seed)
+        self.requests = 0
+        self.injected_errors = 0
+        self._lock = threading.Lock()
+        self._server: Optional[_StandinServer] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "Standin":
+        self._server = _StandinServer(_Handler, self)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def before_request(self):
+        with self._lock:
+            self.requests += 1
+        if self.config.latency:
+            time.sleep(self.config.latency)
+
+    def should_fail(self) -> bool:
+        if self.config.error_rate and self.random.random() < self.config.error_rate:
+            with self._lock:
+                self.injected_errors += 1
+            return True
+        return False
+
+    def handle(self, request: _Handler, method: str, body: bytes):
+        raise NotImplementedError
+
+
+class TelegramStandin(Standin):
+    """Bot API methods used by the bot, plus file downloads.
+
+    File IDs encode their kind and size as ``<kind>-<bytes>`` (e.g.
+    ``photo-200000``) so synthetic updates control download sizes.
+    """
+
+    def __init__(self, config: Optional[StandinConfig] = None):
+        super().__init__(config)
+        self.messages_sent = 0
+        self.error_replies = 0
+        self.chat_actions = 0
+        self._message_id = 0
+        self._files: Dict[str, bytes] = {}
+        self._updates: List[Dict] = []
+        self._updates_ready = threading.Condition(self._lock)
+
+    def push_update(self, update: Dict):
+        """Queue an update for getUpdates, for bots running in polling mode."""
+        with self._updates_ready:
+            self._updates.append(update)
+            self._updates_ready.notify_all()
+
+    def file_content(self, file_id: str) -> bytes:
+        """Deterministic file body for a file ID."""
+        if file_id not in self._files:
+            kind, _, size = file_id.partition("-")
+            size = int(size or 1024)
+            if kind == "doc":
+                text = (LOREM * (size // len(LOREM) + 1))[:size]
+                self._files[file_id] = text.encode("ascii")
+            else:
+                self._files[file_id] = random.Random(file_id).randbytes(size)
+        return self._files[file_id]
+
+    def handle(self, request: _Handler, method: str, body: bytes):
+        path = urllib.parse.urlparse(request.path).path
+
+        if path.startswith("/file/bot"):
+            file_id = path.rsplit("/", 1)[-1]
+            request.send_bytes(200, self.file_content(file_id), "application/octet-stream")
+            return
+
+        api_method = path.rsplit("/", 1)[-1]
+        params = self._parse_params(request, body)
+
+        if self.should_fail():
+            request.send_json(500, {"ok": False, "error_code": 500, "description": "Injected error"})
+            return
+
+        if api_method == "getMe":
+            result = BOT_USER
+        elif api_method == "getUpdates":
+            result = self._get_updates(int(params.get("offset") or 0), float(params.get("timeout") or 0))
+        elif api_method == "sendChatAction":
+            with self._lock:
+                self.chat_actions += 1
+            result = True
+        elif api_method == "getFile":
+            file_id = params.get("file_id", "file-1024")
+            result = {
+                "file_id": file_id,
+                "file_unique_id": f"u{file_id}",
+                "file_size": len(self.file_content(file_id)),
+                "file_path": f"files/{file_id}",
+            }
+        elif api_method in ("sendMessage", "editMessageText", "sendDocument"):
+            result = self._message(params)
+        else:
+            result = True
+
+        request.send_json(200, {"ok": True, "result": result})
+
+    def _get_updates(self, offset: int, timeout: float) -> List[Dict]:
+        with self._updates_ready:
+            # Confirmed updates are dropped, as Telegram does
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            if not self._updates and timeout:
+                self._updates_ready.wait(min(timeout, 1.0))
+            return list(self._updates)
+
+    def _message(self, params: Dict) -> Dict:
+        text = str(params.get("text", ""))
+        with self._lock:
+            self._message_id += 1
+            self.messages_sent += 1
+            if text.startswith("❌"):
+                self.error_replies += 1
+            message_id = self._message_id
+        chat_id = int(params.get("chat_id", 0))
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+            "from": BOT_USER,
+            "text": text,
+        }
+
+    @staticmethod
+    def _parse_params(request: _Handler, body: bytes) -> Dict:
+        content_type = request.headers.get("Content-Type", "")
+        if not body:
+            return {}
+        if content_type.startswith("application/json"):
+            return json.loads(body)
+        if content_type.startswith("application/x-www-form-urlencoded"):
+            params = dict(urllib.parse.parse_qsl(body.decode("utf-8")))
+            # python-telegram-bot JSON-encodes non-string values
+            for key, value in params.items():
+                try:
+                    decoded = json.loads(value)
+                except ValueError:
+                    continue
+                if not isinstance(decoded, (dict, list)):
+                    params[key] = decoded
+            return params
+        return {}
+
+
+class AnthropicStandin(Standin):
+    """Messages API with streaming, Message Batches, a model list, and 529 error injection.
+
+    A batch ends ``batch_delay`` seconds after it is created; each of its
+    requests succeeds unless error injection picks it.
+    """
+
+    def __init__(self, config: Optional[StandinConfig] = None, ttft: float = 0.3,
+                 token_rate: float = 100.0, output_tokens: int = 150, batch_delay: float = 1.0):
+        super().__init__(config)
+        self.ttft = ttft                    # seconds before the first token
+        self.token_rate = token_rate        # output tokens per second after that
+        self.output_tokens = output_tokens  # tokens generated per response
+        self.batch_delay = batch_delay      # seconds until a batch ends
+        self._message_id = 0
+        self._batches: Dict[str, Dict] = {}
+
+    def handle(self, request: _Handler, method: str, body: bytes):
+        path = urllib.parse.urlparse(request.path).path
+
+        if method == "GET" and path == "/v1/models":
+            request.send_json(200, {"data": [
+                {"id": "claude-3-5-sonnet-20241022", "display_name": "Claude 3.5 Sonnet"},
+                {"id": "claude-3-haiku-20240307", "display_name": "Claude 3 Haiku"},
+            ]})
+            return
+
+        if path.startswith("/v1/messages/batches"):
+            self._handle_batches(request, method, path, body)
+            return
+
+        if path != "/v1/messages":
+            request.send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": path}})
+            return
+
+        if self.should_fail():
+            request.send_json(529, {"type": "error", "error": {"type": "overloaded_error", "message": "Injected"}})
+            return
+
+        payload = json.loads(body or b"{}")
+        model = payload.get("model", "claude-3-5-sonnet-20241022")
+        # Rough token estimate: four bytes per token
+        input_tokens = max(1, len(body) // 4)
+        tokens = self._tokens()
+        message_id = self._next_id("msg_bench")
+
+        if payload.get("stream"):
+            self._stream(request, message_id, model, input_tokens, tokens)
+            return
+
+        time.sleep(self.ttft + len(tokens) / self.token_rate)
+        request.send_json(200, {
+            "id": message_id,
+            "type": "message",
+            "role": "assistant",
+            "model": model,
+            "content": [{"type": "text", "text": "".join(tokens)}],
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": {"input_tokens": input_tokens, "output_tokens": len(tokens)},
+        })
+
+    def _tokens(self) -> List[str]:
+        words = [w + " " for w in LOREM.split()]
+        return [words[i % len(words)] for i in range(self.output_tokens)]
+
+    def _next_id(self, prefix: str) -> str:
+        with self._lock:
+            self._message_id += 1
+            return f"{prefix}_{self._message_id}"
+
+    def _handle_batches(self, request: _Handler, method: str, path: str, body: bytes):
+        parts = path.split("/")[4:]  # after /v1/messages/batches
+        if method == "POST" and not parts:
+            requests = json.loads(body or b"{}").get("requests", [])
+            batch_id = self._next_id("msgbatch_bench")
+            with self._lock:
+                self._batches[batch_id] = {"created": time.time(), "requests": requests, "canceled": None}
+            request.send_json(200, self._batch_info(batch_id))
+            return
+
+        batch_id = parts[0] if parts else ""
+        if batch_id not in self._batches:
+            request.send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": path}})
+            return
+        batch = self._batches[batch_id]
+
+        if method == "POST" and parts[1:] == ["cancel"]:
+            with self._lock:
+                if batch["canceled"] is None and self._batch_ended_at(batch) > time.time():
+                    batch["canceled"] = time.time()
+            request.send_json(200, self._batch_info(batch_id))
+        elif method == "GET" and parts[1:] == ["results"]:
+            if self._batch_ended_at(batch) > time.time():
+                request.send_json(400, {"type": "error", "error": {
+                    "type": "invalid_request_error", "message": "Batch is still processing"}})
+                return
+            lines = [json.dumps({"custom_id": item["custom_id"], "result": result})
+                     for item, result in zip(batch["requests"], batch["results"])]
+            request.send_bytes(200, "\n".join(lines).encode("utf-8"), "application/binary")
+        elif method == "GET" and not parts[1:]:
+            request.send_json(200, self._batch_info(batch_id))
+        else:
+            request.send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": path}})
+
+    def _batch_ended_at(self, batch: Dict) -> float:
+        if batch["canceled"] is not None:
+            return batch["canceled"]
+        return batch["created"] + self.batch_delay
+
+    def _batch_info(self, batch_id: str) -> Dict:
+        batch = self._batches[batch_id]
+        ended_at = self._batch_ended_at(batch)
+        ended = ended_at <= time.time()
+        with self._lock:
+            if ended and "results" not in batch:
+                batch["results"] = [self._batch_result(batch_id, i, item, batch["canceled"] is not None)
+                                    for i, item in enumerate(batch["requests"])]
+        counts = {"processing": 0, "succeeded": 0, "errored": 0, "canceled": 0, "expired": 0}
+        if ended:
+            for result in batch["results"]:
+                counts[result["type"]] += 1
+        else:
+            counts["processing"] = len(batch["requests"])
+
+        def timestamp(value: Optional[float]) -> Optional[str]:
+            if value is None:
+                return None
+            return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(value))
+
+        return {
+            "id": batch_id,
+            "type": "message_batch",
+            "processing_status": "ended" if ended else ("canceling" if batch["canceled"] else "in_progress"),
+            "request_counts": counts,
+            "created_at": timestamp(batch["created"]),
+            "expires_at": timestamp(batch["created"] + 86400),
+            "ended_at": timestamp(ended_at) if ended else None,
+            "cancel_initiated_at": timestamp(batch["canceled"]),
+            "archived_at": None,
+            "results_url": f"{self.url}/v1/messages/batches/{batch_id}/results" if ended else None,
+        }
+
+    def _batch_result(self, batch_id: str, index: int, item: Dict, canceled: bool) -> Dict:
+        if canceled:
+            return {"type": "canceled"}
+        if self.config.error_rate and self.random.random() < self.config.error_rate:
+            self.injected_errors += 1
+            return {"type": "errored", "error": {"type": "error", "error": {
+                "type": "overloaded_error", "message": "Injected"}}}
+        params = item.get("params", {})
+        tokens = self._tokens()
+        return {"type": "succeeded", "message": {
+            "id": f"msg_{batch_id}_{index}",
+            "type": "message",
+            "role": "assistant",
+            "model": params.get("model", "claude-3-5-sonnet-20241022"),
+            "content": [{"type": "text", "text": "".join(tokens)}],
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": {"input_tokens": max(1, len(json.dumps(params)) // 4), "output_tokens": len(tokens)},
+        }}
+
+    def _stream(self, request: _Handler, message_id: str, model: str, input_tokens: int, tokens):
+        request.send_response(200)
+        request.send_header("Content-Type", "text/event-stream")
+        request.send_header("Connection", "close")
+        request.end_headers()
+        request.close_connection = True
+
+        def event(name: str, data: Dict):
+            request.wfile.write(f"event: {name}\ndata: {json.dumps(data)}\n\n".encode("utf-8"))
+            request.wfile.flush()
+
+        event("message_start", {"type": "message_start", "message": {
+            "id": message_id, "type": "message", "role": "assistant", "model": model,
+            "content": [], "stop_reason": None, "stop_sequence": None,
+            "usage": {"input_tokens": input_tokens, "output_tokens": 1},
+        }})
+        event("content_block_start", {"type": "content_block_start", "index": 0,
+                                      "content_block": {"type": "text", "text": ""}})
+        time.sleep(self.ttft)
+
+        # Emit deltas in ~20ms batches to keep the stand-in cheap
+        batch = max(1, int(self.token_rate * 0.02))
+        for i in range(0, len(tokens), batch):
+            chunk = "".join(tokens[i:i + batch])
+            event("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                          "delta": {"type": "text_delta", "text": chunk}})
+            time.sleep(len(tokens[i:i + batch]) / self.token_rate)
+
+        event("content_block_stop", {"type": "content_block_stop", "index": 0})
+        event("message_delta", {"type": "message_delta",
+                                "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                "usage": {"output_tokens": len(tokens)}})
+        event("message_stop", {"type": "message_stop"})
+
+
+class WhisperStandin(Standin):
+    """POST /transcribe returning a fixed transcription."""
+
+    def __init__(self, config: Optional[StandinConfig] = None, text: str = "Привет, это тестовое голосовое сообщение"):
+        super().__init__(config)
+        self.text = text
+
+    def handle(self, request: _Handler, method: str, body: bytes):
+        if self.should_fail():
+            request.send_json(500, {"detail": "Injected error"})
+            return
+        request.send_json(200, {"text": self.text})
@@ -1,9 +1,7 @@
 """Main Telegram bot implementation with Claude AI integration."""
+import argparse
 import logging
-import io
-import asyncio
-import re
-import httpx
+from typing import List, Optional
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
@@ -13,10 +11,22 @@ from telegram.ext import (
     filters,
     ContextTypes
 )
-from telegram.constants import ParseMode, ChatAction
+from telegram.constants import ParseMode
+from telegram.request import BaseRequest
 import config
-from database import Database
-from claude_client import ClaudeClient
+import documents
+import loop_monitor
+import metrics
+import recorder
+import tracing
+from app_context import AppContext, BOT_DATA_KEY, create_app_context, get_app
+from pipeline import (
+    TextModality,
+    PhotoModality,
+    VoiceModality,
+    DocumentModality,
+)
+from update_processor import ChatUpdateProcessor
 
 # Configure logging
 logging.basicConfig(
@@ -25,144 +35,16 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Initialize database and Claude client
-db = Database()
-claude = ClaudeClient()
-
-
-def get_active_model() -> str:
-    """Get the currently active Claude model from settings, falling back to config default."""
-    return db.get_setting('active_model') or config.CLAUDE_MODEL
-
-
-def build_system_prompt(active_model: str, custom_prompt: str | None) -> str:
-    """Build effective system prompt: base instructions + optional admin-set prompt.
-
-    Base always tells Claude its model identity and to answer only the latest message.
-    """
-    base = (
-        f"Ты работаешь как модель {active_model} от Anthropic. "
-        "Отвечай только на последнее сообщение пользователя — "
-        "не пересказывай и не отвечай повторно на предыдущие сообщения из истории переписки."
-    )
-    if custom_prompt:
-        return f"{base}\n\n{custom_prompt}"
-    return base
-
-# Telegram message length limit
-MAX_MESSAGE_LENGTH = 4096
-
-
-def is_bot_mentioned(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    """Check if bot is mentioned in a group message (via @ or reply)."""
-    # Always respond in private chats
-    if update.effective_chat.type == 'private':
-        return True
-
-    message = update.message
-    if not message:
-        return False
-
-    # Check if message is a reply to bot's message
-    if message.reply_to_message and message.reply_to_message.from_user.id == context.bot.id:
-        return True
-
-    # Check if bot is mentioned in message text
-    if message.entities and message.text:
-        for entity in message.entities:
-            if entity.type in ('mention', 'text_mention'):
-                if entity.type == 'mention':
-                    mention_text = message.text[entity.offset:entity.offset + entity.length]
-                    bot_username = context.bot.username
-                    if mention_text == f'@{bot_username}' or mention_text.lower() == f'@{bot_username.lower()}':
-                        return True
-                elif entity.type == 'text_mention' and entity.user.id == context.bot.id:
-                    return True
-
-    # Check if bot is mentioned in caption (for photos)
-    if message.caption and message.caption_entities:
-        for entity in message.caption_entities:
-            if entity.type in ('mention', 'text_mention'):
-                if entity.type == 'mention':
-                    mention_text = message.caption[entity.offset:entity.offset + entity.length]
-                    bot_username = context.bot.username
-                    if mention_text == f'@{bot_username}' or mention_text.lower() == f'@{bot_username.lower()}':
-                        return True
-                elif entity.type == 'text_mention' and entity.user.id == context.bot.id:
-                    return True
-
-    return False
-
-
-def split_message(text: str, max_length: int = MAX_MESSAGE_LENGTH) -> list[str]:
-    """Split long message into chunks that fit Telegram's limit."""
-    if len(text) <= max_length:
-        return [text]
-
-    chunks = []
-    current_chunk = ""
-
-    # Split by paragraphs first
-    paragraphs = text.split('\n\n')
-
-    for paragraph in paragraphs:
-        # If single paragraph is too long, split by sentences
-        if len(paragraph) > max_length:
-            sentences = paragraph.split('. ')
-            for sentence in sentences:
-                if len(current_chunk) + len(sentence) + 2 < max_length:
-                    current_chunk += sentence + '. '
-                else:
-                    if current_chunk:
-                        chunks.append(current_chunk.strip())
-                    current_chunk = sentence + '. '
-        else:
-            # Try to add paragraph to current chunk
-            if len(current_chunk) + len(paragraph) + 2 < max_length:
-                current_chunk += paragraph + '\n\n'
-            else:
-                if current_chunk:
-                    chunks.append(current_chunk.strip())
-                current_chunk = paragraph + '\n\n'
-
-    # Add remaining text
-    if current_chunk:
-        chunks.append(current_chunk.strip())
-
-    return chunks if chunks else [text[:max_length]]
-
-
-async def keep_typing(chat, stop_event: asyncio.Event):
-    """Keep sending typing action every 5 seconds until stopped."""
-    try:
-        while not stop_event.is_set():
-            await chat.send_action(ChatAction.TYPING)
-            await asyncio.sleep(5)
-    except asyncio.CancelledError:
-        pass
-    except Exception as e:
-        logger.warning(f"Error sending typing action: {e}")
-
-
-def convert_markdown_to_html(text: str) -> str:
-    """Convert Markdown formatting to Telegram HTML."""
-    # Code blocks ``` (process first to avoid affecting ** inside)
-    text = re.sub(r'```(.*?)```', r'<pre>\1</pre>', text, flags=re.DOTALL)
-
-    # Inline code `
-    text = re.sub(r'`([^`]+)`', r'<code>\1</code>', text)
-
-    # Bold text **
-    text = re.sub(r'\*\*([^\*]+)\*\*', r'<b>\1</b>', text)
-
-    # Italic * (single asterisks, but not inside words)
-    text = re.sub(r'(?<!\*)\*(?!\*)([^\*]+)\*(?!\*)', r'<i>\1</i>', text)
-
-    return text
+# Modality hooks plugged into the shared pipeline
+TEXT = TextModality()
+PHOTO = PhotoModality()
+VOICE = VoiceModality()
+DOCUMENT = DocumentModality()
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command."""
+    db = get_app(context).db
     user = update.effective_user
     db.add_user(user.id, user.username, user.first_name, user.last_name)
 
@@ -182,7 +64,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Я бот с интеграцией Claude AI. Вы можете:\n"
         "• Задавать любые вопросы\n"
         "• Отправлять картинки для анализа\n"
-        "• Отправлять текстовые файлы"
+        "• Отправлять документы (текст и код, PDF, DOCX, HTML, CSV)"
         f"{voice_line}\n\n"
         "Команды:\n"
         "/clear - Очистить историю разговора\n"
@@ -194,6 +76,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /help command."""
+    app = get_app(context)
+    db = app.db
     user_id = update.effective_user.id
 
     if not db.is_authorized(user_id):
@@ -206,16 +90,25 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/start - Начать работу с ботом\n"
         "/help - Показать эту справку\n"
         "/clear - Очистить историю разговора\n"
-        "/stats - Показать статистику использования\n\n"
+        "/stats - Показать статистику использования\n"
+        "/search &lt;слова&gt; - Поиск по истории этого чата\n"
+        "/export [history|usage] [jsonl|csv] - Выгрузить историю или расход токенов файлом\n"
+        + ("/batch &lt;задание&gt; - Пакетная обработка текстов и файлов в фоне (вдвое дешевле)\n"
+           "/batchrun, /batchcancel, /batches - Запуск, отмена и список пакетов\n" if app.batches else "")
+        + "\n"
         "<b>Возможности:</b>\n"
         "• Отправьте текстовое сообщение - получите ответ от Claude\n"
-        "• Отправьте картинку с подписью - Claude проанализирует её\n"
-        "• Отправьте текстовый файл - Claude прочитает и ответит\n"
+        "• Отправьте картинку с подписью - Claude проанализирует её; "
+        "альбом из нескольких фото разбирается одним ответом\n"
+        "• Отправьте документ (текст, код, PDF, DOCX, HTML, CSV) - Claude прочитает и ответит\n"
         + ("• Отправьте голосовое сообщение - будет распознано и отправлено Claude\n" if config.WHISPER_URL else "")
         + "\n"
         "<b>Особенности:</b>\n"
         "• Бот помнит контекст разговора\n"
-        "• Используется модель: " + config.CLAUDE_MODEL
+        + ("• На простые вопросы отвечает быстрая модель; начните сообщение с !smart, "
+           "чтобы ответила основная, или с !fast — чтобы быстрая (в голосовом — скажите в начале "
+           "«умно» или «быстро» и сделайте паузу)\n" if config.ROUTER_LIGHT_MODEL else "")
+        + "• Используется модель: " + config.CLAUDE_MODEL
     )
 
     if db.is_admin(user_id):
@@ -226,8 +119,11 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "/deauthorize &lt;user_id&gt; - Удалить пользователя\n"
             "/users - Список всех пользователей\n"
             "/totalstats - Общая статистика\n"
+            "/export ... all|&lt;user_id&gt; - Выгрузка всех пользователей или одного\n"
             "/setprompt &lt;текст&gt; - Установить системный промпт\n"
-            "/showprompt - Показать текущий промпт"
+            "/showprompt - Показать текущий промпт\n"
+            "/routing - Правила выбора модели по сложности запроса\n"
+            "/limits - Лимиты токенов для пользователей и чатов"
         )
 
     await update.message.reply_text(help_text, parse_mode=ParseMode.HTML)
@@ -235,6 +131,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def clear_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /clear command to clear conversation history."""
+    app = get_app(context)
+    db = app.db
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
 
@@ -242,12 +140,15 @@ async def clear_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ У вас нет доступа к боту.")
         return
 
+    if app.summarizer:
+        app.summarizer.forget(user_id, chat_id)
     db.clear_conversation_history(user_id, chat_id)
     await update.message.reply_text("🗑️ История разговора очищена в этом чате.")
 
 
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /stats command to show user statistics."""
+    db = get_app(context).db
     user_id = update.effective_user.id
 
     if not db.is_authorized(user_id):
@@ -269,196 +170,26 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle text messages."""
-    user_id = update.effective_user.id
-
-    # In groups, only respond if bot is mentioned
-    if not is_bot_mentioned(update, context):
-        return
-
-    if not db.is_authorized(user_id):
-        await update.message.reply_text(
-            "❌ У вас нет доступа к боту.\n"
-            f"Ваш ID: <code>{user_id}</code>\n"
-            "Отправьте этот ID администратору.",
-            parse_mode=ParseMode.HTML
-        )
-        return
-
-    # Update last active
-    user = update.effective_user
-    db.add_user(user.id, user.username, user.first_name, user.last_name, is_authorized=True)
-
-    # Send typing status immediately
-    await update.message.chat.send_action(ChatAction.TYPING)
-
-    # Start continuous typing indicator
-    stop_typing = asyncio.Event()
-    typing_task = asyncio.create_task(keep_typing(update.message.chat, stop_typing))
-
-    try:
-        chat_id = update.effective_chat.id
-
-        # Get conversation history for this specific chat
-        history = db.get_conversation_history(user_id, chat_id, limit=10)
-
-        # Add current message
-        user_message = update.message.text
-        history.append({"role": "user", "content": user_message})
-
-        # Build effective system prompt
-        active_model = get_active_model()
-        system_prompt = build_system_prompt(active_model, db.get_setting('system_prompt'))
-
-        # Send to Claude with system prompt
-        response_text, input_tokens, output_tokens = claude.send_message(history, system_prompt, model=active_model)
-
-        # Convert Markdown to HTML formatting
-        response_text = convert_markdown_to_html(response_text)
-
-        # Save to database with chat_id
-        db.add_message_to_history(user_id, chat_id, "user", user_message)
-        db.add_message_to_history(user_id, chat_id, "assistant", response_text)
-
-        # Log usage
-        cost = db.log_usage(user_id, active_model, input_tokens, output_tokens)
-
-        # Send response - split if too long, try with HTML, fallback to plain text
-        message_chunks = split_message(response_text)
-
-        for i, chunk in enumerate(message_chunks):
-            # Small delay between chunks to look more natural
-            if i > 0:
-                await asyncio.sleep(0.5)
-
-            try:
-                await update.message.reply_text(chunk, parse_mode=ParseMode.HTML)
-            except Exception as parse_error:
-                # HTML parsing or length error, send as plain text
-                logger.warning(f"Message send error for user {user_id}: {parse_error}")
-                try:
-                    await update.message.reply_text(chunk)
-                except Exception as e:
-                    # If still fails, truncate
-                    logger.error(f"Failed to send chunk {i+1}: {e}")
-                    await update.message.reply_text(chunk[:MAX_MESSAGE_LENGTH])
-
-        # Stop typing indicator after all messages sent
-        stop_typing.set()
-        typing_task.cancel()
-        try:
-            await typing_task
-        except asyncio.CancelledError:
-            pass
-
-        # Log for admin
-        logger.info(f"User {user_id} - Tokens: {input_tokens}+{output_tokens}, Cost: ${cost:.4f}")
-
-    except Exception as e:
-        logger.error(f"Error handling message: {e}")
-        # Stop typing on error
-        stop_typing.set()
-        typing_task.cancel()
-        await update.message.reply_text(
-            f"❌ Произошла ошибка при обработке сообщения:\n{str(e)}"
-        )
+    await get_app(context).pipeline.run(update, context, TEXT)
 
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle photo messages."""
-    user_id = update.effective_user.id
-
-    # In groups, only respond if bot is mentioned
-    if not is_bot_mentioned(update, context):
+    """Handle photo messages; photos of an album are collected and answered together."""
+    app = get_app(context)
+    if app.media_groups.accepts(update):
+        # The album's first photo waits for the rest, holding the chat's turn
+        updates = await app.media_groups.collect(update)
+        if updates:
+            await handle_album(updates, context)
         return
 
-    if not db.is_authorized(user_id):
-        await update.message.reply_text("❌ У вас нет доступа к боту.")
-        return
-
-    # Update last active
-    user = update.effective_user
-    db.add_user(user.id, user.username, user.first_name, user.last_name, is_authorized=True)
-
-    # Send typing status immediately
-    await update.message.chat.send_action(ChatAction.TYPING)
-
-    # Start continuous typing indicator
-    stop_typing = asyncio.Event()
-    typing_task = asyncio.create_task(keep_typing(update.message.chat, stop_typing))
-
-    try:
-        # Get the largest photo
-        photo = update.message.photo[-1]
-        photo_file = await photo.get_file()
+    await app.pipeline.run(update, context, PHOTO)
 
-        # Download photo
-        photo_bytes = await photo_file.download_as_bytearray()
 
-        chat_id = update.effective_chat.id
-
-        # Get caption or default question
-        caption = update.message.caption or "Что изображено на этой картинке?"
-
-        # Get conversation history for this specific chat
-        history = db.get_conversation_history(user_id, chat_id, limit=10)
-        history.append({"role": "user", "content": caption})
-
-        # Build effective system prompt
-        active_model = get_active_model()
-        system_prompt = build_system_prompt(active_model, db.get_setting('system_prompt'))
-
-        # Send to Claude with image and system prompt
-        response_text, input_tokens, output_tokens = claude.send_message_with_image(
-            history, bytes(photo_bytes), "jpeg", system_prompt, model=active_model
-        )
-
-        # Convert Markdown to HTML formatting
-        response_text = convert_markdown_to_html(response_text)
-
-        # Save to database with chat_id
-        db.add_message_to_history(user_id, chat_id, "user", f"[Image] {caption}")
-        db.add_message_to_history(user_id, chat_id, "assistant", response_text)
-
-        # Log usage
-        cost = db.log_usage(user_id, active_model, input_tokens, output_tokens)
-
-        # Send response - split if too long, try with HTML, fallback to plain text
-        message_chunks = split_message(response_text)
-
-        for i, chunk in enumerate(message_chunks):
-            # Small delay between chunks to look more natural
-            if i > 0:
-                await asyncio.sleep(0.5)
-
-            try:
-                await update.message.reply_text(chunk, parse_mode=ParseMode.HTML)
-            except Exception as parse_error:
-                # HTML parsing or length error, send as plain text
-                logger.warning(f"Message send error for user {user_id} (image): {parse_error}")
-                try:
-                    await update.message.reply_text(chunk)
-                except Exception as e:
-                    logger.error(f"Failed to send chunk {i+1}: {e}")
-                    await update.message.reply_text(chunk[:MAX_MESSAGE_LENGTH])
-
-        # Stop typing indicator after all messages sent
-        stop_typing.set()
-        typing_task.cancel()
-        try:
-            await typing_task
-        except asyncio.CancelledError:
-            pass
-
-        logger.info(f"User {user_id} - Image - Tokens: {input_tokens}+{output_tokens}, Cost: ${cost:.4f}")
-
-    except Exception as e:
-        logger.error(f"Error handling photo: {e}")
-        # Stop typing on error
-        stop_typing.set()
-        typing_task.cancel()
-        await update.message.reply_text(
-            f"❌ Произошла ошибка при обработке изображения:\n{str(e)}"
-        )
+async def handle_album(updates: List[Update], context: ContextTypes.DEFAULT_TYPE):
+    """Answer a collected media group as one request, addressed to the captioned photo."""
+    main = next((u for u in updates if u.message.caption), updates[0])
+    await get_app(context).pipeline.run(main, context, PHOTO, group=updates)
 
 
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -466,228 +197,128 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not config.WHISPER_URL:
         return
 
-    user_id = update.effective_user.id
-
-    # In groups, only respond if bot is mentioned
-    if not is_bot_mentioned(update, context):
-        return
+    await get_app(context).pipeline.run(update, context, VOICE)
 
-    if not db.is_authorized(user_id):
-        await update.message.reply_text(
-            "❌ У вас нет доступа к боту.\n"
-            f"Ваш ID: <code>{user_id}</code>\n"
-            "Отправьте этот ID администратору.",
-            parse_mode=ParseMode.HTML
-        )
-        return
 
-    # Send typing status immediately
-    await update.message.chat.send_action(ChatAction.TYPING)
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle document messages."""
+    await get_app(context).pipeline.run(update, context, DOCUMENT)
 
-    # Start continuous typing indicator
-    stop_typing = asyncio.Event()
-    typing_task = asyncio.create_task(keep_typing(update.message.chat, stop_typing))
 
-    try:
-        voice = update.message.voice or update.message.audio
-        file = await context.bot.get_file(voice.file_id)
-        ogg_bytes = await file.download_as_bytearray()
-
-        # Send to Whisper for transcription
-        async with httpx.AsyncClient() as client:
-            r = await client.post(
-                f"{config.WHISPER_URL}/transcribe",
-                files={"file": ("voice.ogg", bytes(ogg_bytes), "audio/ogg")},
-                timeout=60,
-            )
-        r.raise_for_status()
-        transcribed_text = r.json()["text"].strip()
-
-        if not transcribed_text:
-            stop_typing.set()
-            typing_task.cancel()
-            await update.message.reply_text("❌ Не удалось распознать речь.")
-            return
-
-        logger.info(f"User {user_id} - Voice transcribed: {transcribed_text[:100]}")
-
-        # Process transcribed text through Claude as a regular message
-        user_id = update.effective_user.id
-        user = update.effective_user
-        db.add_user(user.id, user.username, user.first_name, user.last_name, is_authorized=True)
-
-        chat_id = update.effective_chat.id
-        history = db.get_conversation_history(user_id, chat_id, limit=10)
-
-        user_message = f"[Голосовое сообщение]: {transcribed_text}"
-        history.append({"role": "user", "content": user_message})
-
-        active_model = get_active_model()
-        system_prompt = build_system_prompt(active_model, db.get_setting('system_prompt'))
-        response_text, input_tokens, output_tokens = claude.send_message(history, system_prompt, model=active_model)
-        response_text = convert_markdown_to_html(response_text)
-
-        db.add_message_to_history(user_id, chat_id, "user", user_message)
-        db.add_message_to_history(user_id, chat_id, "assistant", response_text)
-        cost = db.log_usage(user_id, active_model, input_tokens, output_tokens)
-
-        # Send transcription note + response
-        await update.message.reply_text(
-            f"🎤 <i>{transcribed_text}</i>",
-            parse_mode=ParseMode.HTML
+def application_builder():
+    """Application builder with the bot token and Bot API server applied."""
+    builder = Application.builder().token(config.TELEGRAM_BOT_TOKEN)
+    if config.TELEGRAM_API_URL:
+        builder = builder.base_url(f"{config.TELEGRAM_API_URL}/bot").base_file_url(
+            f"{config.TELEGRAM_API_URL}/file/bot"
         )
+    return builder
 
-        message_chunks = split_message(response_text)
-        for i, chunk in enumerate(message_chunks):
-            if i > 0:
-                await asyncio.sleep(0.5)
-            try:
-                await update.message.reply_text(chunk, parse_mode=ParseMode.HTML)
-            except Exception as parse_error:
-                logger.warning(f"Message send error for user {user_id} (voice): {parse_error}")
-                try:
-                    await update.message.reply_text(chunk)
-                except Exception as e:
-                    logger.error(f"Failed to send chunk {i+1}: {e}")
-                    await update.message.reply_text(chunk[:MAX_MESSAGE_LENGTH])
-
-        stop_typing.set()
-        typing_task.cancel()
-        try:
-            await typing_task
-        except asyncio.CancelledError:
-            pass
-
-        logger.info(f"User {user_id} - Voice - Tokens: {input_tokens}+{output_tokens}, Cost: ${cost:.4f}")
-
-    except httpx.HTTPError as e:
-        logger.error(f"Whisper API error: {e}")
-        stop_typing.set()
-        typing_task.cancel()
-        await update.message.reply_text("❌ Ошибка связи с Whisper сервером.")
-    except Exception as e:
-        logger.error(f"Error handling voice: {e}")
-        stop_typing.set()
-        typing_task.cancel()
-        await update.message.reply_text(
-            f"❌ Произошла ошибка при обработке голосового сообщения:\n{str(e)}"
-        )
 
+async def start_background_tasks(application: Application, poll_batches: bool = True):
+    """Start background work: the event loop monitor and the batch results poller."""
+    await loop_monitor.start()
+    batches = application.bot_data[BOT_DATA_KEY].batches
+    if batches and poll_batches:
+        batches.start(application.bot)
 
-async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle document messages."""
-    user_id = update.effective_user.id
 
-    if not db.is_authorized(user_id):
-        await update.message.reply_text("❌ У вас нет доступа к боту.")
-        return
+async def stop_background_tasks(application: Application):
+    batches = application.bot_data[BOT_DATA_KEY].batches
+    if batches:
+        await batches.stop()
+    await documents.shutdown()
+    await loop_monitor.stop()
 
-    # Update last active
-    user = update.effective_user
-    db.add_user(user.id, user.username, user.first_name, user.last_name, is_authorized=True)
 
-    # Send typing status immediately
-    await update.message.chat.send_action(ChatAction.TYPING)
+def build_application(app: AppContext, request: Optional[BaseRequest] = None) -> Application:
+    """Create the Telegram application around a shared AppContext and register all handlers.
 
-    # Start continuous typing indicator
-    stop_typing = asyncio.Event()
-    typing_task = asyncio.create_task(keep_typing(update.message.chat, stop_typing))
+    A custom request is used by worker processes, which do not poll.
+    Updates of different chats are processed concurrently, each chat's in order.
+    """
+    builder = application_builder().concurrent_updates(
+        ChatUpdateProcessor(config.CONCURRENT_UPDATES, media_groups=app.media_groups)
+    )
+    if request is not None:
+        builder = builder.request(request).updater(None)
+    else:
+        builder = builder.post_init(start_background_tasks).post_stop(stop_background_tasks)
+    application = builder.build()
+    application.bot_data[BOT_DATA_KEY] = app
 
-    document = update.message.document
+    # Add handlers
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("clear", clear_history))
+    application.add_handler(CommandHandler("stats", stats))
 
-    # Check if it's a text file
-    if not document.mime_type or not document.mime_type.startswith('text/'):
-        await update.message.reply_text(
-            "❌ Поддерживаются только текстовые файлы.\n"
-            "Поддерживаемые форматы: .txt, .py, .js, .json, .md, и т.д."
-        )
-        return
+    # Import admin handlers
+    from admin import register_admin_handlers
+    register_admin_handlers(application)
 
-    # Check file size (max 1MB)
-    if document.file_size > 1_000_000:
-        await update.message.reply_text("❌ Файл слишком большой. Максимум: 1 МБ")
-        return
+    from search import register_search_handlers
+    register_search_handlers(application)
 
-    try:
-        # Download document
-        doc_file = await document.get_file()
-        doc_bytes = await doc_file.download_as_bytearray()
+    from export import register_export_handlers
+    register_export_handlers(application)
 
-        # Decode text
-        try:
-            doc_text = bytes(doc_bytes).decode('utf-8')
-        except UnicodeDecodeError:
-            doc_text = bytes(doc_bytes).decode('latin-1')
+    # Batch commands, and batch items collected ahead of the regular handlers
+    if app.batches:
+        app.batches.register_handlers(application)
 
-        chat_id = update.effective_chat.id
+    # Message handlers
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+    application.add_handler(MessageHandler(filters.Document.ALL, handle_document))
+    application.add_handler(MessageHandler(filters.VOICE | filters.AUDIO, handle_voice))
 
-        # Get caption or default question
-        caption = update.message.caption or "Проанализируй этот документ"
+    return application
 
-        # Get conversation history for this specific chat
-        history = db.get_conversation_history(user_id, chat_id, limit=5)
-        history.append({"role": "user", "content": caption})
 
-        # Build effective system prompt
-        active_model = get_active_model()
-        system_prompt = build_system_prompt(active_model, db.get_setting('system_prompt'))
+def enable_observability(application: Application, worker: Optional[int] = None):
+    """Start the optional metrics endpoint, tracing and traffic recording.
 
-        # Send to Claude with document and system prompt
-        response_text, input_tokens, output_tokens = claude.send_message_with_document(
-            history, doc_text, system_prompt, model=active_model
+    Worker processes serve metrics on METRICS_PORT + 1 + worker and write
+    traces and recordings to their own files.
+    """
+    suffix = f".worker{worker}" if worker is not None else ""
+
+    # Optional Prometheus metrics endpoint
+    if config.METRICS_PORT:
+        if worker is None:
+            metrics.QUEUE_DEPTH.set_function(application.update_queue.qsize, queue="updates")
+        port = config.METRICS_PORT + (worker + 1 if worker is not None else 0)
+        metrics.start_server(config.METRICS_HOST, port)
+
+    # Optional per-update tracing
+    if config.TRACE_FILE:
+        tracing.configure(
+            config.TRACE_FILE + suffix,
+            sample_rate=config.TRACE_SAMPLE_RATE,
+            slow_ms=config.TRACE_SLOW_MS,
+            max_bytes=config.TRACE_MAX_BYTES,
+            backup_count=config.TRACE_BACKUP_COUNT,
         )
 
-        # Convert Markdown to HTML formatting
-        response_text = convert_markdown_to_html(response_text)
-
-        # Save to database with chat_id
-        db.add_message_to_history(user_id, chat_id, "user", f"[Document: {document.file_name}] {caption}")
-        db.add_message_to_history(user_id, chat_id, "assistant", response_text)
-
-        # Log usage
-        cost = db.log_usage(user_id, active_model, input_tokens, output_tokens)
-
-        # Send response - split if too long, try with HTML, fallback to plain text
-        message_chunks = split_message(response_text)
-
-        for i, chunk in enumerate(message_chunks):
-            # Small delay between chunks to look more natural
-            if i > 0:
-                await asyncio.sleep(0.5)
-
-            try:
-                await update.message.reply_text(chunk, parse_mode=ParseMode.HTML)
-            except Exception as parse_error:
-                # HTML parsing or length error, send as plain text
-                logger.warning(f"Message send error for user {user_id} (document): {parse_error}")
-                try:
-                    await update.message.reply_text(chunk)
-                except Exception as e:
-                    logger.error(f"Failed to send chunk {i+1}: {e}")
-                    await update.message.reply_text(chunk[:MAX_MESSAGE_LENGTH])
-
-        # Stop typing indicator after all messages sent
-        stop_typing.set()
-        typing_task.cancel()
-        try:
-            await typing_task
-        except asyncio.CancelledError:
-            pass
-
-        logger.info(f"User {user_id} - Document - Tokens: {input_tokens}+{output_tokens}, Cost: ${cost:.4f}")
-
-    except Exception as e:
-        logger.error(f"Error handling document: {e}")
-        # Stop typing on error
-        stop_typing.set()
-        typing_task.cancel()
-        await update.message.reply_text(
-            f"❌ Произошла ошибка при обработке документа:\n{str(e)}"
-        )
+    # Optional anonymized traffic recording
+    if config.RECORD_FILE:
+        recorder.configure(config.RECORD_FILE + suffix, salt=config.RECORD_SALT)
+
+
+def disable_observability():
+    """Flush traces and recordings."""
+    tracing.shutdown()
+    recorder.shutdown()
 
 
 def main():
     """Start the bot."""
+    parser = argparse.ArgumentParser(description="Telegram bot with Claude AI")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="report import and init time per module, then exit")
+    args = parser.parse_args()
+
     # Validate configuration
     try:
         config.validate_config()
@@ -695,28 +326,30 @@ def main():
         logger.error(f"Configuration error: {e}")
         return
 
-    # Create application
-    application = Application.builder().token(config.TELEGRAM_BOT_TOKEN).build()
-
-    # Add handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("clear", clear_history))
-    application.add_handler(CommandHandler("stats", stats))
+    if args.profile_startup:
+        from startup_profile import report
+        report()
+        return
 
-    # Import admin handlers
-    from admin import register_admin_handlers
-    register_admin_handlers(application)
+    # Workers open their own storage and clients; the ingress process only polls
+    app = None
+    if config.WORKERS > 0:
+        from workers import build_ingress_application
+        application = build_ingress_application(application_builder(), config.WORKERS)
+    else:
+        app = create_app_context()
+        application = build_application(app)
 
-    # Message handlers
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-    application.add_handler(MessageHandler(filters.Document.ALL, handle_document))
-    application.add_handler(MessageHandler(filters.VOICE | filters.AUDIO, handle_voice))
+    enable_observability(application)
 
     # Start bot
     logger.info("Bot started successfully")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    try:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+    finally:
+        if app:
+            app.close()
+        disable_observability()
 
 
 if __name__ == '__main__':
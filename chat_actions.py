@@ -0,0 +1,87 @@
+"""One "typing…" indicator loop for all busy chats.
+
+Telegram shows a chat action for about five seconds, so it has to be
+repeated while a reply is being generated. Instead of a task per request,
+requests mark their chat busy (reference counted) and a single task
+repeats the action for every busy chat at most once per interval. Two
+requests in the same group share one indicator, and the task exits as
+soon as no chat is busy.
+"""
+import asyncio
+import logging
+from typing import Dict, Optional
+
+from telegram.constants import ChatAction
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Seconds between repeated typing actions in a busy chat
+TYPING_INTERVAL = 5.0
+
+
+class _BusyChat:
+    __slots__ = ("bot", "count", "next_due")
+
+    def __init__(self, bot, next_due: float):
+        self.bot = bot
+        self.count = 1
+        self.next_due = next_due
+
+
+class TypingIndicator:
+    """Reference-counted set of busy chats with one shared refresh task."""
+
+    def __init__(self, interval: float = TYPING_INTERVAL):
+        self.interval = interval
+        self._chats: Dict[int, _BusyChat] = {}
+        self._task: Optional[asyncio.Task] = None
+        metrics.BUSY_CHATS.set_function(lambda: len(self._chats))
+
+    async def acquire(self, bot, chat_id: int):
+        """Mark the chat busy; the first request in a chat sends the action right away."""
+        chat = self._chats.get(chat_id)
+        if chat:
+            chat.count += 1
+            return
+
+        loop = asyncio.get_running_loop()
+        self._chats[chat_id] = _BusyChat(bot, loop.time() + self.interval)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="typing-indicator")
+        await self._send(bot, chat_id)
+
+    def release(self, chat_id: int):
+        """Drop one reference to the chat; stop the task when no chat is busy."""
+        chat = self._chats.get(chat_id)
+        if not chat:
+            return
+        chat.count -= 1
+        if chat.count <= 0:
+            del self._chats[chat_id]
+        if not self._chats and self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while self._chats:
+            delay = min(chat.next_due for chat in self._chats.values()) - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            now = loop.time()
+            due = []
+            for chat_id, chat in self._chats.items():
+                if chat.next_due <= now:
+                    chat.next_due = now + self.interval
+                    due.append(self._send(chat.bot, chat_id))
+            await asyncio.gather(*due)
+
+    async def _send(self, bot, chat_id: int):
+        try:
+            with metrics.DEPENDENCY_LATENCY.time(dependency="telegram_action"):
+                await bot.send_chat_action(chat_id, ChatAction.TYPING)
+        except Exception as e:
+            logger.warning(f"Error sending typing action to chat {chat_id}: {e}")
@@ -1,19 +1,73 @@
 """Claude API client for handling AI conversations."""
 import anthropic
-import base64
+import time
 import httpx
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Sequence
 import config
+import media
+import metrics
+import tracing
+
+
+class _StreamingBodyClient(anthropic.DefaultHttpxClient):
+    """SDK HTTP client that sends request bodies through media.json_body.
+
+    Images placed with media.inline_base64 are base64-encoded while the
+    body is sent instead of being built into one JSON string first.
+    """
+
+    def build_request(self, method, url, *, json=None, headers=None, **kwargs):
+        if json is None:
+            return super().build_request(method, url, headers=headers, **kwargs)
+        body = media.json_body(json)
+        headers = httpx.Headers(headers)
+        headers["Content-Type"] = "application/json"
+        if isinstance(body, media.StreamedJSON):
+            headers["Content-Length"] = str(body.length)
+        return super().build_request(method, url, content=body, headers=headers, **kwargs)
 
 
 class ClaudeClient:
     """Wrapper for Anthropic Claude API with conversation management."""
 
     def __init__(self):
-        self.client = anthropic.Anthropic(api_key=config.CLAUDE_API_KEY)
+        self.client = anthropic.Anthropic(api_key=config.CLAUDE_API_KEY, http_client=_StreamingBodyClient())
         self.model = config.CLAUDE_MODEL
         self.max_tokens = config.MAX_TOKENS
 
+    def close(self):
+        """Close the HTTP connection pool."""
+        self.client.close()
+
+    def _create(self, kwargs: Dict) -> tuple[str, int, int]:
+        """Run a Messages API request, recording latency and time-to-first-token.
+
+        The request is streamed so the first text delta can be timed; the
+        result is the same as a non-streaming call.
+        """
+        start = time.perf_counter()
+        with tracing.span("claude.request", model=kwargs["model"]) as span, \
+                metrics.DEPENDENCY_LATENCY.time(dependency="claude"):
+            with self.client.messages.stream(**kwargs) as stream:
+                for _ in stream.text_stream:
+                    ttft = time.perf_counter() - start
+                    metrics.CLAUDE_TTFT.observe(ttft, model=kwargs["model"])
+                    span.set(ttft_ms=round(ttft * 1000, 1))
+                    break
+                response = stream.get_final_message()
+            span.set(input_tokens=response.usage.input_tokens, output_tokens=response.usage.output_tokens)
+
+        # Extract text from response
+        response_text = ""
+        for block in response.content:
+            if block.type == "text":
+                response_text += block.text
+
+        input_tokens = response.usage.input_tokens
+        output_tokens = response.usage.output_tokens
+
+        return response_text, input_tokens, output_tokens
+
     async def get_available_models(self) -> list:
         """Fetch available Claude models live from Anthropic API.
 
@@ -37,11 +91,13 @@ class ClaudeClient:
             pass
         return []
 
+    @tracing.traced("claude.send_message")
     def send_message(
         self,
         messages: List[Dict[str, str]],
         system_prompt: Optional[str] = None,
-        model: Optional[str] = None
+        model: Optional[str] = None,
+        max_tokens: Optional[int] = None
     ) -> tuple[str, int, int]:
         """
         Send a message to Claude and get response.
@@ -49,6 +105,7 @@ class ClaudeClient:
         Args:
             messages: List of message dicts with 'role' and 'content'
             system_prompt: Optional system prompt
+            max_tokens: Optional cap on the response length (defaults to MAX_TOKENS)
 
         Returns:
             Tuple of (response_text, input_tokens, output_tokens)
@@ -56,25 +113,14 @@ class ClaudeClient:
         try:
             kwargs = {
                 "model": model or self.model,
-                "max_tokens": self.max_tokens,
+                "max_tokens": max_tokens or self.max_tokens,
                 "messages": messages
             }
 
             if system_prompt:
                 kwargs["system"] = system_prompt
 
-            response = self.client.messages.create(**kwargs)
-
-            # Extract text from response
-            response_text = ""
-            for block in response.content:
-                if block.type == "text":
-                    response_text += block.text
-
-            input_tokens = response.usage.input_tokens
-            output_tokens = response.usage.output_tokens
-
-            return response_text, input_tokens, output_tokens
+            return self._create(kwargs)
 
         except anthropic.APIError as e:
             raise Exception(f"Claude API error: {str(e)}")
@@ -99,67 +145,78 @@ class ClaudeClient:
         Returns:
             Tuple of (response_text, input_tokens, output_tokens)
         """
-        try:
-            # Encode image to base64
-            base64_image = base64.b64encode(image_data).decode('utf-8')
+        return self.send_message_with_images(messages, [image_data], image_format, system_prompt, model)
 
-            # Get the last user message (should contain the question about the image)
+    @tracing.traced("claude.send_message_with_images")
+    def send_message_with_images(
+        self,
+        messages: List[Dict],
+        images: Sequence[bytes],
+        image_format: str,
+        system_prompt: Optional[str] = None,
+        model: Optional[str] = None
+    ) -> tuple[str, int, int]:
+        """
+        Send a message with one or more images (e.g. a Telegram album) to Claude.
+
+        Several images are labelled "Image 1:", "Image 2:", ... so the answer
+        can refer to them.
+
+        Args:
+            messages: List of previous messages
+            images: Raw image bytes (any bytes-like object), in album order
+            image_format: Image format (jpeg, png, gif, webp)
+            system_prompt: Optional system prompt
+
+        Returns:
+            Tuple of (response_text, input_tokens, output_tokens)
+        """
+        try:
+            # Get the last user message (should contain the question about the images)
             last_message = messages[-1] if messages else {"role": "user", "content": "What's in this image?"}
+            text_content = last_message["content"]
 
-            # Convert last message to multimodal format
-            if isinstance(last_message["content"], str):
-                text_content = last_message["content"]
-            else:
-                text_content = last_message["content"]
-
-            # Create message with image
-            message_content = [
-                {
-                    "type": "image",
-                    "source": {
-                        "type": "base64",
-                        "media_type": f"image/{image_format}",
-                        "data": base64_image,
-                    },
-                },
-                {
+            with media.inline_base64(images) as placeholders:
+                # Create message with images; their base64 is streamed into the request body
+                message_content = []
+                for i, placeholder in enumerate(placeholders, 1):
+                    if len(placeholders) > 1:
+                        message_content.append({"type": "text", "text": f"Image {i}:"})
+                    message_content.append({
+                        "type": "image",
+                        "source": {
+                            "type": "base64",
+                            "media_type": f"image/{image_format}",
+                            "data": placeholder,
+                        },
+                    })
+                message_content.append({
                     "type": "text",
                     "text": text_content
+                })
+
+                # Update the last message with multimodal content
+                messages_copy = messages[:-1] if len(messages) > 1 else []
+                messages_copy.append({
+                    "role": "user",
+                    "content": message_content
+                })
+
+                kwargs = {
+                    "model": model or self.model,
+                    "max_tokens": self.max_tokens,
+                    "messages": messages_copy
                 }
-            ]
-
-            # Update the last message with multimodal content
-            messages_copy = messages[:-1] if len(messages) > 1 else []
-            messages_copy.append({
-                "role": "user",
-                "content": message_content
-            })
-
-            kwargs = {
-                "model": model or self.model,
-                "max_tokens": self.max_tokens,
-                "messages": messages_copy
-            }
 
-            if system_prompt:
-                kwargs["system"] = system_prompt
+                if system_prompt:
+                    kwargs["system"] = system_prompt
 
-            response = self.client.messages.create(**kwargs)
-
-            # Extract text from response
-            response_text = ""
-            for block in response.content:
-                if block.type == "text":
-                    response_text += block.text
-
-            input_tokens = response.usage.input_tokens
-            output_tokens = response.usage.output_tokens
-
-            return response_text, input_tokens, output_tokens
+                return self._create(kwargs)
 
         except anthropic.APIError as e:
             raise Exception(f"Claude API error: {str(e)}")
 
+    @tracing.traced("claude.send_message_with_document")
     def send_message_with_document(
         self,
         messages: List[Dict],
@@ -196,3 +253,67 @@ class ClaudeClient:
         })
 
         return self.send_message(messages_copy, system_prompt, model=model)
+
+    def create_batch(self, requests: List[Dict]) -> str:
+        """
+        Submit requests to the Message Batches API.
+
+        Args:
+            requests: List of {"custom_id": ..., "params": <Messages API request>}
+
+        Returns:
+            ID of the created batch
+        """
+        try:
+            with metrics.DEPENDENCY_LATENCY.time(dependency="claude_batch"):
+                batch = self.client.beta.messages.batches.create(requests=requests)
+            return batch.id
+        except anthropic.APIError as e:
+            raise Exception(f"Claude API error: {str(e)}")
+
+    def get_batch(self, batch_id: str) -> Dict:
+        """Processing status ("in_progress", "canceling" or "ended") and request counts of a batch."""
+        try:
+            with metrics.DEPENDENCY_LATENCY.time(dependency="claude_batch"):
+                batch = self.client.beta.messages.batches.retrieve(batch_id)
+            return {
+                "processing_status": batch.processing_status,
+                "request_counts": batch.request_counts.model_dump(),
+            }
+        except anthropic.APIError as e:
+            raise Exception(f"Claude API error: {str(e)}")
+
+    def get_batch_results(self, batch_id: str) -> List[Dict]:
+        """
+        Results of an ended batch.
+
+        Returns:
+            List of dicts with custom_id, status ("succeeded", "errored",
+            "canceled" or "expired"), text, input_tokens, output_tokens and error
+        """
+        try:
+            results = []
+            with metrics.DEPENDENCY_LATENCY.time(dependency="claude_batch"):
+                for entry in self.client.beta.messages.batches.results(batch_id):
+                    result = {"custom_id": entry.custom_id, "status": entry.result.type, "text": "",
+                              "input_tokens": 0, "output_tokens": 0, "error": None}
+                    if entry.result.type == "succeeded":
+                        message = entry.result.message
+                        result["text"] = "".join(block.text for block in message.content if block.type == "text")
+                        result["input_tokens"] = message.usage.input_tokens
+                        result["output_tokens"] = message.usage.output_tokens
+                    elif entry.result.type == "errored":
+                        error = entry.result.error.error
+                        result["error"] = getattr(error, "message", None) or str(error)
+                    results.append(result)
+            return results
+        except anthropic.APIError as e:
+            raise Exception(f"Claude API error: {str(e)}")
+
+    def cancel_batch(self, batch_id: str):
+        """Ask the API to stop processing a batch; finished requests keep their results."""
+        try:
+            with metrics.DEPENDENCY_LATENCY.time(dependency="claude_batch"):
+                self.client.beta.messages.batches.cancel(batch_id)
+        except anthropic.APIError as e:
+            raise Exception(f"Claude API error: {str(e)}")
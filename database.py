@@ -1,12 +1,235 @@
 """Database management for user authorization and usage tracking."""
 import sqlite3
 import json
+import logging
 from datetime import datetime
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Iterable, Iterator, Tuple
 import config
-
-
-class Database:
+import metrics
+import tracing
+from storage import (
+    CONVERSATION_COLUMNS,
+    EXPORT_BATCH_SIZE,
+    SNIPPET_END,
+    SNIPPET_START,
+    HistoryRow,
+    USAGE_COLUMNS,
+    Storage,
+    UserCursor,
+    UserRow,
+    calculate_cost,
+    search_terms,
+)
+
+logger = logging.getLogger(__name__)
+
+# WHERE clauses for the user listing filters
+USER_STATUS_FILTERS = {
+    "all": "",
+    "authorized": "is_authorized = 1",
+    "pending": "is_authorized = 0",
+    "admin": "is_admin = 1",
+}
+
+USER_COLUMNS = ("user_id, username, first_name, last_name, is_authorized, is_admin, created_at, "
+                "CAST(strftime('%s', created_at) AS INTEGER) * 1000000")
+
+
+def _user_dict(row) -> Dict:
+    return {
+        "user_id": row[0],
+        "username": row[1],
+        "first_name": row[2],
+        "last_name": row[3],
+        "is_authorized": bool(row[4]),
+        "is_admin": bool(row[5]),
+        "created_at": row[6],
+        "cursor": (row[7] or 0, row[0]),
+    }
+
+
+def _user_filters(status: str, active_days: Optional[int]) -> Tuple[List[str], List]:
+    conditions, params = [], []
+    if USER_STATUS_FILTERS[status]:
+        conditions.append(USER_STATUS_FILTERS[status])
+    if active_days:
+        conditions.append("last_active >= datetime('now', ?)")
+        params.append(f"-{int(active_days)} days")
+    return conditions, params
+
+
+# Search scope token of a conversations row, e.g. u42c100123 or u42cn100123
+# for a negative (group) chat id; unicode61 would split on the minus sign
+SEARCH_SCOPE = "'u' || {row}.user_id || 'c' || replace({row}.chat_id, '-', 'n')"
+
+
+def _search_scope(user_id: int, chat_id: int) -> str:
+    return f"u{user_id}c{str(chat_id).replace('-', 'n')}"
+
+
+# Ordered schema migrations; version N is MIGRATIONS[N - 1]. Column additions
+# are (table, column, definition) and skip columns that already exist, and
+# every statement is idempotent, so databases created before schema_version
+# existed are brought up to date by replaying all of them once.
+MIGRATIONS: List[List] = [
+    # 1: users, usage, history and settings
+    [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            is_authorized INTEGER DEFAULT 0,
+            is_admin INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS usage_stats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            model TEXT,
+            input_tokens INTEGER,
+            output_tokens INTEGER,
+            cost_usd REAL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            chat_id INTEGER,
+            role TEXT,
+            content TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ],
+    # 2: per-chat history
+    [("conversations", "chat_id", "INTEGER")],
+    # 3: rolling per-chat summaries of older turns
+    [
+        """
+        CREATE TABLE IF NOT EXISTS summaries (
+            user_id INTEGER,
+            chat_id INTEGER,
+            summary TEXT,
+            through_id INTEGER,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, chat_id)
+        )
+        """,
+    ],
+    # 4: batch jobs sent through the Message Batches API, their items, and
+    # usage billed at batch pricing
+    [
+        """
+        CREATE TABLE IF NOT EXISTS batch_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            chat_id INTEGER,
+            prompt TEXT,
+            model TEXT,
+            status TEXT DEFAULT 'collecting',
+            batch_id TEXT,
+            item_count INTEGER DEFAULT 0,
+            succeeded INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            cost_usd REAL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            submitted_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_batch_jobs_status ON batch_jobs (status)",
+        """
+        CREATE TABLE IF NOT EXISTS batch_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id INTEGER,
+            title TEXT,
+            content TEXT,
+            status TEXT DEFAULT 'pending',
+            result TEXT,
+            input_tokens INTEGER DEFAULT 0,
+            output_tokens INTEGER DEFAULT 0,
+            cost_usd REAL DEFAULT 0,
+            FOREIGN KEY (job_id) REFERENCES batch_jobs (id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_batch_items_job ON batch_items (job_id)",
+        ("usage_stats", "batch", "INTEGER DEFAULT 0"),
+    ],
+    # 5: keyset pagination and per-status counts in the admin user list
+    [
+        "CREATE INDEX IF NOT EXISTS idx_users_created ON users (created_at, user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_users_authorized ON users (is_authorized, created_at, user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_users_admin ON users (is_admin, created_at, user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_users_last_active ON users (last_active)",
+    ],
+    # 6: full-text search over history. The index reads text from the
+    # conversations table through a view; the scope column holds one token per
+    # user and chat, so a search only walks the caller's own turns.
+    [
+        f"""
+        CREATE VIEW IF NOT EXISTS conversations_search AS
+        SELECT id, content, {SEARCH_SCOPE.format(row="conversations")} AS scope FROM conversations
+        """,
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS conversations_fts USING fts5(
+            content, scope,
+            content='conversations_search', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS conversations_fts_insert AFTER INSERT ON conversations BEGIN
+            INSERT INTO conversations_fts (rowid, content, scope)
+            VALUES (new.id, new.content, {SEARCH_SCOPE.format(row="new")});
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS conversations_fts_delete AFTER DELETE ON conversations BEGIN
+            INSERT INTO conversations_fts (conversations_fts, rowid, content, scope)
+            VALUES ('delete', old.id, old.content, {SEARCH_SCOPE.format(row="old")});
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS conversations_fts_update AFTER UPDATE ON conversations BEGIN
+            INSERT INTO conversations_fts (conversations_fts, rowid, content, scope)
+            VALUES ('delete', old.id, old.content, {SEARCH_SCOPE.format(row="old")});
+            INSERT INTO conversations_fts (rowid, content, scope)
+            VALUES (new.id, new.content, {SEARCH_SCOPE.format(row="new")});
+        END
+        """,
+        "INSERT INTO conversations_fts (conversations_fts) VALUES ('rebuild')",
+    ],
+    # 7: per-user exports (the rowid is the implicit last index column)
+    [
+        "CREATE INDEX IF NOT EXISTS idx_conversations_user ON conversations (user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_usage_stats_user ON usage_stats (user_id)",
+    ],
+    # 8: token budgets per user and chat, rebuilt from recent usage
+    [
+        ("usage_stats", "chat_id", "INTEGER"),
+        "CREATE INDEX IF NOT EXISTS idx_usage_stats_user_time ON usage_stats (user_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_usage_stats_chat_time ON usage_stats (chat_id, timestamp)",
+    ],
+]
+
+
+class Database(Storage):
     """Manages SQLite database for user data and usage statistics."""
 
     def __init__(self, db_path: str = None):
@@ -18,78 +241,46 @@ class Database:
         return sqlite3.connect(self.db_path)
 
     def init_database(self):
-        """Initialize database tables."""
+        """Apply pending schema migrations and make sure the admin user exists."""
         conn = self.get_connection()
         cursor = conn.cursor()
+        try:
+            current = cursor.execute("SELECT MAX(version) FROM schema_version").fetchone()[0] or 0
+        except sqlite3.OperationalError:  # no schema_version table yet
+            current = 0
+
+        if current < len(MIGRATIONS):
+            # Take the write lock before re-reading, so concurrent workers migrate once
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("CREATE TABLE IF NOT EXISTS schema_version "
+                           "(version INTEGER PRIMARY KEY, applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
+            cursor.execute("SELECT MAX(version) FROM schema_version")
+            current = cursor.fetchone()[0] or 0
+            for version, statements in enumerate(MIGRATIONS[current:], current + 1):
+                for statement in statements:
+                    if isinstance(statement, tuple):
+                        table, column, definition = statement
+                        cursor.execute(f"PRAGMA table_info({table})")
+                        if column in [row[1] for row in cursor.fetchall()]:
+                            continue
+                        statement = f"ALTER TABLE {table} ADD COLUMN {column} {definition}"
+                    cursor.execute(statement)
+                cursor.execute("INSERT INTO schema_version (version) VALUES (?)", (version,))
+                logger.info(f"Applied schema migration {version}")
+            conn.commit()
 
-        # Users table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                is_authorized INTEGER DEFAULT 0,
-                is_admin INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
-        # Usage statistics table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS usage_stats (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                model TEXT,
-                input_tokens INTEGER,
-                output_tokens INTEGER,
-                cost_usd REAL,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        """)
-
-        # Conversation history table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS conversations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                chat_id INTEGER,
-                role TEXT,
-                content TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        """)
-
-        # Migrate existing database - add chat_id column if it doesn't exist
-        cursor.execute("PRAGMA table_info(conversations)")
-        columns = [column[1] for column in cursor.fetchall()]
-        if 'chat_id' not in columns:
-            cursor.execute("ALTER TABLE conversations ADD COLUMN chat_id INTEGER")
-
-        # Settings table for system prompt and other settings
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS settings (
-                key TEXT PRIMARY KEY,
-                value TEXT,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
-        conn.commit()
-
-        # Ensure admin user exists
+        # Ensure admin user exists; no write when it already does
         if config.ADMIN_USER_ID:
             cursor.execute("""
-                INSERT OR REPLACE INTO users (user_id, is_authorized, is_admin)
-                VALUES (?, 1, 1)
+                INSERT INTO users (user_id, is_authorized, is_admin) VALUES (?, 1, 1)
+                ON CONFLICT(user_id) DO UPDATE SET is_authorized = 1, is_admin = 1
+                WHERE is_authorized != 1 OR is_admin != 1
             """, (config.ADMIN_USER_ID,))
             conn.commit()
 
         conn.close()
 
+    @metrics.db_timed
     def is_authorized(self, user_id: int) -> bool:
         """Check if user is authorized."""
         conn = self.get_connection()
@@ -97,8 +288,9 @@ class Database:
         cursor.execute("SELECT is_authorized FROM users WHERE user_id = ?", (user_id,))
         result = cursor.fetchone()
         conn.close()
-        return result and result[0] == 1
+        return bool(result) and result[0] == 1
 
+    @metrics.db_timed
     def is_admin(self, user_id: int) -> bool:
         """Check if user is admin."""
         conn = self.get_connection()
@@ -106,8 +298,9 @@ class Database:
         cursor.execute("SELECT is_admin FROM users WHERE user_id = ?", (user_id,))
         result = cursor.fetchone()
         conn.close()
-        return result and result[0] == 1
+        return bool(result) and result[0] == 1
 
+    @metrics.db_timed
     def add_user(self, user_id: int, username: str = None, first_name: str = None,
                  last_name: str = None, is_authorized: bool = False):
         """Add or update user information."""
@@ -126,6 +319,7 @@ class Database:
         conn.commit()
         conn.close()
 
+    @metrics.db_timed
     def authorize_user(self, user_id: int):
         """Authorize a user."""
         conn = self.get_connection()
@@ -134,6 +328,7 @@ class Database:
         conn.commit()
         conn.close()
 
+    @metrics.db_timed
     def deauthorize_user(self, user_id: int):
         """Deauthorize a user."""
         conn = self.get_connection()
@@ -142,6 +337,45 @@ class Database:
         conn.commit()
         conn.close()
 
+    @metrics.db_timed
+    def set_users_authorized(self, user_ids: Iterable[int], authorized: bool) -> List[int]:
+        """Authorize or deauthorize many users in one transaction."""
+        user_ids = list(dict.fromkeys(user_ids))
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        found = []
+        # Stay well under SQLite's bound-parameter limit
+        for i in range(0, len(user_ids), 500):
+            chunk = user_ids[i:i + 500]
+            cursor.execute(f"SELECT user_id FROM users WHERE user_id IN ({', '.join('?' * len(chunk))})", chunk)
+            found.extend(row[0] for row in cursor.fetchall())
+        cursor.executemany("UPDATE users SET is_authorized = ? WHERE user_id = ?",
+                           [(int(authorized), user_id) for user_id in found])
+        conn.commit()
+        conn.close()
+        return found
+
+    @metrics.db_timed
+    def import_users(self, users: Iterable[UserRow], authorize: bool = True) -> int:
+        """Create or update many users in one transaction."""
+        rows = [(user_id, username, first_name, last_name, int(authorize))
+                for user_id, username, first_name, last_name in users]
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.executemany("""
+            INSERT INTO users (user_id, username, first_name, last_name, is_authorized)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                username = COALESCE(excluded.username, username),
+                first_name = COALESCE(excluded.first_name, first_name),
+                last_name = COALESCE(excluded.last_name, last_name),
+                is_authorized = excluded.is_authorized
+        """, rows)
+        conn.commit()
+        conn.close()
+        return len(rows)
+
+    @metrics.db_timed
     def get_all_users(self) -> List[Dict]:
         """Get all users."""
         conn = self.get_connection()
@@ -164,23 +398,90 @@ class Database:
         conn.close()
         return users
 
-    def log_usage(self, user_id: int, model: str, input_tokens: int, output_tokens: int):
+    @metrics.db_timed
+    def get_user(self, user_id: int) -> Optional[Dict]:
+        """Get one user."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT {USER_COLUMNS} FROM users WHERE user_id = ?", (user_id,))
+        row = cursor.fetchone()
+        conn.close()
+        return _user_dict(row) if row else None
+
+    @metrics.db_timed
+    def get_users_page(self, status: str = "all", active_days: int = None,
+                       after: UserCursor = None, before: UserCursor = None, limit: int = 20) -> List[Dict]:
+        """A page of users, newest first, continuing from a cursor."""
+        conditions, params = _user_filters(status, active_days)
+        order = "DESC"
+        if after is not None:
+            conditions.append("(created_at, user_id) < (datetime(? / 1000000, 'unixepoch'), ?)")
+            params.extend(after)
+        elif before is not None:
+            # Walk backwards from the cursor, then flip the page
+            conditions.append("(created_at, user_id) > (datetime(? / 1000000, 'unixepoch'), ?)")
+            params.extend(before)
+            order = "ASC"
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT {USER_COLUMNS} FROM users {where}
+            ORDER BY created_at {order}, user_id {order}
+            LIMIT ?
+        """, (*params, limit))
+        rows = cursor.fetchall()
+        conn.close()
+        if order == "ASC":
+            rows.reverse()
+        return [_user_dict(row) for row in rows]
+
+    @metrics.db_timed
+    def count_users(self, status: str = "all", active_days: int = None) -> int:
+        """Count users matching the listing filters."""
+        conditions, params = _user_filters(status, active_days)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT COUNT(*) FROM users {where}", params)
+        count = cursor.fetchone()[0]
+        conn.close()
+        return count
+
+    @metrics.db_timed
+    def get_user_counts(self) -> Dict[str, int]:
+        """Count users of every status in one pass over the table."""
+        statuses = [status for status, condition in USER_STATUS_FILTERS.items() if condition]
+        sums = ", ".join(
+            f"COALESCE(SUM(CASE WHEN {USER_STATUS_FILTERS[status]} THEN 1 ELSE 0 END), 0)" for status in statuses
+        )
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT COUNT(*), {sums} FROM users")
+        row = cursor.fetchone()
+        conn.close()
+        return dict(zip(["all"] + statuses, row))
+
+    @metrics.db_timed
+    @tracing.traced("db.log_usage")
+    def log_usage(self, user_id: int, model: str, input_tokens: int, output_tokens: int,
+                  batch: bool = False, chat_id: int = None) -> float:
         """Log API usage and calculate cost."""
-        pricing = config.CLAUDE_PRICING.get(model, {"input": 3.00, "output": 15.00})
-        cost = (input_tokens / 1_000_000 * pricing["input"] +
-                output_tokens / 1_000_000 * pricing["output"])
+        cost = calculate_cost(model, input_tokens, output_tokens, batch)
 
         conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute("""
-            INSERT INTO usage_stats (user_id, model, input_tokens, output_tokens, cost_usd)
-            VALUES (?, ?, ?, ?, ?)
-        """, (user_id, model, input_tokens, output_tokens, cost))
+            INSERT INTO usage_stats (user_id, chat_id, model, input_tokens, output_tokens, cost_usd, batch)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (user_id, chat_id, model, input_tokens, output_tokens, cost, int(batch)))
         conn.commit()
         conn.close()
 
         return cost
 
+    @metrics.db_timed
     def get_total_usage(self) -> Dict:
         """Get total usage statistics."""
         conn = self.get_connection()
@@ -203,6 +504,7 @@ class Database:
             "total_requests": row[3] or 0
         }
 
+    @metrics.db_timed
     def get_user_usage(self, user_id: int) -> Dict:
         """Get usage statistics for a specific user."""
         conn = self.get_connection()
@@ -226,6 +528,67 @@ class Database:
             "total_requests": row[3] or 0
         }
 
+    @metrics.db_timed
+    def get_usage_by_model(self, days: int = 7) -> List[Dict]:
+        """Usage per model over the last days."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT model, COUNT(*), SUM(input_tokens), SUM(output_tokens), SUM(cost_usd)
+            FROM usage_stats
+            WHERE timestamp >= datetime('now', ?)
+            GROUP BY model
+            ORDER BY COUNT(*) DESC, model
+        """, (f"-{int(days)} days",))
+        usage = [{
+            "model": row[0],
+            "requests": row[1],
+            "input_tokens": row[2] or 0,
+            "output_tokens": row[3] or 0,
+            "cost": row[4] or 0.0
+        } for row in cursor.fetchall()]
+        conn.close()
+        return usage
+
+    @metrics.db_timed
+    def get_tokens_since(self, seconds: int, user_id: int = None, chat_id: int = None) -> int:
+        """Tokens of chat replies in the last seconds, for a user or a chat."""
+        column, value = ("user_id", user_id) if user_id is not None else ("chat_id", chat_id)
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT SUM(input_tokens + output_tokens)
+            FROM usage_stats
+            WHERE {column} = ? AND timestamp >= datetime('now', ?) AND chat_id IS NOT NULL AND batch = 0
+        """, (value, f"-{int(seconds)} seconds"))
+        tokens = cursor.fetchone()[0] or 0
+        conn.close()
+        return tokens
+
+    def iter_usage(self, user_id: int = None) -> Iterator[Tuple]:
+        """Usage records in id order, read in batches."""
+        return self._iter_by_id("usage_stats", USAGE_COLUMNS, user_id)
+
+    def _iter_by_id(self, table: str, columns: Tuple[str, ...], user_id: Optional[int]) -> Iterator[Tuple]:
+        """Rows of a table in id order, one short query and connection per batch."""
+        condition, params = ("user_id = ? AND ", (user_id,)) if user_id is not None else ("", ())
+        last_id = 0
+        while True:
+            conn = self.get_connection()
+            rows = conn.execute(f"""
+                SELECT {", ".join(columns)} FROM {table}
+                WHERE {condition}id > ?
+                ORDER BY id
+                LIMIT ?
+            """, params + (last_id, EXPORT_BATCH_SIZE)).fetchall()
+            conn.close()
+            yield from rows
+            if len(rows) < EXPORT_BATCH_SIZE:
+                return
+            last_id = rows[-1][0]
+
+    @metrics.db_timed
+    @tracing.traced("db.add_message_to_history")
     def add_message_to_history(self, user_id: int, chat_id: int, role: str, content: str):
         """Add message to conversation history for a specific chat."""
         conn = self.get_connection()
@@ -237,6 +600,21 @@ class Database:
         conn.commit()
         conn.close()
 
+    @metrics.db_timed
+    @tracing.traced("db.add_messages_to_history")
+    def add_messages_to_history(self, messages: Iterable[HistoryRow]):
+        """Add several messages in one transaction."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.executemany("""
+            INSERT INTO conversations (user_id, chat_id, role, content)
+            VALUES (?, ?, ?, ?)
+        """, list(messages))
+        conn.commit()
+        conn.close()
+
+    @metrics.db_timed
+    @tracing.traced("db.get_conversation_history")
     def get_conversation_history(self, user_id: int, chat_id: int, limit: int = 20) -> List[Dict]:
         """Get recent conversation history for a user in a specific chat (last 10 minutes)."""
         conn = self.get_connection()
@@ -246,7 +624,7 @@ class Database:
             FROM conversations
             WHERE user_id = ? AND chat_id = ?
                 AND timestamp >= datetime('now', '-10 minutes')
-            ORDER BY timestamp DESC
+            ORDER BY timestamp DESC, id DESC
             LIMIT ?
         """, (user_id, chat_id, limit))
 
@@ -259,17 +637,120 @@ class Database:
         conn.close()
         return messages
 
+    @metrics.db_timed
+    @tracing.traced("db.get_recent_turns")
+    def get_recent_turns(self, user_id: int, chat_id: int, limit: int = 20) -> List[Tuple[float, str, str]]:
+        """Recent history with unix timestamps, oldest first."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT CAST(strftime('%s', timestamp) AS REAL), role, content
+            FROM conversations
+            WHERE user_id = ? AND chat_id = ?
+                AND timestamp >= datetime('now', '-10 minutes')
+            ORDER BY timestamp DESC, id DESC
+            LIMIT ?
+        """, (user_id, chat_id, limit))
+        turns = list(reversed(cursor.fetchall()))
+        conn.close()
+        return turns
+
+    @metrics.db_timed
+    def get_turns_since(self, user_id: int, chat_id: int, after_id: int,
+                        limit: int = 200) -> List[Tuple[int, float, str, str]]:
+        """Latest turns after a given id, oldest first."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id, CAST(strftime('%s', timestamp) AS REAL), role, content
+            FROM conversations
+            WHERE user_id = ? AND chat_id = ? AND id > ?
+            ORDER BY id DESC
+            LIMIT ?
+        """, (user_id, chat_id, after_id, limit))
+        turns = list(reversed(cursor.fetchall()))
+        conn.close()
+        return turns
+
+    @metrics.db_timed
+    def search_history(self, user_id: int, chat_id: int, query: str,
+                       limit: int = 5, offset: int = 0) -> List[Dict]:
+        """Full-text search over one chat's history, newest match first.
+
+        FTS5 returns rowid order straight from the index, so a page costs about
+        the same however many turns match; ORDER BY rank (bm25) would score
+        every match and count each term over the whole table first.
+        """
+        terms = search_terms(query)
+        if not terms:
+            return []
+        match = (f'scope:"{_search_scope(user_id, chat_id)}" AND content:('
+                 + " ".join(f'"{term}"*' for term in terms) + ")")
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT c.id, c.role, c.timestamp, snippet(conversations_fts, 0, ?, ?, '…', 24)
+            FROM conversations_fts
+            JOIN conversations c ON c.id = conversations_fts.rowid
+            WHERE conversations_fts MATCH ?
+            ORDER BY conversations_fts.rowid DESC
+            LIMIT ? OFFSET ?
+        """, (SNIPPET_START, SNIPPET_END, match, limit, offset))
+        rows = cursor.fetchall()
+        conn.close()
+        return [{"id": row[0], "role": row[1], "timestamp": row[2], "snippet": row[3]} for row in rows]
+
+    def iter_conversations(self, user_id: int = None) -> Iterator[Tuple]:
+        """Conversation turns in id order, read in batches."""
+        return self._iter_by_id("conversations", CONVERSATION_COLUMNS, user_id)
+
+    @metrics.db_timed
     def clear_conversation_history(self, user_id: int, chat_id: int = None):
         """Clear conversation history for a user in specific chat or all chats."""
         conn = self.get_connection()
         cursor = conn.cursor()
         if chat_id is not None:
             cursor.execute("DELETE FROM conversations WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+            cursor.execute("DELETE FROM summaries WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
         else:
             cursor.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
+            cursor.execute("DELETE FROM summaries WHERE user_id = ?", (user_id,))
         conn.commit()
         conn.close()
 
+    @metrics.db_timed
+    @tracing.traced("db.get_summary")
+    def get_summary(self, user_id: int, chat_id: int) -> Optional[Tuple[str, int]]:
+        """Get the rolling summary of a chat."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT summary, through_id FROM summaries WHERE user_id = ? AND chat_id = ?",
+                       (user_id, chat_id))
+        row = cursor.fetchone()
+        conn.close()
+        return (row[0], row[1]) if row else None
+
+    @metrics.db_timed
+    def save_summary(self, user_id: int, chat_id: int, summary: str, through_id: int) -> bool:
+        """Store the rolling summary of a chat unless its folded turns were cleared."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO summaries (user_id, chat_id, summary, through_id, updated_at)
+            SELECT ?, ?, ?, ?, CURRENT_TIMESTAMP
+            WHERE EXISTS (SELECT 1 FROM conversations WHERE id = ? AND user_id = ? AND chat_id = ?)
+            ON CONFLICT(user_id, chat_id) DO UPDATE SET
+                summary = excluded.summary,
+                through_id = excluded.through_id,
+                updated_at = CURRENT_TIMESTAMP
+        """, (user_id, chat_id, summary, through_id, through_id, user_id, chat_id))
+        saved = cursor.rowcount > 0
+        conn.commit()
+        conn.close()
+        return saved
+
+    @metrics.db_timed
+    @tracing.traced("db.get_setting")
     def get_setting(self, key: str, default: str = None) -> Optional[str]:
         """Get a setting value by key."""
         conn = self.get_connection()
@@ -279,6 +760,7 @@ class Database:
         conn.close()
         return row[0] if row else default
 
+    @metrics.db_timed
     def set_setting(self, key: str, value: str):
         """Set a setting value."""
         conn = self.get_connection()
@@ -292,3 +774,117 @@ class Database:
         """, (key, value))
         conn.commit()
         conn.close()
+
+    @metrics.db_timed
+    def create_batch_job(self, user_id: int, chat_id: int, prompt: str) -> int:
+        """Start collecting items for a new batch job."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO batch_jobs (user_id, chat_id, prompt) VALUES (?, ?, ?)",
+                       (user_id, chat_id, prompt))
+        job_id = cursor.lastrowid
+        conn.commit()
+        conn.close()
+        return job_id
+
+    @metrics.db_timed
+    def get_batch_jobs(self, user_id: int = None, chat_id: int = None,
+                       statuses: Iterable[str] = None, limit: int = 20) -> List[Dict]:
+        """Batch jobs, newest first."""
+        conditions, params = [], []
+        if user_id is not None:
+            conditions.append("user_id = ?")
+            params.append(user_id)
+        if chat_id is not None:
+            conditions.append("chat_id = ?")
+            params.append(chat_id)
+        if statuses is not None:
+            statuses = list(statuses)
+            conditions.append(f"status IN ({', '.join('?' * len(statuses))})")
+            params.extend(statuses)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        conn = self.get_connection()
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT id, user_id, chat_id, prompt, model, status, batch_id, item_count,
+                   succeeded, failed, cost_usd, created_at, finished_at
+            FROM batch_jobs {where}
+            ORDER BY id DESC
+            LIMIT ?
+        """, (*params, limit))
+        jobs = [dict(row) for row in cursor.fetchall()]
+        conn.close()
+        return jobs
+
+    @metrics.db_timed
+    def update_batch_job(self, job_id: int, status: str, expected_status: str = None,
+                         batch_id: str = None, model: str = None,
+                         results: Tuple[int, int, float] = None) -> bool:
+        """Move a job to a new status, optionally only from expected_status."""
+        assignments, params = ["status = ?"], [status]
+        if batch_id is not None:
+            assignments.append("batch_id = ?, submitted_at = CURRENT_TIMESTAMP")
+            params.append(batch_id)
+        if model is not None:
+            assignments.append("model = ?")
+            params.append(model)
+        if results is not None:
+            assignments.append("succeeded = ?, failed = ?, cost_usd = ?, finished_at = CURRENT_TIMESTAMP")
+            params.extend(results)
+        query = f"UPDATE batch_jobs SET {', '.join(assignments)} WHERE id = ?"
+        params.append(job_id)
+        if expected_status is not None:
+            query += " AND status = ?"
+            params.append(expected_status)
+
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        updated = cursor.rowcount > 0
+        conn.commit()
+        conn.close()
+        return updated
+
+    @metrics.db_timed
+    def add_batch_item(self, job_id: int, title: str, content: str) -> int:
+        """Add an item to a collecting job and return the job's item count."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO batch_items (job_id, title, content) VALUES (?, ?, ?)",
+                       (job_id, title, content))
+        cursor.execute("UPDATE batch_jobs SET item_count = item_count + 1 WHERE id = ?", (job_id,))
+        cursor.execute("SELECT item_count FROM batch_jobs WHERE id = ?", (job_id,))
+        count = cursor.fetchone()[0]
+        conn.commit()
+        conn.close()
+        return count
+
+    @metrics.db_timed
+    def get_batch_items(self, job_id: int) -> List[Dict]:
+        """Items of a batch job in the order they were added."""
+        conn = self.get_connection()
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id, title, content, status, result, input_tokens, output_tokens, cost_usd
+            FROM batch_items WHERE job_id = ? ORDER BY id
+        """, (job_id,))
+        items = [dict(row) for row in cursor.fetchall()]
+        conn.close()
+        return items
+
+    @metrics.db_timed
+    def save_batch_results(self, results: Iterable[Tuple[int, str, str, int, int, float]]):
+        """Store per-item results in one transaction."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.executemany("""
+            UPDATE batch_items
+            SET status = ?, result = ?, input_tokens = ?, output_tokens = ?, cost_usd = ?
+            WHERE id = ?
+        """, [(status, result, input_tokens, output_tokens, cost, item_id)
+              for item_id, status, result, input_tokens, output_tokens, cost in results])
+        conn.commit()
+        conn.close()
@@ -0,0 +1,513 @@
+"""Text extraction from documents in a pool of worker processes.
+
+Plain text and code (with charset detection), PDF, DOCX, HTML and CSV are
+turned into text by ``python documents.py --worker`` processes, so
+CPU-heavy parsing never runs on the event loop and a hostile file can't
+take the bot down. Each worker handles one job at a time under an address
+space limit (EXTRACT_MEMORY_MB); a job that runs longer than
+EXTRACT_TIMEOUT seconds gets its worker killed. Up to EXTRACT_WORKERS
+workers are started on demand and reused.
+
+Workers send text back a page (PDF) or section at a time as JSON lines and
+stop once ``max_chars`` have been sent, so only the beginning of a
+300-page PDF is ever parsed when only that much fits in the prompt.
+
+    async with aclosing(documents.extract(path, "pdf", 200_000)) as sections:
+        async for section in sections:
+            ...
+"""
+import asyncio
+import csv
+import io
+import json
+import logging
+import os
+import sys
+import time
+from html.parser import HTMLParser
+from typing import AsyncIterator, Dict, Iterator, List, Optional
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DOCX_MIME = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+# Text files that Telegram often labels application/*
+TEXT_MIME_TYPES = {
+    "application/json", "application/xml", "application/x-yaml", "application/yaml",
+    "application/javascript", "application/x-javascript", "application/x-sh",
+    "application/sql", "application/x-python", "application/x-tex", "application/toml",
+}
+TEXT_EXTENSIONS = {
+    ".txt", ".md", ".rst", ".log", ".json", ".jsonl", ".xml", ".yaml", ".yml", ".toml", ".ini",
+    ".cfg", ".conf", ".env", ".sql", ".sh", ".py", ".js", ".ts", ".tsx", ".jsx", ".java", ".kt",
+    ".c", ".h", ".cpp", ".hpp", ".cs", ".go", ".rs", ".rb", ".php", ".swift", ".css", ".scss",
+    ".tex", ".srt", ".vtt",
+}
+
+FORMATS_TEXT = "текстовые файлы и код, PDF, DOCX, HTML, CSV"
+
+# Characters per section sent back by a worker (PDF pages are sent whole)
+SECTION_CHARS = 16_000
+
+# Bytes of a text file sampled for charset detection; shorter non-UTF-8 files
+# than SHORT_TEXT are too short to detect reliably and use the fallback encoding
+CHARSET_SAMPLE = 256 * 1024
+SHORT_TEXT = 1024
+
+ERROR_TEXTS = {
+    "timeout": "❌ Документ обрабатывался слишком долго. Попробуйте файл поменьше.",
+    "memory": "❌ Документ слишком сложный: не хватило памяти на его разбор.",
+    "crashed": "❌ Не удалось разобрать документ.",
+    "encrypted": "❌ PDF защищён паролем.",
+    "invalid": "❌ Не удалось прочитать файл: он повреждён или не соответствует формату.",
+    "unsupported": "❌ Чтение PDF недоступно: на сервере не установлен pypdf.",
+    "empty": "❌ В документе не найден текст (возможно, это скан).",
+}
+
+# Longest JSON line accepted from a worker
+_LINE_LIMIT = 4 * 1024 * 1024
+
+
+class ExtractionError(Exception):
+    """A document could not be read; the message is the reply to the user."""
+
+
+def detect_format(mime_type: Optional[str], file_name: Optional[str]) -> Optional[str]:
+    """text, pdf, docx, html or csv from the MIME type and extension, or None if unsupported."""
+    mime = (mime_type or "").lower()
+    ext = os.path.splitext(file_name or "")[1].lower()
+    if mime == "application/pdf" or ext == ".pdf":
+        return "pdf"
+    if mime == DOCX_MIME or ext == ".docx":
+        return "docx"
+    if mime in ("text/html", "application/xhtml+xml") or ext in (".html", ".htm", ".xhtml"):
+        return "html"
+    if mime in ("text/csv", "text/tab-separated-values") or ext in (".csv", ".tsv"):
+        return "csv"
+    if mime.startswith("text/") or mime in TEXT_MIME_TYPES or ext in TEXT_EXTENSIONS:
+        return "text"
+    return None
+
+
+def check_document(document, max_bytes: int = None) -> Optional[str]:
+    """Rejection text for a Telegram document the bot can't read, or None."""
+    max_bytes = max_bytes or config.DOCUMENT_MAX_BYTES
+    if detect_format(document.mime_type, document.file_name) is None:
+        return f"❌ Этот формат не поддерживается.\nПоддерживаются: {FORMATS_TEXT}."
+    if (document.file_size or 0) > max_bytes:
+        return f"❌ Файл слишком большой. Максимум: {max_bytes / 1_000_000:.0f} МБ"
+    return None
+
+
+# --- Extractors: run inside worker processes ---
+
+def decode_text(data: bytes, fallback: str = "cp1251") -> str:
+    """Decode by BOM, as UTF-8, or by charset detection (the fallback if it can't tell)."""
+    for bom, encoding in ((b"\xef\xbb\xbf", "utf-8-sig"), (b"\xff\xfe\x00\x00", "utf-32"),
+                          (b"\x00\x00\xfe\xff", "utf-32"), (b"\xff\xfe", "utf-16"), (b"\xfe\xff", "utf-16")):
+        if data.startswith(bom):
+            return data.decode(encoding, errors="replace")
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        pass
+    best = None
+    if len(data) >= SHORT_TEXT:
+        try:
+            from charset_normalizer import from_bytes
+            best = from_bytes(data[:CHARSET_SAMPLE]).best()
+        except ImportError:
+            pass
+    return data.decode(best.encoding if best else fallback, errors="replace")
+
+
+# Set from --fallback-encoding in worker processes
+_fallback_encoding = "cp1251"
+
+
+def _read_text(path: str) -> str:
+    with open(path, "rb") as f:
+        return decode_text(f.read(), _fallback_encoding)
+
+
+def _sections(lines) -> Iterator[str]:
+    """Group lines into sections of about SECTION_CHARS.
+
+    A line longer than that (minified JSON, a log without newlines) is cut,
+    so every section stays small and _run_job can stop near max_chars.
+    """
+    section: List[str] = []
+    size = 0
+    for line in lines:
+        while len(line) > SECTION_CHARS:
+            if section:
+                yield "".join(section)
+                section, size = [], 0
+            yield line[:SECTION_CHARS]
+            line = line[SECTION_CHARS:]
+        section.append(line)
+        size += len(line)
+        if size >= SECTION_CHARS:
+            yield "".join(section)
+            section, size = [], 0
+    if section:
+        yield "".join(section)
+
+
+def extract_text(path: str) -> Iterator[str]:
+    return _sections(_read_text(path).splitlines(keepends=True))
+
+
+def extract_csv(path: str) -> Iterator[str]:
+    text = _read_text(path)
+    try:
+        dialect = csv.Sniffer().sniff(text[:SECTION_CHARS], delimiters=",;\t|")
+    except csv.Error:
+        dialect = csv.excel
+    rows = csv.reader(io.StringIO(text), dialect)
+    return _sections(" | ".join(cell.strip() for cell in row) + "\n" for row in rows)
+
+
+class _HTMLText(HTMLParser):
+    """Visible text of an HTML page, one line per block element."""
+
+    SKIP = {"script", "style", "noscript", "template", "svg"}
+    BLOCKS = {"p", "div", "br", "li", "tr", "table", "section", "article", "header", "footer",
+              "blockquote", "pre", "ul", "ol", "hr", "h1", "h2", "h3", "h4", "h5", "h6", "title"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts: List[str] = []
+        self._skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self._skipping += 1
+        elif tag in self.BLOCKS:
+            self.parts.append("\n")
+        elif tag in ("td", "th"):
+            self.parts.append(" | ")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP:
+            self._skipping = max(0, self._skipping - 1)
+        elif tag in self.BLOCKS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self._skipping:
+            self.parts.append(" ".join(data.split()) + (" " if data[-1:].isspace() else ""))
+
+    def take(self) -> str:
+        lines = (line.strip(" |") for line in "".join(self.parts).split("\n"))
+        self.parts = []
+        return "".join(line + "\n" for line in lines if line)
+
+
+def extract_html(path: str) -> Iterator[str]:
+    text = _read_text(path)
+    parser = _HTMLText()
+    for start in range(0, len(text), SECTION_CHARS):
+        parser.feed(text[start:start + SECTION_CHARS])
+        section = parser.take()
+        if section:
+            yield section
+    parser.close()
+    section = parser.take()
+    if section:
+        yield section
+
+
+def extract_docx(path: str) -> Iterator[str]:
+    import zipfile
+    from xml.etree.ElementTree import iterparse
+
+    w = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+    breaks = {f"{w}tab": "\t", f"{w}br": "\n", f"{w}cr": "\n"}
+
+    def lines() -> Iterator[str]:
+        tables = 0
+        row: List[str] = []
+        cell: List[str] = []
+        with zipfile.ZipFile(path) as archive, archive.open("word/document.xml") as xml:
+            for event, element in iterparse(xml, events=("start", "end")):
+                tag = element.tag
+                if event == "start":
+                    if tag == f"{w}tbl":
+                        tables += 1
+                    continue
+                if tag == f"{w}p":
+                    text = "".join(
+                        node.text or "" if node.tag == f"{w}t" else breaks[node.tag]
+                        for node in element.iter() if node.tag == f"{w}t" or node.tag in breaks
+                    )
+                    style = element.find(f"{w}pPr/{w}pStyle")
+                    if style is not None and style.get(f"{w}val", "").lower().startswith(("heading", "title")):
+                        text = f"## {text}"
+                    if tables:
+                        cell.append(text)
+                    elif text:
+                        yield text + "\n"
+                    element.clear()
+                elif tag == f"{w}tc":
+                    row.append(" ".join(part for part in cell if part))
+                    cell = []
+                elif tag == f"{w}tr":
+                    if any(row):
+                        yield " | ".join(row) + "\n"
+                    row = []
+                    element.clear()
+                elif tag == f"{w}tbl":
+                    tables -= 1
+                    element.clear()
+
+    return _sections(lines())
+
+
+def extract_pdf(path: str) -> Iterator[str]:
+    from pypdf import PdfReader
+
+    reader = PdfReader(path)
+    if reader.is_encrypted and not reader.decrypt(""):
+        raise PermissionError("encrypted")
+    for number, page in enumerate(reader.pages, 1):
+        text = (page.extract_text() or "").strip()
+        if text:
+            yield f"[Страница {number}]\n{text}\n\n"
+
+
+EXTRACTORS = {
+    "text": extract_text,
+    "csv": extract_csv,
+    "html": extract_html,
+    "docx": extract_docx,
+    "pdf": extract_pdf,
+}
+
+
+def _run_job(job: Dict, send):
+    """Send one document's sections, then done or an error kind."""
+    sent = 0
+    try:
+        for section in EXTRACTORS[job["format"]](job["path"]):
+            send({"section": section})
+            sent += len(section)
+            if sent > job["max_chars"]:
+                break
+    except MemoryError:
+        send({"error": "memory"})
+        raise
+    except PermissionError:
+        send({"error": "encrypted"})
+        return
+    except ImportError:
+        send({"error": "unsupported"})
+        return
+    except Exception as e:
+        send({"error": "invalid", "detail": f"{type(e).__name__}: {e}"})
+        return
+    send({"error": "empty"} if not sent else {"done": True})
+
+
+def worker_main(memory_mb: int, fallback_encoding: str):
+    """Serve jobs read as JSON lines from stdin until it closes."""
+    import resource
+    import signal
+
+    global _fallback_encoding
+    _fallback_encoding = fallback_encoding
+
+    # Ctrl+C is for the bot; it stops the workers by closing their stdin
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if memory_mb:
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    out = sys.stdout
+
+    def send(message: Dict):
+        out.write(json.dumps(message, ensure_ascii=False) + "\n")
+        out.flush()
+
+    for line in sys.stdin:
+        try:
+            _run_job(json.loads(line), send)
+        except MemoryError:
+            # Leave a fragmented heap behind; the pool starts a fresh worker
+            return
+
+
+# --- Pool: runs in the bot ---
+
+class _Worker:
+    __slots__ = ("process",)
+
+    def __init__(self, process: asyncio.subprocess.Process):
+        self.process = process
+
+    @property
+    def alive(self) -> bool:
+        return self.process.returncode is None
+
+    def kill(self):
+        if self.alive:
+            self.process.kill()
+
+
+class ExtractionPool:
+    """Worker processes started on demand; one job per worker at a time."""
+
+    def __init__(self, size: int, timeout: float, memory_mb: int, fallback_encoding: str = "cp1251"):
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.memory_mb = memory_mb
+        self.fallback_encoding = fallback_encoding
+        self.loop = asyncio.get_running_loop()
+        self._slots = asyncio.Semaphore(self.size)
+        self._idle: List[_Worker] = []
+        self._waiting = 0
+        metrics.QUEUE_DEPTH.set_function(lambda: self._waiting, queue="extractions")
+
+    async def _spawn(self) -> _Worker:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), "--worker",
+            "--memory-mb", str(self.memory_mb), "--fallback-encoding", self.fallback_encoding,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, limit=_LINE_LIMIT,
+        )
+        return _Worker(process)
+
+    async def _checkout(self) -> _Worker:
+        self._waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self._waiting -= 1
+        try:
+            while self._idle:
+                worker = self._idle.pop()
+                if worker.alive:
+                    return worker
+            return await self._spawn()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _checkin(self, worker: _Worker, reusable: bool):
+        if reusable and worker.alive:
+            self._idle.append(worker)
+        else:
+            worker.kill()
+        self._slots.release()
+
+    async def sections(self, path: str, fmt: str, max_chars: int) -> AsyncIterator[str]:
+        """Text of a document, section by section. Raises ExtractionError."""
+        worker = await self._checkout()
+        reusable = False
+        result = "abandoned"  # the caller stopped reading early
+        try:
+            job = {"path": path, "format": fmt, "max_chars": max_chars}
+            worker.process.stdin.write(json.dumps(job).encode("utf-8") + b"\n")
+            await worker.process.stdin.drain()
+
+            deadline = self.loop.time() + self.timeout
+            while True:
+                try:
+                    line = await asyncio.wait_for(worker.process.stdout.readline(),
+                                                  max(0.0, deadline - self.loop.time()))
+                except asyncio.TimeoutError:
+                    result = "timeout"
+                    raise ExtractionError(ERROR_TEXTS["timeout"])
+                except (ValueError, asyncio.LimitOverrunError):
+                    # A message over the stream limit; the worker is killed on check-in
+                    result = "invalid"
+                    raise ExtractionError(ERROR_TEXTS["invalid"])
+                if not line:
+                    # Killed by the memory limit in native code, or crashed
+                    await worker.process.wait()
+                    result = "crashed"
+                    raise ExtractionError(ERROR_TEXTS["crashed"])
+
+                message = json.loads(line)
+                if "section" in message:
+                    yield message["section"]
+                elif "error" in message:
+                    result = message["error"]
+                    reusable = result != "memory"
+                    if "detail" in message:
+                        logger.warning(f"Failed to extract {fmt} document: {message['detail']}")
+                    raise ExtractionError(ERROR_TEXTS.get(result, ERROR_TEXTS["invalid"]))
+                else:
+                    reusable = True
+                    result = "ok"
+                    return
+        finally:
+            metrics.EXTRACTIONS.inc(format=fmt, result=result)
+            self._checkin(worker, reusable)
+
+    async def close(self):
+        """Stop idle workers; busy ones are killed when their jobs end."""
+        for worker in self._idle:
+            if worker.alive:
+                worker.process.stdin.close()
+                try:
+                    await asyncio.wait_for(worker.process.wait(), 5)
+                except asyncio.TimeoutError:
+                    worker.kill()
+        self._idle.clear()
+
+
+_pool: Optional[ExtractionPool] = None
+
+
+def get_pool() -> ExtractionPool:
+    """The pool of this process and event loop, created on first use."""
+    global _pool
+    if _pool is None or _pool.loop is not asyncio.get_running_loop():
+        _pool = ExtractionPool(config.EXTRACT_WORKERS, config.EXTRACT_TIMEOUT, config.EXTRACT_MEMORY_MB,
+                               config.DOCUMENT_ENCODING)
+    return _pool
+
+
+def extract(path: str, fmt: str, max_chars: int) -> AsyncIterator[str]:
+    """Sections of a document's text (a little over max_chars at most). Raises ExtractionError."""
+    return get_pool().sections(path, fmt, max_chars)
+
+
+async def read_document(path: str, fmt: str, max_chars: int = None) -> tuple[str, bool]:
+    """Text of a document cut to max_chars, and whether it was cut."""
+    max_chars = max_chars or config.DOCUMENT_MAX_CHARS
+    parts: List[str] = []
+    size = 0
+    start = time.perf_counter()
+    sections = extract(path, fmt, max_chars)
+    try:
+        async for section in sections:
+            parts.append(section)
+            size += len(section)
+    finally:
+        await sections.aclose()
+    text = "".join(parts)
+    logger.debug(f"Extracted {len(text)} chars of {fmt} in {time.perf_counter() - start:.2f}s")
+    return text[:max_chars], len(text) > max_chars
+
+
+async def shutdown():
+    """Stop the worker processes."""
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Document text extraction worker.")
+    parser.add_argument("--worker", action="store_true", required=True)
+    parser.add_argument("--memory-mb", type=int, default=0)
+    parser.add_argument("--fallback-encoding", default="cp1251")
+    args = parser.parse_args()
+    worker_main(args.memory_mb, args.fallback_encoding)
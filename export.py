@@ -0,0 +1,153 @@
+"""/export — conversation history or token usage as a compressed file.
+
+    /export [history|usage] [jsonl|csv]            your own rows
+    /export [history|usage] [jsonl|csv] all|<id>   admins: everyone or one user
+
+Rows come from the storage export iterators in keyset batches and are
+written as they arrive into a gzip-compressed temp file by a worker
+thread, so memory stays flat however many rows there are and the event
+loop keeps serving other chats. The file is then sent as a document and
+deleted.
+"""
+import asyncio
+import csv
+import gzip
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Iterable, Optional, Sequence, Tuple
+
+from telegram import Update
+from telegram.constants import ParseMode
+from telegram.ext import Application, CommandHandler, ContextTypes
+
+from app_context import get_app
+from storage import CONVERSATION_COLUMNS, USAGE_COLUMNS, Storage
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ("jsonl", "csv")
+
+# Bot API limit for documents sent by bots
+MAX_DOCUMENT_BYTES = 50 * 1024 * 1024
+
+# Seconds allowed for uploading the file to Telegram
+UPLOAD_TIMEOUT = 300
+
+USAGE_TEXT = (
+    "📦 Использование: <code>/export [history|usage] [jsonl|csv]</code>\n"
+    "history — история разговоров, usage — расход токенов; по умолчанию history и jsonl.\n"
+    "Администратор может добавить <code>all</code> или ID пользователя."
+)
+
+
+def _export_rows(db: Storage, kind: str, user_id: Optional[int]) -> Tuple[Sequence[str], Iterable[Tuple]]:
+    if kind == "usage":
+        return USAGE_COLUMNS, db.iter_usage(user_id)
+    return CONVERSATION_COLUMNS, db.iter_conversations(user_id)
+
+
+def write_export(path: str, columns: Sequence[str], rows: Iterable[Tuple], fmt: str) -> int:
+    """Write rows to a gzip-compressed JSONL or CSV file one by one. Returns the row count."""
+    count = 0
+    with gzip.open(path, "wt", encoding="utf-8", newline="", compresslevel=6) as out:
+        if fmt == "csv":
+            writer = csv.writer(out)
+            writer.writerow(columns)
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        else:
+            for row in rows:
+                out.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+                out.write("\n")
+                count += 1
+    return count
+
+
+def _parse_args(args: Sequence[str]) -> Optional[Tuple[str, str, Optional[str]]]:
+    """(kind, format, target) from command arguments, or None if they don't parse.
+
+    target is None for the caller's own rows, "all" or a user ID.
+    """
+    kind, fmt, target = "history", "jsonl", None
+    for arg in (a.lower() for a in args):
+        if arg in ("history", "usage"):
+            kind = arg
+        elif arg in EXPORT_FORMATS:
+            fmt = arg
+        elif arg == "all" or arg.lstrip("-").isdigit():
+            target = arg
+        else:
+            return None
+    return kind, fmt, target
+
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /export."""
+    db = get_app(context).db
+    user_id = update.effective_user.id
+
+    if not db.is_authorized(user_id):
+        await update.message.reply_text("❌ У вас нет доступа к боту.")
+        return
+
+    parsed = _parse_args(context.args or [])
+    if parsed is None:
+        await update.message.reply_text(USAGE_TEXT, parse_mode=ParseMode.HTML)
+        return
+    kind, fmt, target = parsed
+
+    if target is None or target == str(user_id):
+        owner, label = user_id, str(user_id)
+    elif db.is_admin(user_id):
+        owner, label = (None, "all") if target == "all" else (int(target), target)
+    else:
+        await update.message.reply_text("❌ Выгрузка чужих данных доступна только администратору.")
+        return
+
+    if context.user_data.get("export_running"):
+        await update.message.reply_text("⏳ Предыдущая выгрузка ещё готовится.")
+        return
+    context.user_data["export_running"] = True
+
+    status = await update.message.reply_text("⏳ Готовлю выгрузку…")
+    fd, path = tempfile.mkstemp(prefix="export-", suffix=f".{fmt}.gz")
+    os.close(fd)
+    started = time.perf_counter()
+    try:
+        columns, rows = _export_rows(db, kind, owner)
+        count = await asyncio.to_thread(write_export, path, columns, rows, fmt)
+        size = os.path.getsize(path)
+        logger.info(f"Export {kind}/{fmt} for {label} by user {user_id}: {count} rows, {size} bytes "
+                    f"in {time.perf_counter() - started:.1f}s")
+
+        if size > MAX_DOCUMENT_BYTES:
+            await status.edit_text(
+                f"❌ Выгрузка слишком большая ({size / 1024 / 1024:.0f} МБ, лимит Telegram — 50 МБ). "
+                "Выгрузите данные отдельных пользователей."
+            )
+            return
+
+        filename = f"{kind}_{label}_{time.strftime('%Y%m%d')}.{fmt}.gz"
+        with open(path, "rb") as document:
+            await update.message.reply_document(
+                document=document,
+                filename=filename,
+                caption=f"📦 {kind}: {count:,} строк",
+                write_timeout=UPLOAD_TIMEOUT,
+            )
+        await status.delete()
+    except Exception as e:
+        logger.error(f"Export {kind}/{fmt} for {label} failed: {e}")
+        await status.edit_text("❌ Не удалось подготовить выгрузку.")
+    finally:
+        context.user_data.pop("export_running", None)
+        os.unlink(path)
+
+
+def register_export_handlers(application: Application):
+    """Register /export."""
+    application.add_handler(CommandHandler("export", export_command))
@@ -0,0 +1,294 @@
+"""In-memory ring buffers of recent conversation turns.
+
+Each (user, chat) gets a bounded buffer of its latest turns. Reads for
+the next Claude request are served from memory once a chat is loaded;
+writes go to the storage backend first and then to the buffer, so the
+backend remains the source of truth. Turns older than the history window
+are dropped on read, and a global byte budget evicts the least recently
+used chats. Updates for one chat are handled by one process (see
+workers.py), so a process-local cache stays consistent — within one bot
+instance. Nothing invalidates it across instances, which is why
+create_storage only caches a PostgreSQL backend when
+HISTORY_CACHE_SHARED_DB says the instance is alone on the database.
+"""
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import metrics
+from storage import HistoryRow, Storage, UserCursor, UserRow
+
+# Same window as the storage queries use
+HISTORY_WINDOW = 600
+
+Key = Tuple[int, int]
+
+
+class _Entry:
+    __slots__ = ("turns", "size")
+
+    def __init__(self, capacity: int):
+        self.turns = deque(maxlen=capacity)  # (timestamp, role, content, size)
+        self.size = 0
+
+
+def _turn_size(content: str) -> int:
+    return sys.getsizeof(content) + 64  # tuple and bookkeeping overhead
+
+
+class HistoryCache:
+    """Per-(user, chat) ring buffers under a global LRU byte budget."""
+
+    def __init__(self, max_bytes: int, capacity: int = 20, window: float = HISTORY_WINDOW):
+        self.max_bytes = max_bytes
+        self.capacity = capacity
+        self.window = window
+        self.bytes = 0
+        self._entries: "OrderedDict[Key, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Key, limit: int) -> Optional[List[Dict]]:
+        """Recent turns in chronological order, or None if the chat is not cached."""
+        if limit > self.capacity:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            cutoff = time.time() - self.window
+            while entry.turns and entry.turns[0][0] < cutoff:
+                self._drop_oldest(entry)
+            turns = list(entry.turns)[-limit:] if limit > 0 else []
+        return [{"role": role, "content": content} for _, role, content, _ in turns]
+
+    def load(self, key: Key, turns: Iterable[Tuple[float, str, str]]):
+        """Cache a chat's turns as read from storage (oldest first)."""
+        entry = _Entry(self.capacity)
+        for timestamp, role, content in turns:
+            self._push(entry, timestamp, role, content)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old.size
+            self._entries[key] = entry
+            self.bytes += entry.size
+            self._evict()
+
+    def append(self, key: Key, role: str, content: str):
+        """Add a turn that was just written to storage; no-op for uncached chats."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            before = entry.size
+            self._push(entry, time.time(), role, content)
+            self.bytes += entry.size - before
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def invalidate(self, user_id: int, chat_id: Optional[int] = None):
+        """Forget one chat of a user, or all of the user's chats."""
+        with self._lock:
+            if chat_id is not None:
+                keys = [(user_id, chat_id)]
+            else:
+                keys = [key for key in self._entries if key[0] == user_id]
+            for key in keys:
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self.bytes -= entry.size
+
+    def _push(self, entry: _Entry, timestamp: float, role: str, content: str):
+        if len(entry.turns) == entry.turns.maxlen:
+            entry.size -= entry.turns[0][3]
+        size = _turn_size(content)
+        entry.turns.append((timestamp, role, content, size))
+        entry.size += size
+
+    def _drop_oldest(self, entry: _Entry):
+        size = entry.turns.popleft()[3]
+        entry.size -= size
+        self.bytes -= size
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self.bytes -= entry.size
+
+
+class CachedStorage(Storage):
+    """Storage backend with conversation history served from a HistoryCache."""
+
+    def __init__(self, backend: Storage, cache: HistoryCache, max_summaries: int = 10_000):
+        self.backend = backend
+        self.cache = cache
+        # Rolling summaries are read on every request too; small, so kept by count
+        self.max_summaries = max_summaries
+        self._summaries: "OrderedDict[Key, Optional[Tuple[str, int]]]" = OrderedDict()
+        self._summaries_lock = threading.Lock()
+        metrics.HISTORY_CACHE_BYTES.set_function(lambda: cache.bytes)
+        metrics.HISTORY_CACHE_CHATS.set_function(lambda: len(cache))
+
+    def get_conversation_history(self, user_id: int, chat_id: int, limit: int = 20) -> List[Dict]:
+        """Get recent conversation history, loading the chat into memory on a miss."""
+        key = (user_id, chat_id)
+        messages = self.cache.get(key, limit)
+        if messages is not None:
+            metrics.HISTORY_CACHE.inc(result="hit")
+            return messages
+
+        metrics.HISTORY_CACHE.inc(result="miss")
+        if limit > self.cache.capacity:
+            return self.backend.get_conversation_history(user_id, chat_id, limit)
+        turns = self.backend.get_recent_turns(user_id, chat_id, self.cache.capacity)
+        self.cache.load(key, turns)
+        return [{"role": role, "content": content} for _, role, content in turns[-limit:]] if limit > 0 else []
+
+    def add_message_to_history(self, user_id: int, chat_id: int, role: str, content: str):
+        self.backend.add_message_to_history(user_id, chat_id, role, content)
+        self.cache.append((user_id, chat_id), role, content)
+
+    def add_messages_to_history(self, messages: Iterable[HistoryRow]):
+        messages = list(messages)
+        self.backend.add_messages_to_history(messages)
+        for user_id, chat_id, role, content in messages:
+            self.cache.append((user_id, chat_id), role, content)
+
+    def search_history(self, user_id: int, chat_id: int, query: str,
+                       limit: int = 5, offset: int = 0) -> List[Dict]:
+        return self.backend.search_history(user_id, chat_id, query, limit, offset)
+
+    def iter_conversations(self, user_id: int = None) -> Iterator[Tuple]:
+        return self.backend.iter_conversations(user_id)
+
+    def clear_conversation_history(self, user_id: int, chat_id: int = None):
+        self.backend.clear_conversation_history(user_id, chat_id)
+        self.cache.invalidate(user_id, chat_id)
+        with self._summaries_lock:
+            for key in [k for k in self._summaries if k[0] == user_id and chat_id in (None, k[1])]:
+                del self._summaries[key]
+
+    def get_summary(self, user_id: int, chat_id: int) -> Optional[Tuple[str, int]]:
+        key = (user_id, chat_id)
+        with self._summaries_lock:
+            if key in self._summaries:
+                self._summaries.move_to_end(key)
+                return self._summaries[key]
+        summary = self.backend.get_summary(user_id, chat_id)
+        self._remember_summary(key, summary)
+        return summary
+
+    def save_summary(self, user_id: int, chat_id: int, summary: str, through_id: int) -> bool:
+        saved = self.backend.save_summary(user_id, chat_id, summary, through_id)
+        if saved:
+            self._remember_summary((user_id, chat_id), (summary, through_id))
+        return saved
+
+    def _remember_summary(self, key: Key, summary: Optional[Tuple[str, int]]):
+        with self._summaries_lock:
+            self._summaries[key] = summary
+            self._summaries.move_to_end(key)
+            while len(self._summaries) > self.max_summaries:
+                self._summaries.popitem(last=False)
+
+    # Everything else goes straight to the backend
+
+    def get_recent_turns(self, user_id: int, chat_id: int, limit: int = 20) -> List[Tuple[float, str, str]]:
+        return self.backend.get_recent_turns(user_id, chat_id, limit)
+
+    def get_turns_since(self, user_id: int, chat_id: int, after_id: int,
+                        limit: int = 200) -> List[Tuple[int, float, str, str]]:
+        return self.backend.get_turns_since(user_id, chat_id, after_id, limit)
+
+    def is_authorized(self, user_id: int) -> bool:
+        return self.backend.is_authorized(user_id)
+
+    def is_admin(self, user_id: int) -> bool:
+        return self.backend.is_admin(user_id)
+
+    def add_user(self, user_id: int, username: str = None, first_name: str = None,
+                 last_name: str = None, is_authorized: bool = False):
+        self.backend.add_user(user_id, username, first_name, last_name, is_authorized)
+
+    def authorize_user(self, user_id: int):
+        self.backend.authorize_user(user_id)
+
+    def deauthorize_user(self, user_id: int):
+        self.backend.deauthorize_user(user_id)
+
+    def set_users_authorized(self, user_ids: Iterable[int], authorized: bool) -> List[int]:
+        return self.backend.set_users_authorized(user_ids, authorized)
+
+    def import_users(self, users: Iterable[UserRow], authorize: bool = True) -> int:
+        return self.backend.import_users(users, authorize)
+
+    def get_all_users(self) -> List[Dict]:
+        return self.backend.get_all_users()
+
+    def get_user(self, user_id: int) -> Optional[Dict]:
+        return self.backend.get_user(user_id)
+
+    def get_users_page(self, status: str = "all", active_days: int = None,
+                       after: UserCursor = None, before: UserCursor = None, limit: int = 20) -> List[Dict]:
+        return self.backend.get_users_page(status, active_days, after, before, limit)
+
+    def count_users(self, status: str = "all", active_days: int = None) -> int:
+        return self.backend.count_users(status, active_days)
+
+    def get_user_counts(self) -> Dict[str, int]:
+        return self.backend.get_user_counts()
+
+    def log_usage(self, user_id: int, model: str, input_tokens: int, output_tokens: int,
+                  batch: bool = False, chat_id: int = None) -> float:
+        return self.backend.log_usage(user_id, model, input_tokens, output_tokens, batch, chat_id)
+
+    def get_tokens_since(self, seconds: int, user_id: int = None, chat_id: int = None) -> int:
+        return self.backend.get_tokens_since(seconds, user_id, chat_id)
+
+    def get_total_usage(self) -> Dict:
+        return self.backend.get_total_usage()
+
+    def get_user_usage(self, user_id: int) -> Dict:
+        return self.backend.get_user_usage(user_id)
+
+    def get_usage_by_model(self, days: int = 7) -> List[Dict]:
+        return self.backend.get_usage_by_model(days)
+
+    def iter_usage(self, user_id: int = None) -> Iterator[Tuple]:
+        return self.backend.iter_usage(user_id)
+
+    def get_setting(self, key: str, default: str = None) -> Optional[str]:
+        return self.backend.get_setting(key, default)
+
+    def set_setting(self, key: str, value: str):
+        self.backend.set_setting(key, value)
+
+    def create_batch_job(self, user_id: int, chat_id: int, prompt: str) -> int:
+        return self.backend.create_batch_job(user_id, chat_id, prompt)
+
+    def get_batch_jobs(self, user_id: int = None, chat_id: int = None,
+                       statuses: Iterable[str] = None, limit: int = 20) -> List[Dict]:
+        return self.backend.get_batch_jobs(user_id, chat_id, statuses, limit)
+
+    def update_batch_job(self, job_id: int, status: str, expected_status: str = None,
+                         batch_id: str = None, model: str = None,
+                         results: Tuple[int, int, float] = None) -> bool:
+        return self.backend.update_batch_job(job_id, status, expected_status, batch_id, model, results)
+
+    def add_batch_item(self, job_id: int, title: str, content: str) -> int:
+        return self.backend.add_batch_item(job_id, title, content)
+
+    def get_batch_items(self, job_id: int) -> List[Dict]:
+        return self.backend.get_batch_items(job_id)
+
+    def save_batch_results(self, results: Iterable[Tuple[int, str, str, int, int, float]]):
+        self.backend.save_batch_results(results)
+
+    def close(self):
+        self.backend.close()
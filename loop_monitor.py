@@ -0,0 +1,208 @@
+"""Event-loop lag monitor and blocking-call detector.
+
+Every chat is served by one event loop, so a synchronous call that takes a
+second on it (a slow SQLite query, a sync HTTP request, a DNS lookup)
+delays every chat by that second. LoopMonitor makes such stalls visible:
+
+* A task wakes up every LOOP_MONITOR_INTERVAL seconds and records how late
+  it woke as bot_event_loop_lag_seconds.
+* A watchdog thread follows the task's heartbeat. When the loop has been
+  stuck for LOOP_LAG_THRESHOLD seconds, it takes the stack of the loop
+  thread — the code blocking it, caught in the act — and logs it, at most
+  once per LOOP_LAG_LOG_INTERVAL; stalls in between are counted.
+
+With LOOP_DEBUG, known blocking calls (storage methods, the Claude client,
+sync httpx, time.sleep, DNS lookups, subprocess.run) report their caller
+when made on the event loop thread instead of a worker thread, and
+asyncio's debug mode logs callbacks slower than the threshold.
+"""
+import asyncio
+import functools
+import importlib
+import inspect
+import logging
+import sys
+import threading
+import time
+import traceback
+from typing import Dict, Optional, Tuple
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Frames of the caller's stack included in a blocking-call report
+REPORT_FRAMES = 8
+
+# (module, class or None, attribute or None for every public method) patched in debug mode
+BLOCKING_CALLS = (
+    ("time", None, "sleep"),
+    ("socket", None, "getaddrinfo"),
+    ("subprocess", None, "run"),
+    ("sqlite3", None, "connect"),
+    ("httpx", "Client", "send"),
+    ("database", "Database", None),
+    ("postgres_db", "PostgresDatabase", None),
+    ("claude_client", "ClaudeClient", None),
+)
+
+
+class LoopMonitor:
+    """Measures event-loop lag and logs the loop thread's stack when it stalls."""
+
+    def __init__(self, interval: float, threshold: float, log_interval: float):
+        self.interval = interval
+        self.threshold = threshold
+        self.log_interval = log_interval
+        self._heartbeat = time.monotonic()
+        self._loop_thread: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._last_report = float("-inf")
+        self._unreported = 0
+
+    def start(self):
+        """Start measuring the running loop; with a threshold, start the watchdog as well."""
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._measure(), name="loop-monitor")
+        if self.threshold:
+            self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+            self._watchdog.start()
+
+    async def stop(self):
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._watchdog:
+            self._watchdog.join()
+
+    async def _measure(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self._heartbeat = time.monotonic()
+            metrics.EVENT_LOOP_LAG.observe(max(0.0, loop.time() - start - self.interval))
+
+    def _watch(self):
+        reported = None  # heartbeat of the stall already counted
+        check = min(self.interval, self.threshold / 2)
+        while not self._stopped.wait(check):
+            heartbeat = self._heartbeat
+            blocked = time.monotonic() - heartbeat - self.interval
+            if blocked < self.threshold or heartbeat == reported:
+                continue
+            reported = heartbeat
+            metrics.EVENT_LOOP_STALLS.inc()
+
+            now = time.monotonic()
+            if now - self._last_report < self.log_interval:
+                self._unreported += 1
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = "".join(traceback.format_stack(frame)) if frame else "  (stack unavailable)\n"
+            more = f" ({self._unreported} more stalls since the last report)" if self._unreported else ""
+            self._last_report = now
+            self._unreported = 0
+            logger.warning(f"Event loop blocked for {blocked:.2f}s{more}; loop thread is at:\n{stack}")
+
+
+# --- Debug mode: report known blocking calls made on the event loop thread ---
+
+_installed = False
+_nested = threading.local()
+_last_reports: Dict[Tuple[str, str, int], float] = {}
+
+
+def _on_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def _report(call: str):
+    """Log a blocking call with its caller, once per call site per LOOP_LAG_LOG_INTERVAL."""
+    metrics.BLOCKING_CALLS.inc(call=call)
+    caller = sys._getframe(2)
+    site = (call, caller.f_code.co_filename, caller.f_lineno)
+    now = time.monotonic()
+    if now - _last_reports.get(site, float("-inf")) < config.LOOP_LAG_LOG_INTERVAL:
+        return
+    _last_reports[site] = now
+    stack = "".join(traceback.format_stack(caller, limit=REPORT_FRAMES))
+    logger.warning(f"Blocking call {call} on the event loop thread; "
+                   f"move it to asyncio.to_thread:\n{stack}")
+
+
+def _wrap(func, call: str):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # Only the outermost known call is reported (ClaudeClient, not the httpx call inside it)
+        if getattr(_nested, "active", False) or not _on_event_loop():
+            return func(*args, **kwargs)
+        _report(call)
+        _nested.active = True
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _nested.active = False
+
+    wrapper.__wrapped_blocking__ = True
+    return wrapper
+
+
+def detect_blocking_calls():
+    """Patch BLOCKING_CALLS to report calls made on the event loop thread (once per process)."""
+    global _installed
+    if _installed:
+        return
+    _installed = True
+    for module_name, class_name, attribute in BLOCKING_CALLS:
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError:
+            continue
+        owner = getattr(module, class_name) if class_name else module
+        if attribute:
+            names = [attribute]
+        else:
+            names = [name for name, value in vars(owner).items()
+                     if not name.startswith("_") and inspect.isfunction(value)]
+        for name in names:
+            func = getattr(owner, name)
+            if not getattr(func, "__wrapped_blocking__", False):
+                setattr(owner, name, _wrap(func, f"{class_name or module_name}.{name}"))
+
+
+_monitor: Optional[LoopMonitor] = None
+
+
+async def start():
+    """Start the monitor for the running loop, and debug mode if LOOP_DEBUG is set."""
+    global _monitor
+    if config.LOOP_DEBUG:
+        loop = asyncio.get_running_loop()
+        loop.set_debug(True)
+        loop.slow_callback_duration = config.LOOP_LAG_THRESHOLD or 0.1
+        detect_blocking_calls()
+        logger.info("Event loop debug mode: reporting blocking calls on the loop thread")
+    if config.LOOP_MONITOR_INTERVAL > 0:
+        _monitor = LoopMonitor(config.LOOP_MONITOR_INTERVAL, config.LOOP_LAG_THRESHOLD,
+                               config.LOOP_LAG_LOG_INTERVAL)
+        _monitor.start()
+
+
+async def stop():
+    global _monitor
+    if _monitor:
+        await _monitor.stop()
+        _monitor = None
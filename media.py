@@ -0,0 +1,189 @@
+"""Downloaded media and request bodies without whole-file copies.
+
+Nothing on the media path holds more than one whole copy of a file:
+
+* Files up to MEDIA_SPILL_BYTES are downloaded into one bytearray and
+  used through a memoryview. Larger ones are streamed to a temporary file
+  and memory-mapped, so their pages belong to the page cache rather than
+  the heap; files a local Bot API server already has on disk are mapped
+  in place.
+* Images are put into Messages API requests as placeholders. The Claude
+  client's HTTP client serializes the request around them and base64-
+  encodes each image chunk by chunk while the body is being sent
+  (``json_body``), so no base64 copy of the image is ever held whole.
+* Uploads to other services (Whisper) stream from the file.
+
+A MediaBuffer must be closed when the request is done; that also deletes
+its temporary file.
+"""
+import base64
+import io
+import json
+import logging
+import mmap
+import os
+import re
+import tempfile
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import BinaryIO, Dict, Iterator, List, Optional, Sequence, Union
+
+import httpx
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Raw bytes base64-encoded per body chunk (a multiple of 3, so chunks join without padding)
+ENCODE_CHUNK = 3 * 64 * 1024
+
+# Seconds allowed for streaming a large file to disk
+DOWNLOAD_TIMEOUT = 120
+
+_CAN_DROP_PAGES = hasattr(mmap, "MADV_DONTNEED")
+
+_PLACEHOLDER = re.compile(r"<<media:([0-9a-f]{32})>>")
+
+
+class MediaBuffer:
+    """File contents as a bytearray or a memory-mapped file, read through ``view``."""
+
+    def __init__(self, data: Union[bytearray, mmap.mmap], path: Optional[str] = None, temporary: bool = False):
+        self._data = data
+        self.path = path
+        self._temporary = temporary
+        self.view = memoryview(data)
+
+    @classmethod
+    def map_file(cls, path: str, temporary: bool = False) -> "MediaBuffer":
+        """Map a file read-only (an empty one is read as an empty buffer)."""
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return cls(bytearray(), path, temporary)
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), path, temporary)
+
+    def __len__(self) -> int:
+        return len(self.view)
+
+    def open(self) -> BinaryIO:
+        """A file object for streaming uploads."""
+        if self.path:
+            return open(self.path, "rb")
+        return io.BytesIO(self.view)
+
+    def close(self):
+        if self.view is None:
+            return
+        self.view.release()
+        self.view = None
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._data = None
+        if self._temporary:
+            try:
+                os.unlink(self.path)
+            except OSError as e:
+                logger.warning(f"Failed to remove temporary media file {self.path}: {e}")
+
+    def __enter__(self) -> "MediaBuffer":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _is_local_file(path: Optional[str]) -> bool:
+    # A local Bot API server (--local) reports absolute paths instead of URLs
+    return bool(path) and not path.startswith(("http://", "https://")) and os.path.isfile(path)
+
+
+async def download(file, spill_bytes: Optional[int] = None) -> MediaBuffer:
+    """Download a telegram.File: into memory if small, else into a mapped temporary file."""
+    spill_bytes = config.MEDIA_SPILL_BYTES if spill_bytes is None else spill_bytes
+    if _is_local_file(file.file_path):
+        return MediaBuffer.map_file(file.file_path)
+    if file.file_size is not None and file.file_size <= spill_bytes:
+        return MediaBuffer(await file.download_as_bytearray())
+
+    fd, path = tempfile.mkstemp(prefix="media-")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            async with httpx.AsyncClient(timeout=DOWNLOAD_TIMEOUT) as client:
+                async with client.stream("GET", file.file_path) as response:
+                    response.raise_for_status()
+                    async for chunk in response.aiter_bytes():
+                        out.write(chunk)
+        return MediaBuffer.map_file(path, temporary=True)
+    except BaseException:
+        os.unlink(path)
+        raise
+
+
+def base64_length(size: int) -> int:
+    """Length of the padded base64 encoding of size bytes."""
+    return (size + 2) // 3 * 4
+
+
+# Buffers currently placed into requests, by placeholder id
+_inline: Dict[str, memoryview] = {}
+_inline_lock = threading.Lock()
+
+
+@contextmanager
+def inline_base64(images: Sequence) -> Iterator[List[str]]:
+    """Placeholders to use as base64 ``data`` of image blocks while the request is made.
+
+    ``json_body`` replaces each with the base64 of its image as the body is sent.
+    """
+    keys = [uuid.uuid4().hex for _ in images]
+    with _inline_lock:
+        _inline.update((key, memoryview(image)) for key, image in zip(keys, images))
+    try:
+        yield [f"<<media:{key}>>" for key in keys]
+    finally:
+        with _inline_lock:
+            for key in keys:
+                _inline.pop(key).release()
+
+
+class StreamedJSON:
+    """A JSON request body whose placeholders are base64-encoded as it is iterated.
+
+    Iterable more than once, so the SDK can retry the request.
+    """
+
+    def __init__(self, parts: List[bytes], images: List[memoryview]):
+        self._parts = parts    # JSON text around the placeholders
+        self._images = images  # one between each pair of parts
+        self.length = sum(map(len, parts)) + sum(base64_length(len(image)) for image in images)
+
+    def __iter__(self) -> Iterator[bytes]:
+        for part, image in zip(self._parts, self._images):
+            yield part
+            # Pages of a mapped file are dropped once encoded; they stay in the page cache
+            mapped = image.obj if _CAN_DROP_PAGES and isinstance(image.obj, mmap.mmap) else None
+            for start in range(0, len(image), ENCODE_CHUNK):
+                yield base64.b64encode(image[start:start + ENCODE_CHUNK])
+                if mapped is not None:
+                    mapped.madvise(mmap.MADV_DONTNEED, start, min(ENCODE_CHUNK, len(image) - start))
+        yield self._parts[-1]
+
+
+def json_body(payload) -> Union[bytes, StreamedJSON]:
+    """Serialize a request; one with image placeholders becomes a StreamedJSON."""
+    text = json.dumps(payload)
+    pieces = _PLACEHOLDER.split(text)
+    parts, images = [pieces[0]], []
+    with _inline_lock:
+        for key, after in zip(pieces[1::2], pieces[2::2]):
+            image = _inline.get(key)
+            if image is None:
+                # Not one of ours: user text that looks like a placeholder
+                parts[-1] += f"<<media:{key}>>{after}"
+            else:
+                images.append(image)
+                parts.append(after)
+    if not images:
+        return text.encode("utf-8")
+    return StreamedJSON([part.encode("utf-8") for part in parts], images)
@@ -0,0 +1,90 @@
+"""Albums: the updates of a Telegram media group answered as one request.
+
+Telegram delivers an album as one update per photo, sharing a
+``media_group_id`` and arriving within about a second of each other, with
+the caption on just one of them. The first photo's update takes the chat's
+turn like any other update (see update_processor.py) and its handler waits
+in ``collect`` until no new item has arrived for MEDIA_GROUP_WAIT seconds
+(or the album has the most items Telegram allows). The other photos join
+the group without waiting for the chat's turn, which the first one holds.
+Then the group is answered together — one download round, one Claude call
+and one reply per album — and a message sent after the album is answered
+after it.
+"""
+import asyncio
+from typing import Dict, List, Optional, Tuple
+
+from telegram import Update
+
+# Telegram albums hold at most ten items
+MAX_GROUP_SIZE = 10
+
+
+class _PendingGroup:
+    __slots__ = ("updates", "deadline", "full")
+
+    def __init__(self, deadline: float):
+        self.updates: List[Update] = []
+        self.deadline = deadline
+        self.full = asyncio.Event()
+
+
+def _group_key(update: Update) -> Tuple[int, str]:
+    return update.effective_chat.id, update.message.media_group_id
+
+
+class MediaGroupCollector:
+    """Album photos buffered per chat until the group is complete."""
+
+    def __init__(self, wait: float):
+        self.wait = wait
+        self._groups: Dict[Tuple[int, str], _PendingGroup] = {}
+
+    def accepts(self, update: object) -> bool:
+        """A photo of an album, while albums are collected."""
+        message = update.message if isinstance(update, Update) else None
+        return bool(self.wait > 0 and message and message.photo and message.media_group_id)
+
+    def add(self, update: Update) -> bool:
+        """Buffer an album photo (once); True if it is the group's first, which collects the group."""
+        key = _group_key(update)
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = _PendingGroup(asyncio.get_running_loop().time() + self.wait)
+            group.updates.append(update)
+            return True
+        if any(item is update for item in group.updates):
+            return group.updates[0] is update
+        group.updates.append(update)
+        # Every new item pushes the deadline back
+        group.deadline = asyncio.get_running_loop().time() + self.wait
+        if len(group.updates) >= MAX_GROUP_SIZE:
+            group.full.set()
+        return False
+
+    async def collect(self, update: Update) -> Optional[List[Update]]:
+        """For an album's first photo, wait for the rest and return all of them in order; None for the others."""
+        if not self.add(update):
+            return None
+        key = _group_key(update)
+        group = self._groups[key]
+        loop = asyncio.get_running_loop()
+        try:
+            while not group.full.is_set():
+                delay = group.deadline - loop.time()
+                if delay <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(group.full.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.discard(update)
+        return sorted(group.updates, key=lambda u: u.message.message_id)
+
+    def discard(self, update: Update):
+        """Close the group led by this update, if still open; later photos start a new one."""
+        key = _group_key(update)
+        group = self._groups.get(key)
+        if group is not None and group.updates[0] is update:
+            del self._groups[key]
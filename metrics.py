@@ -0,0 +1,332 @@
+"""Prometheus-format metrics with an optional local HTTP endpoint.
+
+Metrics are kept in process memory and rendered in the Prometheus text
+exposition format on scrape. No external service or client library is
+needed; set METRICS_PORT to expose them on http://METRICS_HOST:METRICS_PORT/metrics.
+"""
+import bisect
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from fast DB calls up to long generations
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+REGISTRY: List["_Metric"] = []
+
+
+def _escape(value: str) -> str:
+    """Escape a label value for the exposition format."""
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    """Base class for a labelled metric family."""
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], object] = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, object]) -> Tuple[str, ...]:
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in items]
+
+
+class Counter(_Metric):
+    """Monotonically increasing value."""
+
+    type = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    """Value that can go up and down, or be computed on scrape."""
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._functions: Dict[Tuple[str, ...], Callable[[], float]] = {}
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, fn: Callable[[], float], **labels):
+        """Compute the value by calling fn at scrape time (e.g. a queue's qsize)."""
+        with self._lock:
+            self._functions[self._key(labels)] = fn
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        """Increment while the block runs."""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def _samples(self) -> List[str]:
+        lines = super()._samples()
+        with self._lock:
+            functions = list(self._functions.items())
+        for key, fn in functions:
+            try:
+                value = fn()
+            except Exception as e:
+                logger.warning(f"Metric {self.name} callback failed: {e}")
+                continue
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in fixed buckets."""
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [per-bucket counts (last one is +Inf), sum, count]
+                state = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self._values[key] = state
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the block in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = [(key, (list(state[0]), state[1], state[2])) for key, state in self._values.items()]
+
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                bucket_labels = _format_labels(self.labelnames, key, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+# Metric families
+
+REQUEST_LATENCY = Histogram(
+    "bot_request_duration_seconds",
+    "End-to-end time to process an update, per handler.",
+    ("handler",),
+)
+STAGE_LATENCY = Histogram(
+    "bot_stage_duration_seconds",
+    "Time spent in each pipeline stage, per handler.",
+    ("handler", "stage"),
+)
+DEPENDENCY_LATENCY = Histogram(
+    "bot_dependency_duration_seconds",
+    "Latency of calls to external dependencies (download, claude, whisper, telegram_send, telegram_action).",
+    ("dependency",),
+)
+CLAUDE_TTFT = Histogram(
+    "bot_claude_time_to_first_token_seconds",
+    "Time from sending a Claude request to receiving the first text token.",
+    ("model",),
+)
+DB_LATENCY = Histogram(
+    "bot_db_call_duration_seconds",
+    "Latency of Database method calls.",
+    ("method",),
+)
+GENERATIONS_IN_FLIGHT = Gauge(
+    "bot_generations_in_flight",
+    "Claude generations currently running.",
+)
+EVENT_LOOP_LAG = Histogram(
+    "bot_event_loop_lag_seconds",
+    "How late the loop monitor's timer fired, i.e. how long the event loop was kept busy.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+EVENT_LOOP_STALLS = Counter(
+    "bot_event_loop_stalls_total",
+    "Times the event loop was blocked for longer than LOOP_LAG_THRESHOLD.",
+)
+BLOCKING_CALLS = Counter(
+    "bot_blocking_calls_total",
+    "Known blocking calls made on the event loop thread (LOOP_DEBUG only), by call.",
+    ("call",),
+)
+QUEUE_DEPTH = Gauge(
+    "bot_queue_depth",
+    "Items waiting in internal queues.",
+    ("queue",),
+)
+QUOTA_REJECTIONS = Counter(
+    "bot_quota_rejections_total",
+    "Requests refused by a token budget, by scope (user, chat) and limit.",
+    ("scope", "limit"),
+)
+BUSY_CHATS = Gauge(
+    "bot_busy_chats",
+    "Chats with a request in progress, shown as typing.",
+)
+HISTORY_CACHE = Counter(
+    "bot_history_cache_requests_total",
+    "Conversation history reads served from memory (hit) or storage (miss).",
+    ("result",),
+)
+HISTORY_CACHE_BYTES = Gauge(
+    "bot_history_cache_bytes",
+    "Approximate memory held by the conversation history cache.",
+)
+HISTORY_CACHE_CHATS = Gauge(
+    "bot_history_cache_chats",
+    "Chats currently held in the conversation history cache.",
+)
+SUMMARIES = Counter(
+    "bot_summaries_total",
+    "Background folds of old turns into chat summaries, by result.",
+    ("result",),
+)
+ROUTED = Counter(
+    "bot_routed_requests_total",
+    "Requests by the model they were routed to and the rule that chose it.",
+    ("model", "route"),
+)
+BATCH_JOBS = Counter(
+    "bot_batch_jobs_total",
+    "Batch jobs submitted and finished, by result.",
+    ("result",),
+)
+EXTRACTIONS = Counter(
+    "bot_document_extractions_total",
+    "Document text extractions in worker processes, by format and result.",
+    ("format", "result"),
+)
+TOKENS = Counter(
+    "bot_tokens_total",
+    "Claude tokens used, by model and direction.",
+    ("model", "direction"),
+)
+COST = Counter(
+    "bot_cost_usd_total",
+    "Estimated Claude cost in USD, by model.",
+    ("model",),
+)
+ERRORS = Counter(
+    "bot_errors_total",
+    "Errors raised while handling updates, by handler and exception class.",
+    ("handler", "error"),
+)
+
+
+def db_timed(func):
+    """Decorator recording the latency of a Database method."""
+    method = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            DB_LATENCY.observe(time.perf_counter() - start, method=method)
+
+    return wrapper
+
+
+def render() -> str:
+    """Render all registered metrics in the Prometheus text format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are frequent; keep them out of the bot log
+        pass
+
+
+def start_server(host: str, port: int) -> ThreadingHTTPServer:
+    """Serve /metrics from a daemon thread so scrapes never touch the event loop."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    logger.info(f"Metrics endpoint listening on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,610 @@
+"""Request pipeline shared by all message handlers.
+
+Every incoming message goes through the same stages:
+ingest -> prepare -> generate -> persist -> deliver.
+Modality-specific work (downloading a photo, transcribing voice,
+decoding a document) plugs in through a Modality subclass.
+"""
+import asyncio
+import logging
+import re
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import httpx
+from telegram import Message, Update
+from telegram.constants import ParseMode
+from telegram.ext import ContextTypes
+
+import config
+import documents
+import media
+import metrics
+from chat_actions import TypingIndicator
+from quotas import QuotaExceeded, QuotaManager, estimate_tokens
+import recorder
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Telegram message length limit
+MAX_MESSAGE_LENGTH = 4096
+
+UNAUTHORIZED_TEXT = (
+    "❌ У вас нет доступа к боту.\n"
+    "Ваш ID: <code>{user_id}</code>\n"
+    "Отправьте этот ID администратору."
+)
+
+
+def build_system_prompt(active_model: str, custom_prompt: str | None, summary: str | None = None) -> str:
+    """Build effective system prompt: base instructions + optional admin-set prompt.
+
+    Base always tells Claude its model identity and to answer only the latest message.
+    A rolling summary of earlier turns, if any, goes last.
+    """
+    base = (
+        f"Ты работаешь как модель {active_model} от Anthropic. "
+        "Отвечай только на последнее сообщение пользователя — "
+        "не пересказывай и не отвечай повторно на предыдущие сообщения из истории переписки."
+    )
+    if custom_prompt:
+        base = f"{base}\n\n{custom_prompt}"
+    if summary:
+        base = f"{base}\n\nКраткое содержание более ранней части этого разговора:\n{summary}"
+    return base
+
+
+def is_bot_mentioned(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """Check if bot is mentioned in a group message (via @ or reply)."""
+    # Always respond in private chats
+    if update.effective_chat.type == 'private':
+        return True
+
+    message = update.message
+    if not message:
+        return False
+
+    # Check if message is a reply to bot's message
+    if message.reply_to_message and message.reply_to_message.from_user.id == context.bot.id:
+        return True
+
+    # Check if bot is mentioned in message text
+    if message.entities and message.text:
+        for entity in message.entities:
+            if entity.type in ('mention', 'text_mention'):
+                if entity.type == 'mention':
+                    mention_text = message.text[entity.offset:entity.offset + entity.length]
+                    bot_username = context.bot.username
+                    if mention_text == f'@{bot_username}' or mention_text.lower() == f'@{bot_username.lower()}':
+                        return True
+                elif entity.type == 'text_mention' and entity.user.id == context.bot.id:
+                    return True
+
+    # Check if bot is mentioned in caption (for photos and documents)
+    if message.caption and message.caption_entities:
+        for entity in message.caption_entities:
+            if entity.type in ('mention', 'text_mention'):
+                if entity.type == 'mention':
+                    mention_text = message.caption[entity.offset:entity.offset + entity.length]
+                    bot_username = context.bot.username
+                    if mention_text == f'@{bot_username}' or mention_text.lower() == f'@{bot_username.lower()}':
+                        return True
+                elif entity.type == 'text_mention' and entity.user.id == context.bot.id:
+                    return True
+
+    return False
+
+
+def split_message(text: str, max_length: int = MAX_MESSAGE_LENGTH) -> list[str]:
+    """Split long message into chunks that fit Telegram's limit."""
+    if len(text) <= max_length:
+        return [text]
+
+    chunks = []
+    current_chunk = ""
+
+    # Split by paragraphs first
+    paragraphs = text.split('\n\n')
+
+    for paragraph in paragraphs:
+        # If single paragraph is too long, split by sentences
+        if len(paragraph) > max_length:
+            sentences = paragraph.split('. ')
+            for sentence in sentences:
+                if len(current_chunk) + len(sentence) + 2 < max_length:
+                    current_chunk += sentence + '. '
+                else:
+                    if current_chunk:
+                        chunks.append(current_chunk.strip())
+                    current_chunk = sentence + '. '
+        else:
+            # Try to add paragraph to current chunk
+            if len(current_chunk) + len(paragraph) + 2 < max_length:
+                current_chunk += paragraph + '\n\n'
+            else:
+                if current_chunk:
+                    chunks.append(current_chunk.strip())
+                current_chunk = paragraph + '\n\n'
+
+    # Add remaining text
+    if current_chunk:
+        chunks.append(current_chunk.strip())
+
+    return chunks if chunks else [text[:max_length]]
+
+
+def convert_markdown_to_html(text: str) -> str:
+    """Convert Markdown formatting to Telegram HTML."""
+    # Code blocks ``` (process first to avoid affecting ** inside)
+    text = re.sub(r'```(.*?)```', r'<pre>\1</pre>', text, flags=re.DOTALL)
+
+    # Inline code `
+    text = re.sub(r'`([^`]+)`', r'<code>\1</code>', text)
+
+    # Bold text **
+    text = re.sub(r'\*\*([^\*]+)\*\*', r'<b>\1</b>', text)
+
+    # Italic * (single asterisks, but not inside words)
+    text = re.sub(r'(?<!\*)\*(?!\*)([^\*]+)\*(?!\*)', r'<i>\1</i>', text)
+
+    return text
+
+
+@contextmanager
+def track_dependency(dependency: str, **attributes):
+    """Time a call to an external dependency as a metric and a trace span."""
+    with tracing.span(dependency, **attributes) as span:
+        with metrics.DEPENDENCY_LATENCY.time(dependency=dependency):
+            yield span
+
+
+class PipelineAbort(Exception):
+    """Stop processing an update and reply to the user with the given text."""
+
+
+class RequestContext:
+    """State carried through the pipeline stages for a single update."""
+
+    def __init__(self, update: Update, context: ContextTypes.DEFAULT_TYPE, modality: "Modality",
+                 group: Optional[List[Update]] = None):
+        self.update = update
+        self.context = context
+        self.modality = modality
+        self.message = update.message
+        # All messages of a media group, in order; just the one message otherwise
+        self.messages: List[Message] = [u.message for u in group] if group else [update.message]
+        self.user = update.effective_user
+        self.user_id = update.effective_user.id
+        self.chat_id = update.effective_chat.id
+
+        # Filled by the modality during ingest
+        self.prompt_text = ""      # latest user turn as sent to Claude
+        self.history_text = ""     # latest user turn as stored in history
+        self.turn_prefix = ""      # label put before both after routing, so hints see the user's own words
+        self.attachment = None     # list of image buffers, document text, etc.
+        self.buffers: List[media.MediaBuffer] = []  # downloaded files, closed when the request ends
+        self.preface: List[str] = []  # HTML messages sent before the response
+
+        # Filled by the shared stages
+        self.history: List[Dict] = []
+        self.model = ""
+        self.default_model = ""    # active model, used if the routed one fails
+        self.route = "default"     # routing rule that picked the model
+        self.summary: Optional[str] = None
+        self.system_prompt = ""
+        self.response_text = ""
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cost = 0.0
+
+        self.outcome = "ok"  # ok, unauthorized, rejected, aborted or error
+        self.timings: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time a pipeline stage and record its duration in seconds."""
+        start = time.perf_counter()
+        try:
+            with tracing.span(name):
+                yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timings[name] = elapsed
+            metrics.STAGE_LATENCY.observe(elapsed, handler=self.modality.name, stage=name)
+
+    def format_timings(self) -> str:
+        """Render stage timings for the log line."""
+        return " ".join(f"{name}={seconds * 1000:.0f}ms" for name, seconds in self.timings.items())
+
+
+class Modality:
+    """Base class for modality-specific pipeline hooks (plain text by default)."""
+
+    name = "text"
+    label = "Text"
+    history_limit = 10  # raw turns sent when summaries are off
+    error_text = "❌ Произошла ошибка при обработке сообщения"
+
+    def check(self, ctx: RequestContext) -> Optional[str]:
+        """Validate the update before any work starts. Returns an error reply or None."""
+        return None
+
+    async def ingest(self, ctx: RequestContext):
+        """Extract the user's turn (and any attachment) from the update."""
+        ctx.prompt_text = ctx.message.text
+        ctx.history_text = ctx.message.text
+
+    def generate(self, claude, ctx: RequestContext) -> tuple[str, int, int]:
+        """Call Claude for this modality."""
+        return claude.send_message(ctx.history, ctx.system_prompt, model=ctx.model)
+
+    def error_reply(self, error: Exception) -> str:
+        """User-facing text for an unexpected error."""
+        return f"{self.error_text}:\n{str(error)}"
+
+
+class TextModality(Modality):
+    """Plain text messages."""
+
+
+class PhotoModality(Modality):
+    """Photos: the largest size is downloaded and sent as an image block.
+
+    An album arrives as one update per photo; the handler collects them
+    (see media_groups.py) and they go through here as a single request,
+    all photos downloaded concurrently and sent in one Claude call.
+    """
+
+    name = "photo"
+    label = "Image"
+    error_text = "❌ Произошла ошибка при обработке изображения"
+
+    async def ingest(self, ctx: RequestContext):
+        photos = [message.photo[-1] for message in ctx.messages]
+        downloads = await asyncio.gather(*(self._download(photo) for photo in photos), return_exceptions=True)
+        # Whatever did download is closed with the request even if another photo failed
+        ctx.buffers.extend(d for d in downloads if isinstance(d, media.MediaBuffer))
+        failed = next((d for d in downloads if isinstance(d, BaseException)), None)
+        if failed:
+            raise failed
+        ctx.attachment = [buffer.view for buffer in downloads]
+
+        # Telegram puts an album's caption on one of its messages, not always the first
+        caption = next((message.caption for message in ctx.messages if message.caption), None)
+        if len(photos) == 1:
+            caption = caption or "Что изображено на этой картинке?"
+            ctx.history_text = f"[Image] {caption}"
+        else:
+            caption = caption or "Что изображено на этих картинках?"
+            ctx.history_text = f"[Images: {len(photos)}] {caption}"
+        ctx.prompt_text = caption
+
+    async def _download(self, photo) -> media.MediaBuffer:
+        with track_dependency("download", kind="photo", size=photo.file_size):
+            return await media.download(await photo.get_file())
+
+    def generate(self, claude, ctx: RequestContext) -> tuple[str, int, int]:
+        return claude.send_message_with_images(
+            ctx.history, ctx.attachment, "jpeg", ctx.system_prompt, model=ctx.model
+        )
+
+
+class VoiceModality(Modality):
+    """Voice and audio messages, transcribed by the Whisper server."""
+
+    name = "voice"
+    label = "Voice"
+    error_text = "❌ Произошла ошибка при обработке голосового сообщения"
+
+    async def ingest(self, ctx: RequestContext):
+        voice = ctx.message.voice or ctx.message.audio
+        with track_dependency("download", kind="voice", size=voice.file_size):
+            file = await ctx.context.bot.get_file(voice.file_id)
+            # Always on disk, so the upload below streams from the file
+            audio = await media.download(file, spill_bytes=0)
+            ctx.buffers.append(audio)
+
+        # Send to Whisper for transcription
+        with track_dependency("whisper", size=len(audio)), audio.open() as upload:
+            async with httpx.AsyncClient() as client:
+                r = await client.post(
+                    f"{config.WHISPER_URL}/transcribe",
+                    files={"file": ("voice.ogg", upload, "audio/ogg")},
+                    timeout=60,
+                )
+        r.raise_for_status()
+        transcribed_text = r.json()["text"].strip()
+
+        if not transcribed_text:
+            raise PipelineAbort("❌ Не удалось распознать речь.")
+
+        logger.info(f"User {ctx.user_id} - Voice transcribed: {transcribed_text[:100]}")
+
+        ctx.prompt_text = transcribed_text
+        ctx.history_text = transcribed_text
+        ctx.turn_prefix = "[Голосовое сообщение]: "
+        ctx.preface.append(f"🎤 <i>{transcribed_text}</i>")
+
+    def error_reply(self, error: Exception) -> str:
+        if isinstance(error, httpx.HTTPError):
+            return "❌ Ошибка связи с Whisper сервером."
+        return super().error_reply(error)
+
+
+class DocumentModality(Modality):
+    """Documents whose text is extracted in worker processes and inlined into the prompt."""
+
+    name = "document"
+    label = "Document"
+    history_limit = 5
+    error_text = "❌ Произошла ошибка при обработке документа"
+
+    def check(self, ctx: RequestContext) -> Optional[str]:
+        return documents.check_document(ctx.message.document)
+
+    async def ingest(self, ctx: RequestContext):
+        document = ctx.message.document
+        fmt = documents.detect_format(document.mime_type, document.file_name)
+        with track_dependency("download", kind="document", size=document.file_size):
+            doc_file = await document.get_file()
+            # Always on disk: workers read the file by path
+            doc = await media.download(doc_file, spill_bytes=0)
+        ctx.buffers.append(doc)
+        if not doc.path:
+            raise PipelineAbort(documents.ERROR_TEXTS["empty"])
+
+        try:
+            with track_dependency("extract", format=fmt):
+                text, truncated = await documents.read_document(doc.path, fmt)
+        except documents.ExtractionError as e:
+            raise PipelineAbort(str(e))
+        if truncated:
+            ctx.preface.append(
+                f"✂️ <i>Документ длинный: в запрос вошли первые {len(text):,} символов.</i>"
+            )
+        ctx.attachment = text
+
+        caption = ctx.message.caption or "Проанализируй этот документ"
+        ctx.prompt_text = caption
+        ctx.history_text = f"[Document: {document.file_name}] {caption}"
+
+    def generate(self, claude, ctx: RequestContext) -> tuple[str, int, int]:
+        return claude.send_message_with_document(
+            ctx.history, ctx.attachment, ctx.system_prompt, model=ctx.model
+        )
+
+
+class Pipeline:
+    """Runs an update through ingest, prepare, generate, persist and deliver."""
+
+    def __init__(self, db, claude, summarizer=None, router=None, typing: TypingIndicator = None,
+                 quotas: QuotaManager = None):
+        self.db = db
+        self.claude = claude
+        self.summarizer = summarizer
+        self.router = router
+        self.typing = typing or TypingIndicator()
+        self.quotas = quotas
+
+    def get_active_model(self) -> str:
+        """Get the currently active Claude model from settings, falling back to config default."""
+        return self.db.get_setting('active_model') or config.CLAUDE_MODEL
+
+    async def run(self, update: Update, context: ContextTypes.DEFAULT_TYPE, modality: Modality,
+                  group: Optional[List[Update]] = None):
+        """Process one update end to end.
+
+        ``group`` is every update of a media group (``update`` among them),
+        answered together as one request.
+        """
+        # In groups, only respond if bot is mentioned
+        if not is_bot_mentioned(update, context):
+            for item in group or [update]:
+                recorder.record(item, modality.name, "ignored")
+            return
+
+        ctx = RequestContext(update, context, modality, group)
+        with tracing.trace(
+            "update",
+            update_id=update.update_id,
+            handler=modality.name,
+            user_id=ctx.user_id,
+            chat_id=ctx.chat_id,
+        ) as root:
+            try:
+                await self._run(ctx, root)
+            except Exception as e:
+                # Failures before the request is under way (authorization, user update, checks)
+                await self._fail(ctx, root, e)
+
+        recorder.record(
+            update, modality.name, ctx.outcome, ctx.timings,
+            model=ctx.model or None, input_tokens=ctx.input_tokens, output_tokens=ctx.output_tokens,
+        )
+        for item in group or []:
+            if item is not update:
+                recorder.record(item, modality.name, "grouped")
+
+    async def _run(self, ctx: RequestContext, root):
+        modality = ctx.modality
+        start = time.perf_counter()
+
+        if not self.db.is_authorized(ctx.user_id):
+            ctx.outcome = "unauthorized"
+            await ctx.message.reply_text(
+                UNAUTHORIZED_TEXT.format(user_id=ctx.user_id),
+                parse_mode=ParseMode.HTML
+            )
+            return
+
+        # Update last active
+        user = ctx.user
+        self.db.add_user(user.id, user.username, user.first_name, user.last_name, is_authorized=True)
+
+        rejection = modality.check(ctx)
+        if rejection:
+            ctx.outcome = "rejected"
+            await ctx.message.reply_text(rejection)
+            return
+
+        # Show typing until the reply is out; concurrent requests in a chat share it
+        await self.typing.acquire(ctx.context.bot, ctx.chat_id)
+
+        try:
+            with ctx.stage("ingest"):
+                await modality.ingest(ctx)
+            with ctx.stage("prepare"):
+                self.prepare(ctx)
+            await self.generate_fairly(ctx)
+            with ctx.stage("persist"):
+                self.persist(ctx)
+            with ctx.stage("deliver"):
+                await self.deliver(ctx)
+            if self.summarizer:
+                self.summarizer.schedule(ctx.user_id, ctx.chat_id)
+
+            root.set(model=ctx.model, route=ctx.route, input_tokens=ctx.input_tokens, output_tokens=ctx.output_tokens)
+            trace_id = tracing.current_trace_id()
+            logger.info(
+                f"User {ctx.user_id} - {modality.label} - "
+                f"Model: {ctx.model} ({ctx.route}), Tokens: {ctx.input_tokens}+{ctx.output_tokens}, Cost: ${ctx.cost:.4f}, "
+                f"Stages: {ctx.format_timings()}"
+                + (f", Trace: {trace_id}" if trace_id else "")
+            )
+
+        except QuotaExceeded as e:
+            ctx.outcome = "rejected"
+            await ctx.message.reply_text(str(e))
+        except PipelineAbort as e:
+            ctx.outcome = "aborted"
+            await ctx.message.reply_text(str(e))
+        except Exception as e:
+            await self._fail(ctx, root, e)
+        finally:
+            for buffer in ctx.buffers:
+                buffer.close()
+            self.typing.release(ctx.chat_id)
+            metrics.REQUEST_LATENCY.observe(time.perf_counter() - start, handler=modality.name)
+
+    async def _fail(self, ctx: RequestContext, root, error: Exception):
+        """Count an unexpected error and tell the user."""
+        modality = ctx.modality
+        ctx.outcome = "error"
+        root.set_error(error)
+        metrics.ERRORS.inc(handler=modality.name, error=type(error).__name__)
+        logger.error(f"Error handling {modality.name}: {error} (stages: {ctx.format_timings()})")
+        try:
+            await ctx.message.reply_text(modality.error_reply(error))
+        except Exception as e:
+            logger.error(f"Could not send the error reply: {e}")
+
+    def prepare(self, ctx: RequestContext):
+        """Load chat history, pick the model and build the system prompt."""
+        # With summaries on, the raw window must be exactly the turns the
+        # summarizer never folds, or turns get dropped or sent twice
+        limit = self.summarizer.keep_turns if self.summarizer else ctx.modality.history_limit
+        ctx.history = self.db.get_conversation_history(ctx.user_id, ctx.chat_id, limit=limit)
+
+        ctx.default_model = self.get_active_model()
+        if self.router:
+            ctx.model, ctx.route = self.router.route(ctx, ctx.default_model)
+        else:
+            ctx.model = ctx.default_model
+        metrics.ROUTED.inc(model=ctx.model, route=ctx.route)
+        ctx.prompt_text = ctx.turn_prefix + ctx.prompt_text
+        ctx.history_text = ctx.turn_prefix + ctx.history_text
+        ctx.history.append({"role": "user", "content": ctx.prompt_text})
+
+        summary = self.db.get_summary(ctx.user_id, ctx.chat_id) if self.summarizer else None
+        ctx.summary = summary[0] if summary else None
+        ctx.system_prompt = build_system_prompt(ctx.model, self.db.get_setting('system_prompt'), ctx.summary)
+
+    async def generate_fairly(self, ctx: RequestContext):
+        """Admit the request past the token budgets, wait for a fair-share slot and generate.
+
+        The Claude call runs in a thread, so waiting requests and other chats
+        keep being served meanwhile.
+        """
+        if not self.quotas:
+            with ctx.stage("generate"):
+                await asyncio.to_thread(self.generate, ctx)
+            return
+
+        admission = self.quotas.admit(ctx.user_id, ctx.chat_id, estimate_tokens(ctx.history, ctx.attachment))
+        try:
+            with ctx.stage("queue"):
+                await admission.wait()
+            with ctx.stage("generate"):
+                await asyncio.to_thread(self.generate, ctx)
+        finally:
+            admission.release()
+
+    def generate(self, ctx: RequestContext):
+        """Call Claude and convert its Markdown to Telegram HTML.
+
+        A request routed away from the active model is retried on it once if it fails.
+        """
+        with metrics.GENERATIONS_IN_FLIGHT.track_inprogress():
+            try:
+                response_text, ctx.input_tokens, ctx.output_tokens = ctx.modality.generate(self.claude, ctx)
+            except Exception as e:
+                if ctx.model == ctx.default_model:
+                    raise
+                logger.warning(
+                    f"User {ctx.user_id} - model {ctx.model} ({ctx.route}) failed, "
+                    f"retrying with {ctx.default_model}: {e}"
+                )
+                metrics.ROUTED.inc(model=ctx.default_model, route="fallback")
+                ctx.model, ctx.route = ctx.default_model, "fallback"
+                ctx.system_prompt = build_system_prompt(
+                    ctx.model, self.db.get_setting('system_prompt'), ctx.summary
+                )
+                response_text, ctx.input_tokens, ctx.output_tokens = ctx.modality.generate(self.claude, ctx)
+        ctx.response_text = convert_markdown_to_html(response_text)
+
+    def persist(self, ctx: RequestContext):
+        """Save both turns to history and log usage."""
+        self.db.add_messages_to_history([
+            (ctx.user_id, ctx.chat_id, "user", ctx.history_text),
+            (ctx.user_id, ctx.chat_id, "assistant", ctx.response_text),
+        ])
+        ctx.cost = self.db.log_usage(ctx.user_id, ctx.model, ctx.input_tokens, ctx.output_tokens,
+                                     chat_id=ctx.chat_id)
+        if self.quotas:
+            self.quotas.charge(ctx.user_id, ctx.chat_id, ctx.input_tokens + ctx.output_tokens)
+
+        metrics.TOKENS.inc(ctx.input_tokens, model=ctx.model, direction="input")
+        metrics.TOKENS.inc(ctx.output_tokens, model=ctx.model, direction="output")
+        metrics.COST.inc(ctx.cost, model=ctx.model)
+
+    async def deliver(self, ctx: RequestContext):
+        """Send preface messages, then the response split into Telegram-sized chunks."""
+        for text in ctx.preface:
+            await self.reply(ctx, text, parse_mode=ParseMode.HTML)
+
+        message_chunks = split_message(ctx.response_text)
+
+        for i, chunk in enumerate(message_chunks):
+            # Small delay between chunks to look more natural
+            if i > 0:
+                await asyncio.sleep(0.5)
+
+            try:
+                await self.reply(ctx, chunk, parse_mode=ParseMode.HTML)
+            except Exception as parse_error:
+                # HTML parsing or length error, send as plain text
+                metrics.ERRORS.inc(handler=ctx.modality.name, error=type(parse_error).__name__)
+                logger.warning(f"Message send error for user {ctx.user_id} ({ctx.modality.name}): {parse_error}")
+                try:
+                    await self.reply(ctx, chunk)
+                except Exception as e:
+                    # If still fails, truncate
+                    logger.error(f"Failed to send chunk {i+1}: {e}")
+                    await self.reply(ctx, chunk[:MAX_MESSAGE_LENGTH])
+
+    async def reply(self, ctx: RequestContext, text: str, **kwargs):
+        """Send one reply to the user's message."""
+        with track_dependency("telegram_send", chars=len(text)):
+            return await ctx.message.reply_text(text, **kwargs)
@@ -277,7 +277,7 @@ pct exec $CT_ID -- mkdir -p $INSTALL_DIR
 # Option 1: Download from GitHub (if available)
 if curl -fsSL "$REPO_RAW_URL/bot.py" &>/dev/null; then
     print_info "Downloading bot files from GitHub..."
-    for file in bot.py admin.py config.py database.py claude_client.py requirements.txt; do
+    for file in bot.py admin.py app_context.py config.py database.py claude_client.py pipeline.py chat_actions.py media_groups.py media.py documents.py loop_monitor.py update_processor.py search.py export.py metrics.py tracing.py recorder.py workers.py startup_profile.py storage.py postgres_db.py history_cache.py summarizer.py batches.py router.py quotas.py requirements.txt; do
         pct exec $CT_ID -- curl -fsSL "$REPO_RAW_URL/$file" -o "$INSTALL_DIR/$file"
         print_info "Downloaded: $file"
     done
@@ -0,0 +1,298 @@
+"""Per-user and per-chat token budgets and fair-share scheduling of generations.
+
+Budgets. Every user and every chat has a token bucket per window (hour and
+day) that holds up to the window's limit and refills continuously at
+limit / window. A request is admitted while its estimated size fits in each
+bucket (one larger than a whole budget needs a full bucket); the tokens it
+actually used are charged afterwards, so a bucket can go into debt. Buckets
+live in memory: the first time a user or chat is seen after a restart, its
+level is rebuilt from the tokens usage_stats recorded in the window.
+Only the budgets refuse requests.
+
+Fair share. At most MAX_CONCURRENT_GENERATIONS run at once. When all slots
+are busy, waiting requests are served by start-time fair queuing instead of
+arrival order: each user's virtual finish time advances by the request's
+estimated tokens / weight, and the waiting request with the earliest virtual
+start goes next. A user pasting 1 MB documents in a loop only queues behind
+themselves; a light user's short question takes the next free slot.
+A user already running ``concurrent`` generations has their next request
+wait in this queue, under their weight, until one of them finishes. Chats
+have no such limit: a chat's updates are answered one at a time anyway
+(see update_processor.py).
+
+Limits come from config (QUOTA_*), overridden by the admin-editable
+``quota_limits`` setting (JSON, see /limits):
+
+    {"users": {"hour": 200000, "day": 1000000, "concurrent": 2},
+     "chats": {"hour": 500000},
+     "user:42": {"day": 0, "weight": 3},
+     "chat:-100123": {"hour": 50000}}
+
+0 means unlimited; concurrent and weight (default 1) apply to users only. In WORKERS mode
+every process keeps its own buckets, so a user active in chats handled by
+several workers gets up to that many budgets.
+"""
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+WINDOWS = {"hour": 3600, "day": 86400}
+WINDOW_NAMES = {"hour": "час", "day": "сутки"}
+LIMIT_KEYS = ("hour", "day", "concurrent", "weight")
+SCOPES = ("user", "chat")
+
+# Rough token counts for requests that haven't been sent yet
+CHARS_PER_TOKEN = 4
+IMAGE_TOKENS = 1600
+OUTPUT_ESTIMATE = 500
+
+# Buckets and fair-share tags kept in memory before idle ones are pruned
+MAX_TRACKED = 10_000
+
+
+def estimate_tokens(history: List[Dict], attachment=None) -> int:
+    """Approximate tokens of a request: its history, attachment and a typical reply."""
+    chars = sum(len(turn["content"]) for turn in history if isinstance(turn.get("content"), str))
+    tokens = OUTPUT_ESTIMATE
+    if isinstance(attachment, str):
+        chars += len(attachment)
+    elif isinstance(attachment, list):
+        tokens += IMAGE_TOKENS * len(attachment)
+    elif attachment:
+        tokens += IMAGE_TOKENS
+    return tokens + chars // CHARS_PER_TOKEN
+
+
+def parse_limits(text: str) -> Dict[str, Dict[str, int]]:
+    """Parse and validate the quota_limits setting. Raises ValueError with a readable message."""
+    try:
+        limits = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"некорректный JSON: {e}")
+    if not isinstance(limits, dict):
+        raise ValueError("ожидается объект")
+    for target, values in limits.items():
+        scope, _, target_id = target.partition(":")
+        if target not in ("users", "chats") and not (scope in SCOPES and target_id.lstrip("-").isdigit()):
+            raise ValueError(f"{target}: ожидается users, chats, user:<id> или chat:<id>")
+        if not isinstance(values, dict):
+            raise ValueError(f"{target}: ожидается объект")
+        unknown = set(values) - set(LIMIT_KEYS)
+        if unknown:
+            raise ValueError(f"{target}: неизвестные ключи {', '.join(sorted(unknown))}")
+        for key, value in values.items():
+            if not isinstance(value, int) or value < 0:
+                raise ValueError(f"{target}: {key} должно быть неотрицательным числом")
+        if values.get("weight") == 0:
+            raise ValueError(f"{target}: weight должен быть больше нуля")
+    return limits
+
+
+def default_limits(scope: str) -> Dict[str, int]:
+    """Limits from config for users or chats."""
+    if scope == "user":
+        return {"hour": config.QUOTA_USER_TOKENS_HOUR, "day": config.QUOTA_USER_TOKENS_DAY,
+                "concurrent": config.QUOTA_USER_CONCURRENT, "weight": 1}
+    return {"hour": config.QUOTA_CHAT_TOKENS_HOUR, "day": config.QUOTA_CHAT_TOKENS_DAY}
+
+
+def _format_wait(seconds: float) -> str:
+    minutes = max(1, round(seconds / 60))
+    if minutes < 60:
+        return f"{minutes} мин."
+    return f"{minutes // 60} ч. {minutes % 60} мин."
+
+
+class QuotaExceeded(Exception):
+    """A request was refused by a budget; the message is the reply to the user."""
+
+
+class TokenBucket:
+    __slots__ = ("level", "updated")
+
+    def __init__(self, level: float, now: float):
+        self.level = level
+        self.updated = now
+
+    def refill(self, capacity: int, window: int, now: float) -> float:
+        self.level = min(capacity, self.level + (now - self.updated) * capacity / window)
+        self.updated = now
+        return self.level
+
+
+class FairScheduler:
+    """Generation slots handed out by start-time fair queuing between users."""
+
+    def __init__(self, slots: int):
+        self.slots = max(1, slots)
+        self.busy = 0
+        self._virtual_time = 0.0
+        self._finish: Dict[int, float] = {}
+        self._running: Dict[int, int] = {}  # user -> generations holding a slot
+        # (virtual start, arrival, user, user's concurrency limit, future)
+        self._waiting: List[Tuple[float, int, int, int, asyncio.Future]] = []
+        self._order = itertools.count()
+        metrics.QUEUE_DEPTH.set_function(lambda: len(self._waiting), queue="generations")
+
+    async def acquire(self, user_id: int, cost: float, weight: float = 1.0, limit: int = 0):
+        """Wait for a slot, and with a limit until the user holds fewer than that many.
+
+        The user's next request starts cost / weight later in virtual time.
+        """
+        start = max(self._virtual_time, self._finish.get(user_id, 0.0))
+        self._finish[user_id] = start + cost / weight
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (start, next(self._order), user_id, limit, future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Cancelled after the slot was handed over: pass it on
+            if future.done() and not future.cancelled():
+                self.release(user_id)
+            raise
+
+    def release(self, user_id: int):
+        """Free the user's slot and hand it to the waiting request with the earliest virtual start."""
+        self.busy -= 1
+        running = self._running.pop(user_id) - 1
+        if running:
+            self._running[user_id] = running
+        self._dispatch()
+        if len(self._finish) > MAX_TRACKED:
+            self._finish = {user_id: finish for user_id, finish in self._finish.items()
+                            if finish > self._virtual_time}
+
+    def _dispatch(self):
+        """Start waiting requests in virtual-start order while slots are free, skipping users at their limit."""
+        held = []
+        while self.busy < self.slots and self._waiting:
+            entry = heapq.heappop(self._waiting)
+            start, _, user_id, limit, future = entry
+            if future.cancelled():
+                continue
+            if limit and self._running.get(user_id, 0) >= limit:
+                held.append(entry)
+                continue
+            self.busy += 1
+            self._running[user_id] = self._running.get(user_id, 0) + 1
+            self._virtual_time = start
+            future.set_result(None)
+        for entry in held:
+            heapq.heappush(self._waiting, entry)
+
+
+class Admission:
+    """A request that passed the budgets; holds its generation slot until released."""
+
+    def __init__(self, manager: "QuotaManager", user_id: int, cost: int, weight: int, concurrent: int):
+        self.manager = manager
+        self.user_id = user_id
+        self.cost = cost
+        self.weight = weight
+        self.concurrent = concurrent
+        self._slot = False
+        self._released = False
+
+    async def wait(self):
+        """Wait for a generation slot within the user's concurrency limit."""
+        await self.manager.scheduler.acquire(self.user_id, self.cost, self.weight, self.concurrent)
+        self._slot = True
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        if self._slot:
+            self.manager.scheduler.release(self.user_id)
+
+
+class QuotaManager:
+    """Token buckets per user and chat, and the generation scheduler."""
+
+    def __init__(self, db, slots: int = None):
+        self.db = db
+        self.scheduler = FairScheduler(slots or config.MAX_CONCURRENT_GENERATIONS)
+        self._buckets: Dict[Tuple[str, int, str], TokenBucket] = {}
+        self._cached: Tuple[Optional[str], Dict] = (None, {})
+
+    def overrides(self) -> Dict[str, Dict[str, int]]:
+        """The admin's quota_limits setting (empty if unset or invalid)."""
+        raw = self.db.get_setting('quota_limits') or ""
+        if raw != self._cached[0]:
+            try:
+                self._cached = (raw, parse_limits(raw) if raw else {})
+            except ValueError as e:
+                logger.warning(f"Ignoring invalid quota_limits: {e}")
+                self._cached = (raw, {})
+        return self._cached[1]
+
+    def limits(self, scope: str, target_id: int) -> Dict[str, int]:
+        """Effective limits: config, then the admin's defaults for the scope, then the target's own."""
+        overrides = self.overrides()
+        limits = default_limits(scope)
+        limits.update(overrides.get(f"{scope}s", {}))
+        limits.update(overrides.get(f"{scope}:{target_id}", {}))
+        return limits
+
+    def admit(self, user_id: int, chat_id: int, estimate: int) -> Admission:
+        """Check the token budgets for a request. Raises QuotaExceeded.
+
+        The concurrency limit is not checked here: the request waits for it in the scheduler.
+        """
+        now = time.monotonic()
+        user_limits = self.limits("user", user_id)
+        for scope, target_id, limits in (("user", user_id, user_limits),
+                                         ("chat", chat_id, self.limits("chat", chat_id))):
+            for window, seconds in WINDOWS.items():
+                capacity = limits[window]
+                if not capacity:
+                    continue
+                level = self._bucket(scope, target_id, window, capacity, now).refill(capacity, seconds, now)
+                needed = min(estimate, capacity)
+                if level < needed:
+                    metrics.QUOTA_REJECTIONS.inc(scope=scope, limit=window)
+                    owner = "этого чата" if scope == "chat" else "ваш"
+                    raise QuotaExceeded(
+                        f"⏳ Исчерпан {owner} лимит токенов за {WINDOW_NAMES[window]} ({capacity:,}). "
+                        f"Попробуйте через {_format_wait((needed - level) * seconds / capacity)}"
+                    )
+
+        return Admission(self, user_id, estimate, user_limits["weight"] or 1, user_limits["concurrent"])
+
+    def charge(self, user_id: int, chat_id: int, tokens: int):
+        """Take the tokens a finished request used from its user's and chat's buckets."""
+        now = time.monotonic()
+        for scope, target_id in (("user", user_id), ("chat", chat_id)):
+            limits = self.limits(scope, target_id)
+            for window, seconds in WINDOWS.items():
+                if limits[window]:
+                    bucket = self._bucket(scope, target_id, window, limits[window], now)
+                    bucket.refill(limits[window], seconds, now)
+                    bucket.level -= tokens
+        if len(self._buckets) > MAX_TRACKED:
+            self._prune(now)
+
+    def _bucket(self, scope: str, target_id: int, window: str, capacity: int, now: float) -> TokenBucket:
+        key = (scope, target_id, window)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            # First sight since the restart: count what the window has already used
+            used = self.db.get_tokens_since(WINDOWS[window], **{f"{scope}_id": target_id})
+            bucket = self._buckets[key] = TokenBucket(capacity - used, now)
+        return bucket
+
+    def _prune(self, now: float):
+        """Forget buckets idle for a whole window; storage has nothing left to rebuild them from."""
+        for key, bucket in list(self._buckets.items()):
+            if now - bucket.updated >= WINDOWS[key[2]]:
+                del self._buckets[key]
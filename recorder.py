@@ -0,0 +1,111 @@
+"""Opt-in recorder of anonymized incoming traffic for load replay.
+
+When RECORD_FILE is set, every message that reaches the pipeline is
+written as one JSON line: its kind, sizes and shape (never its text or
+file contents), salted hashes instead of user and chat IDs, the outcome,
+and per-stage timings. ``python -m benchmarks.replay`` feeds a recording
+back into the bot against local stand-ins.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Dict, Optional
+
+from telegram import Update
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+_record_logger = logging.getLogger("bot.recording")
+_listener = None
+_salt = b""
+
+
+def is_enabled() -> bool:
+    """Whether recording is configured."""
+    return _listener is not None
+
+
+def configure(path: str, salt: Optional[str] = None, max_bytes: int = 50_000_000, backup_count: int = 5):
+    """Start writing recordings to a rotating JSONL file.
+
+    Without a fixed salt a random one is used, so IDs are consistent within
+    one run of the bot but cannot be linked across restarts.
+    """
+    global _listener, _salt
+    if _listener is not None:
+        return
+    _salt = salt.encode("utf-8") if salt else os.urandom(16)
+    _listener = tracing.start_jsonl_writer(_record_logger, path, max_bytes, backup_count)
+    logger.info(f"Recording anonymized traffic to {path}")
+
+
+def shutdown():
+    """Flush pending records and stop the writer."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def anonymize(value) -> str:
+    """Salted, truncated hash of a Telegram ID."""
+    return hashlib.blake2b(str(value).encode("utf-8"), key=_salt[:64], digest_size=8).hexdigest()
+
+
+def describe(update: Update, kind: str) -> Dict:
+    """Shape of an update without any user content."""
+    message = update.message
+    chat = update.effective_chat
+    record = {
+        "ts": round(time.time(), 3),
+        "kind": kind,
+        "chat": anonymize(chat.id),
+        "user": anonymize(update.effective_user.id),
+        "chat_type": chat.type,
+    }
+    if message is None:
+        return record
+
+    record["reply_to_bot"] = bool(message.reply_to_message and message.reply_to_message.from_user
+                                  and message.reply_to_message.from_user.is_bot)
+    if message.text is not None:
+        record["text_len"] = len(message.text)
+    if message.caption is not None:
+        record["caption_len"] = len(message.caption)
+    entities = (message.entities or ()) + (message.caption_entities or ())
+    record["mention"] = any(e.type in ("mention", "text_mention") for e in entities)
+    if message.media_group_id:
+        record["media_group"] = anonymize(message.media_group_id)
+
+    if message.photo:
+        record["file_size"] = message.photo[-1].file_size
+    elif message.document:
+        document = message.document
+        record["file_size"] = document.file_size
+        record["mime_type"] = document.mime_type
+        record["file_ext"] = os.path.splitext(document.file_name or "")[1].lower()[:10]
+    elif message.voice or message.audio:
+        media = message.voice or message.audio
+        record["file_size"] = media.file_size
+        record["duration"] = media.duration
+    return record
+
+
+def record(update: Update, kind: str, outcome: str, timings: Optional[Dict[str, float]] = None,
+           **fields):
+    """Write one update to the recording. No-op when recording is off."""
+    if _listener is None:
+        return
+    try:
+        entry = describe(update, kind)
+        entry["outcome"] = outcome
+        if timings:
+            entry["stages_ms"] = {name: round(seconds * 1000, 2) for name, seconds in timings.items()}
+        entry.update(fields)
+        _record_logger.info(json.dumps(entry, ensure_ascii=False))
+    except Exception as e:
+        logger.warning(f"Failed to record update: {e}")
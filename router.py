@@ -0,0 +1,151 @@
+"""Per-request model routing.
+
+A "thanks!" or a one-line lookup does not need the strongest model. Cheap
+features of each request — modality, length of the user's turn, history
+size, code in the text and explicit hints — pick the model before the
+request is sent:
+
+    !fast / !быстро    at the start of a message: use the light model
+    !smart / !умно     use the active model
+
+In a voice message the hint is the first word spoken on its own, followed
+by a pause ("Умно, ...", "Быстро. ..."): it is matched on the transcription
+before the voice label is added, without the "!" speech recognition never
+writes. A hint word that simply starts a sentence ("Быстро пробежать
+марафон реально?") is part of the question and is left alone.
+
+Otherwise admin-editable rules (the ``routing_rules`` setting, JSON, see
+/routing) are checked in order and the first match wins; a request that
+matches no rule goes to the active model. If a routed model fails, the
+pipeline retries the request once on the active model.
+
+Rule keys (all conditions optional):
+
+    name         label used in logs and metrics
+    modality     list of "text", "photo", "voice", "document"
+    min_chars    / max_chars    length of the user's turn
+    max_history  previous turns in the history window
+    include      substrings, at least one must occur (case-insensitive)
+    exclude      substrings, none may occur
+    model        model id, "light" (ROUTER_LIGHT_MODEL) or "default" (active model)
+"""
+import json
+from typing import Dict, List, Optional, Tuple
+
+import config
+
+HINTS = {
+    "!fast": "light",
+    "!быстро": "light",
+    "!smart": "default",
+    "!умно": "default",
+}
+
+# Punctuation speech recognition puts after a word said on its own
+PAUSE_MARKS = (",", ".", "!", ":", ";", "—")
+
+# Short fresh questions without code go to the light model
+DEFAULT_RULES: List[Dict] = [
+    {"name": "short", "modality": ["text", "voice"], "max_chars": 200, "max_history": 4,
+     "exclude": ["```"], "model": "light"},
+]
+
+RULE_KEYS = {"name", "modality", "min_chars", "max_chars", "max_history", "include", "exclude", "model"}
+
+
+def parse_rules(text: str) -> List[Dict]:
+    """Parse and validate routing rules. Raises ValueError with a readable message."""
+    try:
+        rules = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"некорректный JSON: {e}")
+    if not isinstance(rules, list):
+        raise ValueError("ожидается список правил")
+    for i, rule in enumerate(rules, 1):
+        if not isinstance(rule, dict):
+            raise ValueError(f"правило {i}: ожидается объект")
+        unknown = set(rule) - RULE_KEYS
+        if unknown:
+            raise ValueError(f"правило {i}: неизвестные ключи {', '.join(sorted(unknown))}")
+        if not isinstance(rule.get("model"), str) or not rule["model"]:
+            raise ValueError(f"правило {i}: не указана модель")
+        for key in ("min_chars", "max_chars", "max_history"):
+            if key in rule and not isinstance(rule[key], int):
+                raise ValueError(f"правило {i}: {key} должно быть числом")
+        for key in ("modality", "include", "exclude"):
+            if key in rule and not (isinstance(rule[key], list) and all(isinstance(v, str) for v in rule[key])):
+                raise ValueError(f"правило {i}: {key} должно быть списком строк")
+    return rules
+
+
+class ModelRouter:
+    """Picks a model for each request from admin rules and user hints."""
+
+    def __init__(self, db, light_model: str = None):
+        self.db = db
+        self.light_model = light_model if light_model is not None else config.ROUTER_LIGHT_MODEL
+        self._cached: Tuple[Optional[str], List[Dict]] = (None, [])
+
+    def rules(self) -> List[Dict]:
+        """Current rules: the admin's, or the defaults when none are set."""
+        raw = self.db.get_setting('routing_rules')
+        if not raw:
+            return DEFAULT_RULES if self.light_model else []
+        if raw != self._cached[0]:
+            try:
+                self._cached = (raw, parse_rules(raw))
+            except ValueError:
+                self._cached = (raw, [])
+        return self._cached[1]
+
+    def resolve(self, model: str, default_model: str) -> str:
+        if model == "light":
+            return self.light_model or default_model
+        if model == "default":
+            return default_model
+        return model
+
+    def take_hint(self, ctx) -> Optional[str]:
+        """Strip a leading hint from the user's turn and return its target."""
+        text = ctx.prompt_text or ""
+        word, _, rest = text.partition(" ")
+        key = word.lower()
+        if ctx.modality.name == "voice":
+            # Only a word the recognizer set off with a pause: "Умно, ..." but not "Умно ли ..."
+            if not key.endswith(PAUSE_MARKS):
+                return None
+            key = "!" + key.rstrip("".join(PAUSE_MARKS)).lstrip("!")
+        target = HINTS.get(key)
+        if target is None or not rest.strip():
+            return None
+        ctx.prompt_text = rest.strip()
+        if ctx.history_text.startswith(word):
+            ctx.history_text = ctx.history_text[len(word):].strip()
+        return target
+
+    def route(self, ctx, default_model: str) -> Tuple[str, str]:
+        """Model for a request and the name of the rule that chose it.
+
+        Called with ctx.history holding the previous turns only.
+        """
+        hint = self.take_hint(ctx)
+        if hint:
+            return self.resolve(hint, default_model), f"hint:{hint}"
+
+        text = ctx.prompt_text or ""
+        lowered = text.lower()
+        for i, rule in enumerate(self.rules(), 1):
+            if "modality" in rule and ctx.modality.name not in rule["modality"]:
+                continue
+            if "min_chars" in rule and len(text) < rule["min_chars"]:
+                continue
+            if "max_chars" in rule and len(text) > rule["max_chars"]:
+                continue
+            if "max_history" in rule and len(ctx.history) > rule["max_history"]:
+                continue
+            if "include" in rule and not any(s.lower() in lowered for s in rule["include"]):
+                continue
+            if any(s.lower() in lowered for s in rule.get("exclude", ())):
+                continue
+            return self.resolve(rule["model"], default_model), rule.get("name") or f"rule{i}"
+        return default_model, "default"
@@ -0,0 +1,107 @@
+"""/search — full-text search over the caller's history in the current chat.
+
+    /search <words>   turns containing every word (prefixes match too), newest first
+
+Results come from the storage full-text index (FTS5 on SQLite, tsvector on
+PostgreSQL), scoped to the caller's user and chat, a page at a time.
+"""
+import html
+import re
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.constants import ParseMode
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, ContextTypes
+
+from app_context import get_app
+from storage import SNIPPET_END, SNIPPET_START, search_terms
+
+# Results per page
+PAGE_SIZE = 5
+
+ROLE_ICONS = {"user": "👤", "assistant": "🤖"}
+
+
+def _render_snippet(snippet: str, role: str) -> str:
+    """Snippet as Telegram HTML, matches in bold.
+
+    Assistant turns are stored as Telegram HTML; their tags (including ones cut
+    by the snippet edges) are dropped and entities decoded first.
+    """
+    text = snippet or ""
+    if role == "assistant":
+        text = html.unescape(re.sub(r"<[^>]*>|<[^>]*$|^[^<>]*>", "", text))
+    text = html.escape(" ".join(text.split()))
+    return text.replace(SNIPPET_START, "<b>").replace(SNIPPET_END, "</b>")
+
+
+def _results_page(db, user_id: int, chat_id: int, query: str, offset: int) -> tuple:
+    """Render one page of results. Returns (text, markup)."""
+    results = db.search_history(user_id, chat_id, query, limit=PAGE_SIZE + 1, offset=offset)
+    has_more = len(results) > PAGE_SIZE
+    results = results[:PAGE_SIZE]
+
+    if not results:
+        text = f"🔎 По запросу «{html.escape(query)}» ничего не найдено в истории этого чата."
+        return text, None
+
+    lines = [f"🔎 <b>{html.escape(query)}</b> — результаты {offset + 1}–{offset + len(results)}\n"]
+    for i, result in enumerate(results, offset + 1):
+        icon = ROLE_ICONS.get(result["role"], "•")
+        when = (result["timestamp"] or "")[:16]
+        lines.append(f"{i}. {icon} <i>{when}</i>\n{_render_snippet(result['snippet'], result['role'])}\n")
+
+    buttons = []
+    if offset > 0:
+        buttons.append(InlineKeyboardButton("◀️ Назад", callback_data=f"search:{max(offset - PAGE_SIZE, 0)}"))
+    if has_more:
+        buttons.append(InlineKeyboardButton("Дальше ▶️", callback_data=f"search:{offset + PAGE_SIZE}"))
+    return "\n".join(lines), InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /search <query>."""
+    db = get_app(context).db
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+
+    if not db.is_authorized(user_id):
+        await update.message.reply_text("❌ У вас нет доступа к боту.")
+        return
+
+    query = " ".join(context.args or []).strip()
+    if not search_terms(query):
+        await update.message.reply_text(
+            "🔎 Использование: <code>/search &lt;слова&gt;</code>\n"
+            "Ищет в истории этого чата сообщения, содержащие все слова (можно начало слова).",
+            parse_mode=ParseMode.HTML
+        )
+        return
+
+    # Callback data is limited to 64 bytes, so the query waits here for the page buttons
+    context.user_data["search"] = (chat_id, query)
+    text, reply_markup = _results_page(db, user_id, chat_id, query, 0)
+    await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+
+
+async def search_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle result page buttons."""
+    db = get_app(context).db
+    query = update.callback_query
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+
+    saved = context.user_data.get("search")
+    if not saved or saved[0] != chat_id or not db.is_authorized(user_id):
+        await query.answer("Поиск устарел, повторите /search", show_alert=True)
+        return
+    await query.answer()
+
+    offset = int(query.data.split(":", 1)[1])
+    text, reply_markup = _results_page(db, user_id, chat_id, saved[1], offset)
+    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+
+
+def register_search_handlers(application: Application):
+    """Register /search and its page buttons."""
+    application.add_handler(CommandHandler("search", search_command))
+    application.add_handler(CallbackQueryHandler(search_callback, pattern=r"^search:\d+$"))
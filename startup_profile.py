@@ -0,0 +1,110 @@
+"""Startup-time profile of the bot entry point.
+
+    python bot.py --profile-startup
+
+Reports where a restart spends its time and exits without polling:
+
+- import time per top-level package, measured in a fresh interpreter with
+  ``python -X importtime -c "import bot"`` (self time, summed over the
+  package's modules) and the cumulative time of the bot's own modules;
+- time of each init step main() performs: the Claude client import, storage
+  with schema migrations, the Claude client, services, handler
+  registration and the Telegram handshake (getMe).
+"""
+import asyncio
+import importlib
+import os
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+import config
+
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Bot modules reported by cumulative import time (the rest by package)
+LOCAL_MODULES = {
+    os.path.splitext(name)[0] for name in os.listdir(BOT_DIR) if name.endswith(".py")
+}
+
+
+def measure_imports(module: str = "bot") -> Tuple[float, Dict[str, float], Dict[str, float]]:
+    """Import a module in a fresh interpreter under -X importtime.
+
+    Returns (total ms, self ms per top-level package, cumulative ms per bot module).
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=BOT_DIR, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+
+    packages: Dict[str, float] = defaultdict(float)
+    local: Dict[str, float] = {}
+    total = 0.0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        name = name.strip()
+        packages[name.split(".")[0]] += int(self_us) / 1000
+        if name in LOCAL_MODULES:
+            local[name] = int(cumulative_us) / 1000
+        if name == module:
+            total = int(cumulative_us) / 1000
+    return total, dict(packages), local
+
+
+async def measure_init() -> List[Tuple[str, float]]:
+    """Run main()'s init steps once, timing each; nothing is polled."""
+    steps: List[Tuple[str, float]] = []
+
+    def timed(name: str, func, *args):
+        started = time.perf_counter()
+        result = func(*args)
+        steps.append((name, (time.perf_counter() - started) * 1000))
+        return result
+
+    import bot
+    from app_context import AppContext
+    from storage import create_storage
+
+    timed("validate_config", config.validate_config)
+    ClaudeClient = timed("import claude_client (anthropic)", importlib.import_module, "claude_client").ClaudeClient
+    db = timed("storage and schema migrations", create_storage)
+    claude = timed("Claude client", ClaudeClient)
+    app = timed("services (router, summarizer, batches)", AppContext, db, claude)
+    application = timed("handlers (admin, batches)", bot.build_application, app)
+
+    started = time.perf_counter()
+    try:
+        await application.initialize()
+        steps.append(("Telegram initialize (getMe)", (time.perf_counter() - started) * 1000))
+    except Exception as e:
+        steps.append((f"Telegram initialize failed: {e}", (time.perf_counter() - started) * 1000))
+    else:
+        await application.shutdown()
+    app.close()
+    return steps
+
+
+def report(top: int = 15):
+    """Print the startup profile."""
+    total, packages, local = measure_imports()
+    print(f"import bot: {total:.1f} ms (fresh interpreter)\n")
+    print(f"{'package':<32}{'self ms':>10}")
+    for name, ms in sorted(packages.items(), key=lambda item: -item[1])[:top]:
+        print(f"{name:<32}{ms:>10.1f}")
+
+    print(f"\n{'bot module':<32}{'cumulative ms':>14}")
+    for name, ms in sorted(local.items(), key=lambda item: -item[1]):
+        print(f"{name:<32}{ms:>14.1f}")
+
+    steps = asyncio.run(measure_init())
+    print(f"\n{'init step':<42}{'ms':>10}")
+    for name, ms in steps:
+        print(f"{name:<42}{ms:>10.1f}")
+    print(f"{'total':<42}{sum(ms for _, ms in steps):>10.1f}")
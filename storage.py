@@ -0,0 +1,264 @@
+"""Storage interface shared by the SQLite and PostgreSQL backends."""
+import abc
+import re
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import config
+
+# (user_id, chat_id, role, content)
+HistoryRow = Tuple[int, int, str, str]
+
+# (user_id, username, first_name, last_name)
+UserRow = Tuple[int, Optional[str], Optional[str], Optional[str]]
+
+# (created_at in unix microseconds, user_id): position of a user in the listing
+UserCursor = Tuple[int, int]
+
+USER_STATUSES = ("all", "authorized", "pending", "admin")
+
+# Markers around matched words in history search snippets
+SNIPPET_START = "\x02"
+SNIPPET_END = "\x03"
+
+MAX_SEARCH_TERMS = 8
+
+# Columns of exported rows, in order
+CONVERSATION_COLUMNS = ("id", "user_id", "chat_id", "role", "content", "timestamp")
+USAGE_COLUMNS = ("id", "user_id", "chat_id", "model", "input_tokens", "output_tokens", "cost_usd", "batch", "timestamp")
+
+# Rows read per query by the export iterators
+EXPORT_BATCH_SIZE = 1000
+
+
+def search_terms(query: str) -> List[str]:
+    """Words of a search query; punctuation and full-text query syntax are dropped."""
+    return re.findall(r"\w+", query.lower())[:MAX_SEARCH_TERMS]
+
+
+def calculate_cost(model: str, input_tokens: int, output_tokens: int, batch: bool = False) -> float:
+    """Cost in USD of one request at the configured per-million-token prices.
+
+    Message Batches requests are billed at BATCH_DISCOUNT of the regular price.
+    """
+    pricing = config.CLAUDE_PRICING.get(model, {"input": 3.00, "output": 15.00})
+    cost = (input_tokens / 1_000_000 * pricing["input"] +
+            output_tokens / 1_000_000 * pricing["output"])
+    return cost * config.BATCH_DISCOUNT if batch else cost
+
+
+class Storage(abc.ABC):
+    """Users, usage statistics, conversation history and settings."""
+
+    @abc.abstractmethod
+    def is_authorized(self, user_id: int) -> bool:
+        """Check if user is authorized."""
+
+    @abc.abstractmethod
+    def is_admin(self, user_id: int) -> bool:
+        """Check if user is admin."""
+
+    @abc.abstractmethod
+    def add_user(self, user_id: int, username: str = None, first_name: str = None,
+                 last_name: str = None, is_authorized: bool = False):
+        """Add or update user information."""
+
+    @abc.abstractmethod
+    def authorize_user(self, user_id: int):
+        """Authorize a user."""
+
+    @abc.abstractmethod
+    def deauthorize_user(self, user_id: int):
+        """Deauthorize a user."""
+
+    @abc.abstractmethod
+    def set_users_authorized(self, user_ids: Iterable[int], authorized: bool) -> List[int]:
+        """Authorize or deauthorize many users in one transaction; returns the IDs that exist."""
+
+    @abc.abstractmethod
+    def import_users(self, users: Iterable[UserRow], authorize: bool = True) -> int:
+        """Create or update many users in one transaction, optionally authorizing them.
+
+        Known names are kept when a row leaves them empty. Returns the number of rows written.
+        """
+
+    @abc.abstractmethod
+    def get_all_users(self) -> List[Dict]:
+        """Get all users, newest first."""
+
+    @abc.abstractmethod
+    def get_user(self, user_id: int) -> Optional[Dict]:
+        """One user, or None if the user never wrote to the bot."""
+
+    @abc.abstractmethod
+    def get_users_page(self, status: str = "all", active_days: int = None,
+                       after: UserCursor = None, before: UserCursor = None, limit: int = 20) -> List[Dict]:
+        """A page of users, newest first, using keyset pagination.
+
+        status is one of USER_STATUSES; active_days keeps users active in the
+        last days. after/before are the "cursor" of the last/first user of the
+        neighbouring page. Every user dict carries its own cursor.
+        """
+
+    @abc.abstractmethod
+    def count_users(self, status: str = "all", active_days: int = None) -> int:
+        """Number of users matching the same filters as get_users_page."""
+
+    @abc.abstractmethod
+    def get_user_counts(self) -> Dict[str, int]:
+        """Number of users for every status in USER_STATUSES, in a single query."""
+
+    @abc.abstractmethod
+    def log_usage(self, user_id: int, model: str, input_tokens: int, output_tokens: int,
+                  batch: bool = False, chat_id: int = None) -> float:
+        """Log API usage and return its cost (at batch pricing for Message Batches results).
+
+        chat_id is set for replies to a chat's messages, which count towards token budgets.
+        """
+
+    @abc.abstractmethod
+    def get_total_usage(self) -> Dict:
+        """Get total usage statistics."""
+
+    @abc.abstractmethod
+    def get_user_usage(self, user_id: int) -> Dict:
+        """Get usage statistics for a specific user."""
+
+    @abc.abstractmethod
+    def get_usage_by_model(self, days: int = 7) -> List[Dict]:
+        """Requests, tokens and cost per model over the last days, busiest model first."""
+
+    @abc.abstractmethod
+    def get_tokens_since(self, seconds: int, user_id: int = None, chat_id: int = None) -> int:
+        """Input plus output tokens of chat replies in the last seconds, for one user or one chat.
+
+        Batch results and summaries are logged without chat_id and don't count.
+        """
+
+    @abc.abstractmethod
+    def iter_usage(self, user_id: int = None) -> Iterator[Tuple]:
+        """Every usage record (of one user, or everyone's), oldest first, as USAGE_COLUMNS tuples.
+
+        Read in batches like iter_conversations().
+        """
+
+    @abc.abstractmethod
+    def add_message_to_history(self, user_id: int, chat_id: int, role: str, content: str):
+        """Add message to conversation history for a specific chat."""
+
+    def add_messages_to_history(self, messages: Iterable[HistoryRow]):
+        """Add several messages at once; backends override this with a batched insert."""
+        for user_id, chat_id, role, content in messages:
+            self.add_message_to_history(user_id, chat_id, role, content)
+
+    @abc.abstractmethod
+    def get_conversation_history(self, user_id: int, chat_id: int, limit: int = 20) -> List[Dict]:
+        """Get recent conversation history for a user in a specific chat (last 10 minutes)."""
+
+    @abc.abstractmethod
+    def get_recent_turns(self, user_id: int, chat_id: int, limit: int = 20) -> List[Tuple[float, str, str]]:
+        """Like get_conversation_history, as (unix timestamp, role, content) tuples."""
+
+    @abc.abstractmethod
+    def get_turns_since(self, user_id: int, chat_id: int, after_id: int,
+                        limit: int = 200) -> List[Tuple[int, float, str, str]]:
+        """Latest turns with id > after_id as (id, unix timestamp, role, content), oldest first."""
+
+    @abc.abstractmethod
+    def search_history(self, user_id: int, chat_id: int, query: str,
+                       limit: int = 5, offset: int = 0) -> List[Dict]:
+        """Turns of a chat containing every word of the query (as a prefix), newest first.
+
+        Dicts have id, role, timestamp and snippet, with matches wrapped in
+        SNIPPET_START and SNIPPET_END.
+        """
+
+    @abc.abstractmethod
+    def iter_conversations(self, user_id: int = None) -> Iterator[Tuple]:
+        """Every stored turn (of one user, or everyone's), oldest first, as CONVERSATION_COLUMNS tuples.
+
+        Rows are read EXPORT_BATCH_SIZE at a time by id, one short query per
+        batch, so memory stays flat and no read transaction spans the export.
+        """
+
+    @abc.abstractmethod
+    def clear_conversation_history(self, user_id: int, chat_id: int = None):
+        """Clear conversation history and summaries for a user in specific chat or all chats."""
+
+    @abc.abstractmethod
+    def get_summary(self, user_id: int, chat_id: int) -> Optional[Tuple[str, int]]:
+        """Rolling summary of a chat and the id of the last turn it covers."""
+
+    @abc.abstractmethod
+    def save_summary(self, user_id: int, chat_id: int, summary: str, through_id: int) -> bool:
+        """Store the rolling summary of a chat folded through turn ``through_id``.
+
+        Nothing is stored if that turn no longer exists (the history was
+        cleared meanwhile); returns whether the summary was stored.
+        """
+
+    @abc.abstractmethod
+    def get_setting(self, key: str, default: str = None) -> Optional[str]:
+        """Get a setting value by key."""
+
+    @abc.abstractmethod
+    def set_setting(self, key: str, value: str):
+        """Set a setting value."""
+
+    @abc.abstractmethod
+    def create_batch_job(self, user_id: int, chat_id: int, prompt: str) -> int:
+        """Start collecting items for a new batch job; returns its id."""
+
+    @abc.abstractmethod
+    def get_batch_jobs(self, user_id: int = None, chat_id: int = None,
+                       statuses: Iterable[str] = None, limit: int = 20) -> List[Dict]:
+        """Batch jobs, newest first, optionally filtered by owner, chat and status."""
+
+    @abc.abstractmethod
+    def update_batch_job(self, job_id: int, status: str, expected_status: str = None,
+                         batch_id: str = None, model: str = None,
+                         results: Tuple[int, int, float] = None) -> bool:
+        """Move a job to a new status; with expected_status, only if it is still in that status.
+
+        results is (succeeded, failed, cost). Returns whether the job was updated.
+        """
+
+    @abc.abstractmethod
+    def add_batch_item(self, job_id: int, title: str, content: str) -> int:
+        """Add an item to a collecting job; returns the job's item count."""
+
+    @abc.abstractmethod
+    def get_batch_items(self, job_id: int) -> List[Dict]:
+        """Items of a batch job in the order they were added."""
+
+    @abc.abstractmethod
+    def save_batch_results(self, results: Iterable[Tuple[int, str, str, int, int, float]]):
+        """Store (item_id, status, result, input_tokens, output_tokens, cost) rows."""
+
+    def close(self):
+        """Release connections held by the backend."""
+
+
+def create_storage(cache_history: bool = True) -> Storage:
+    """Storage backend selected by DATABASE_URL (PostgreSQL) or DATABASE_PATH (SQLite).
+
+    Conversation history is served from memory unless HISTORY_CACHE_MB is 0
+    or the caller never reads history (cache_history=False). The cache is
+    process-local and nothing invalidates it when another bot instance
+    writes to a shared PostgreSQL database, so with DATABASE_URL it is only
+    used if HISTORY_CACHE_SHARED_DB says this instance is the database's
+    only one.
+    """
+    if config.DATABASE_URL:
+        from postgres_db import PostgresDatabase
+        backend = PostgresDatabase(config.DATABASE_URL)
+    else:
+        from database import Database
+        backend = Database()
+
+    if not cache_history or config.HISTORY_CACHE_MB <= 0:
+        return backend
+    if config.DATABASE_URL and not config.HISTORY_CACHE_SHARED_DB:
+        return backend
+
+    from history_cache import CachedStorage, HistoryCache
+    return CachedStorage(backend, HistoryCache(int(config.HISTORY_CACHE_MB * 1024 * 1024)))
@@ -0,0 +1,152 @@
+"""Rolling per-chat conversation summaries.
+
+Raw history sent to Claude is limited to the last few turns of the last
+10 minutes. Turns that fall out of that window are folded, in the
+background and with a cheap model, into a stored summary of the chat,
+which is added to the system prompt of later requests. Input tokens per
+request therefore stay bounded (recent turns + a summary of capped
+length) without losing the thread of a long session.
+
+A fold runs after a reply has been delivered once enough turns have
+aged out, and once more shortly before an idle chat's turns leave the
+10-minute window.
+"""
+import asyncio
+import logging
+import time
+from typing import Dict, List, Tuple
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = (
+    "Ты ведёшь краткий конспект переписки пользователя с ассистентом. "
+    "Дополни текущий конспект новыми репликами. Сохрани факты о пользователе, задачи, решения, "
+    "имена, числа и открытые вопросы; опусти приветствия, повторы и оформление. "
+    "Пиши сжато, от третьего лица, на языке переписки. Верни только обновлённый конспект."
+)
+
+# Longest text taken from a single turn; documents can be huge
+MAX_TURN_CHARS = 4000
+
+Key = Tuple[int, int]
+
+
+class Summarizer:
+    """Folds aged-out turns into a stored per-chat summary in the background."""
+
+    def __init__(self, db, claude, model: str, keep_turns: int = 10, batch: int = 4,
+                 max_tokens: int = 400, idle_after: float = 540):
+        self.db = db
+        self.claude = claude
+        self.model = model
+        self.keep_turns = keep_turns    # most recent turns never folded (the raw window)
+        self.batch = batch              # fold once this many turns have aged out
+        self.max_tokens = max_tokens    # cap on summary length
+        self.idle_after = idle_after    # turns this old are folded regardless of count
+        self._running: Dict[Key, asyncio.Task] = {}
+        self._again: set = set()
+        self._timers: Dict[Key, asyncio.TimerHandle] = {}
+
+    def schedule(self, user_id: int, chat_id: int):
+        """Request a fold for a chat; returns immediately."""
+        key = (user_id, chat_id)
+        loop = asyncio.get_running_loop()
+
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        # Catch the last turns of an idle chat before they leave the raw window
+        self._timers[key] = loop.call_later(self.idle_after + 1, self._on_idle, key)
+
+        if key in self._running:
+            self._again.add(key)
+            return
+        self._running[key] = loop.create_task(self._fold_loop(key))
+
+    def forget(self, user_id: int, chat_id: int):
+        """Drop a chat's pending timer and fold, e.g. when its history is cleared."""
+        key = (user_id, chat_id)
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        self._again.discard(key)
+        task = self._running.pop(key, None)
+        if task is not None:
+            task.cancel()
+
+    def _on_idle(self, key: Key):
+        self._timers.pop(key, None)
+        if key in self._running:
+            self._again.add(key)
+        else:
+            self._running[key] = asyncio.get_running_loop().create_task(self._fold_loop(key))
+
+    async def _fold_loop(self, key: Key):
+        try:
+            while True:
+                self._again.discard(key)
+                try:
+                    await asyncio.to_thread(self.fold, *key)
+                except Exception as e:
+                    metrics.SUMMARIES.inc(result="error")
+                    logger.warning(f"Summarizing chat {key[1]} for user {key[0]} failed: {e}")
+                    return
+                if key not in self._again:
+                    return
+        finally:
+            if self._running.get(key) is asyncio.current_task():
+                self._running.pop(key)
+
+    def foldable(self, turns: List[Tuple[int, float, str, str]], now: float) -> List[Tuple[int, float, str, str]]:
+        """Oldest turns that are outside the raw window or about to expire."""
+        cutoff = now - self.idle_after
+        result = []
+        for i, turn in enumerate(turns):
+            if i < len(turns) - self.keep_turns or turn[1] <= cutoff:
+                result.append(turn)
+            else:
+                break
+        return result
+
+    def fold(self, user_id: int, chat_id: int) -> bool:
+        """Fold aged-out turns into the chat summary. Blocking; returns whether it ran."""
+        current = self.db.get_summary(user_id, chat_id)
+        summary, through_id = current if current else ("", 0)
+        turns = self.db.get_turns_since(user_id, chat_id, through_id)
+
+        now = time.time()
+        turns_to_fold = self.foldable(turns, now)
+        if not turns_to_fold:
+            return False
+        if len(turns_to_fold) < self.batch and turns_to_fold[-1][1] > now - self.idle_after:
+            return False
+
+        transcript = "\n\n".join(
+            f"{'Пользователь' if role == 'user' else 'Ассистент'}: {content[:MAX_TURN_CHARS]}"
+            for _, _, role, content in turns_to_fold
+        )
+        request = (f"Текущий конспект:\n{summary}\n\n" if summary else "") + f"Новые реплики:\n{transcript}"
+        new_summary, input_tokens, output_tokens = self.claude.send_message(
+            [{"role": "user", "content": request}], SUMMARY_PROMPT, model=self.model, max_tokens=self.max_tokens
+        )
+
+        # Not stored if the chat was cleared while Claude was summarizing
+        saved = self.db.save_summary(user_id, chat_id, new_summary.strip(), turns_to_fold[-1][0])
+        cost = self.db.log_usage(user_id, self.model, input_tokens, output_tokens)
+        metrics.SUMMARIES.inc(result="ok" if saved else "cleared")
+        metrics.TOKENS.inc(input_tokens, model=self.model, direction="input")
+        metrics.TOKENS.inc(output_tokens, model=self.model, direction="output")
+        metrics.COST.inc(cost, model=self.model)
+        logger.info(
+            f"User {user_id} - Summary - {'folded' if saved else 'discarded, chat cleared:'} {len(turns_to_fold)} turns, "
+            f"Tokens: {input_tokens}+{output_tokens}, Cost: ${cost:.4f}"
+        )
+        return saved
+
+    def shutdown(self):
+        """Cancel idle timers; folds already running finish on their own."""
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
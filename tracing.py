@@ -0,0 +1,291 @@
+"""Lightweight per-update tracing written to rotating JSONL files.
+
+Each update processed by the pipeline gets a trace ID and a tree of timed
+spans. Finished traces are sampled (all errors and slow traces are kept,
+the rest at TRACE_SAMPLE_RATE) and written by a background thread, so the
+event loop never waits on disk.
+
+Summarize slow traces from the command line:
+
+    python tracing.py traces.jsonl --min-ms 5000 --top 20
+"""
+import argparse
+import functools
+import glob
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Separate logger used only as the transport to the JSONL file
+_export_logger = logging.getLogger("bot.traces")
+_export_logger.propagate = False
+_listener: Optional[logging.handlers.QueueListener] = None
+
+_sample_rate = 1.0
+_slow_seconds = 5.0
+
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+class Span:
+    """A timed operation inside a trace."""
+
+    __slots__ = ("trace", "span_id", "parent_id", "name", "attributes", "start", "duration", "error")
+
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str], attributes: Dict):
+        self.trace = trace
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start = time.perf_counter()
+        self.duration = 0.0
+        self.error: Optional[str] = None
+
+    def set(self, **attributes):
+        """Add attributes to the span."""
+        self.attributes.update(attributes)
+
+    def set_error(self, error: BaseException):
+        """Mark the span as failed (for errors that are handled, not raised)."""
+        self.error = type(error).__name__
+
+    def to_dict(self) -> Dict:
+        return {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "offset_ms": round((self.start - self.trace.root.start) * 1000, 3),
+            "duration_ms": round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class _NoopSpan:
+    """Returned when tracing is off or no trace is active."""
+
+    def set(self, **attributes):
+        pass
+
+    def set_error(self, error: BaseException):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    """All spans recorded for one update."""
+
+    def __init__(self, name: str, attributes: Dict):
+        self.trace_id = uuid.uuid4().hex
+        self.timestamp = time.time()
+        self.spans: List[Span] = []
+        self.root = Span(self, name, None, attributes)
+        self.spans.append(self.root)
+
+    def to_dict(self) -> Dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.root.span_id,
+            "timestamp": self.timestamp,
+            "name": self.root.name,
+            "duration_ms": round(self.root.duration * 1000, 3),
+            "error": self.root.error,
+            "attributes": self.root.attributes,
+            "spans": [s.to_dict() for s in self.spans[1:]],
+        }
+
+
+def is_enabled() -> bool:
+    """Whether an exporter is configured."""
+    return _listener is not None
+
+
+def start_jsonl_writer(target: logging.Logger, path: str, max_bytes: int,
+                       backup_count: int) -> logging.handlers.QueueListener:
+    """Route a logger's messages to a rotating file through a background thread.
+
+    Callers log one JSON document per record; the calling thread only
+    enqueues it.
+    """
+    file_handler = logging.handlers.RotatingFileHandler(
+        path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"
+    )
+    file_handler.setFormatter(logging.Formatter("%(message)s"))
+
+    record_queue: queue.SimpleQueue = queue.SimpleQueue()
+    target.addHandler(logging.handlers.QueueHandler(record_queue))
+    target.setLevel(logging.INFO)
+    target.propagate = False
+    listener = logging.handlers.QueueListener(record_queue, file_handler)
+    listener.start()
+    return listener
+
+
+def configure(path: str, sample_rate: float = 1.0, slow_ms: float = 5000,
+              max_bytes: int = 10_000_000, backup_count: int = 5):
+    """Start the background JSONL exporter."""
+    global _listener, _sample_rate, _slow_seconds
+    if _listener is not None:
+        return
+
+    _sample_rate = sample_rate
+    _slow_seconds = slow_ms / 1000
+    _listener = start_jsonl_writer(_export_logger, path, max_bytes, backup_count)
+    logger.info(f"Tracing to {path} (sample rate {sample_rate}, slow threshold {slow_ms:.0f}ms)")
+
+
+def shutdown():
+    """Flush pending traces and stop the exporter."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _should_export(t: Trace) -> bool:
+    if t.root.error or t.root.duration >= _slow_seconds:
+        return True
+    return random.random() < _sample_rate
+
+
+def current_trace_id() -> Optional[str]:
+    """Trace ID of the update being processed, if any."""
+    current = _current_span.get()
+    return current.trace.trace_id if current is not None else None
+
+
+@contextmanager
+def trace(name: str, **attributes):
+    """Start a new trace with a root span; exported when the block exits."""
+    if _listener is None:
+        yield NOOP_SPAN
+        return
+
+    t = Trace(name, attributes)
+    token = _current_span.set(t.root)
+    try:
+        yield t.root
+    except BaseException as e:
+        t.root.error = type(e).__name__
+        raise
+    finally:
+        t.root.duration = time.perf_counter() - t.root.start
+        _current_span.reset(token)
+        if _should_export(t):
+            _export_logger.info(json.dumps(t.to_dict(), ensure_ascii=False, default=str))
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Record a child span of the current span. No-op outside a trace."""
+    parent = _current_span.get()
+    if parent is None:
+        yield NOOP_SPAN
+        return
+
+    s = Span(parent.trace, name, parent.span_id, attributes)
+    parent.trace.spans.append(s)
+    token = _current_span.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.error = type(e).__name__
+        raise
+    finally:
+        s.duration = time.perf_counter() - s.start
+        _current_span.reset(token)
+
+
+def traced(name: str):
+    """Decorator recording a span around a synchronous function."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _load_traces(patterns: List[str]) -> List[Dict]:
+    traces = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        traces.append(json.loads(line))
+    return traces
+
+
+def _print_trace(t: Dict):
+    attrs = " ".join(f"{k}={v}" for k, v in t["attributes"].items())
+    error = f" ERROR={t['error']}" if t.get("error") else ""
+    print(f"{t['duration_ms']:>10.0f}ms  {t['trace_id']}  {t['name']}  {attrs}{error}")
+
+    children: Dict[Optional[str], List[Dict]] = {}
+    for s in t["spans"]:
+        children.setdefault(s["parent_id"], []).append(s)
+
+    def walk(parent_id, depth):
+        for s in sorted(children.get(parent_id, []), key=lambda s: s["offset_ms"]):
+            s_attrs = " ".join(f"{k}={v}" for k, v in s["attributes"].items())
+            s_error = f" ERROR={s['error']}" if s.get("error") else ""
+            print(f"{'':12}{'  ' * depth}+{s['offset_ms']:.0f}ms {s['name']} "
+                  f"{s['duration_ms']:.0f}ms {s_attrs}{s_error}".rstrip())
+            walk(s["span_id"], depth + 1)
+
+    walk(t["span_id"], 0)
+
+
+def main():
+    """Summarize slow traces from JSONL files."""
+    parser = argparse.ArgumentParser(description="Summarize slow bot traces.")
+    parser.add_argument("files", nargs="+", help="Trace files or glob patterns (e.g. 'traces.jsonl*')")
+    parser.add_argument("--min-ms", type=float, default=0, help="Only show traces at least this slow")
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest traces to show")
+    parser.add_argument("--trace", help="Show a single trace by ID")
+    parser.add_argument("--user", type=int, help="Only traces for this user_id")
+    args = parser.parse_args()
+
+    traces = _load_traces(args.files)
+    if args.trace:
+        traces = [t for t in traces if t["trace_id"].startswith(args.trace)]
+    if args.user is not None:
+        traces = [t for t in traces if t["attributes"].get("user_id") == args.user]
+    slow = [t for t in traces if t["duration_ms"] >= args.min_ms]
+    slow.sort(key=lambda t: t["duration_ms"], reverse=True)
+
+    # Where does the time go across the slow traces?
+    totals: Dict[str, List[float]] = {}
+    for t in slow:
+        for s in t["spans"]:
+            totals.setdefault(s["name"], []).append(s["duration_ms"])
+
+    print(f"{len(slow)} of {len(traces)} traces >= {args.min_ms:.0f}ms\n")
+    if totals:
+        print(f"{'span':<36}{'count':>8}{'total ms':>12}{'avg ms':>10}{'max ms':>10}")
+        for name, values in sorted(totals.items(), key=lambda kv: sum(kv[1]), reverse=True):
+            print(f"{name:<36}{len(values):>8}{sum(values):>12.0f}{sum(values) / len(values):>10.0f}{max(values):>10.0f}")
+        print()
+
+    for t in slow[:args.top]:
+        _print_trace(t)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -22,7 +22,29 @@ BOT_DIR="/opt/telegram-bot"
 FILES=(
     "bot.py"
     "admin.py"
+    "app_context.py"
     "claude_client.py"
+    "pipeline.py"
+    "chat_actions.py"
+    "media_groups.py"
+    "media.py"
+    "documents.py"
+    "loop_monitor.py"
+    "update_processor.py"
+    "search.py"
+    "export.py"
+    "metrics.py"
+    "tracing.py"
+    "recorder.py"
+    "workers.py"
+    "startup_profile.py"
+    "storage.py"
+    "postgres_db.py"
+    "history_cache.py"
+    "summarizer.py"
+    "batches.py"
+    "router.py"
+    "quotas.py"
     "config.py"
     "database.py"
     "requirements.txt"
@@ -0,0 +1,115 @@
+"""Concurrent update processing with per-chat ordering.
+
+python-telegram-bot handles updates one at a time by default, so one slow
+generation holds back every other chat. ChatUpdateProcessor lets up to
+CONCURRENT_UPDATES updates run at once while each chat's updates still run
+strictly in arrival order: an update waits for the chat's previous one
+(a per-chat lock, FIFO), then for a free slot.
+
+Commands and button presses of the admin skip both waits, so /admin,
+/model or /limits answer at once even when every slot is busy with
+generations. So do the second and later photos of an album: the first
+photo holds the chat's turn and a slot until the whole album is answered
+(see media_groups.py).
+"""
+import asyncio
+import logging
+from typing import Awaitable, Dict, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import config
+import metrics
+from media_groups import MediaGroupCollector
+
+logger = logging.getLogger(__name__)
+
+# PTB's own semaphore must never hold back admin updates; the limit is applied below
+_UNBOUNDED = 1_000_000
+
+
+def chat_key(update: object) -> int:
+    """Ordering key: the chat, falling back to the user for chat-less updates."""
+    if not isinstance(update, Update):
+        return 0
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return 0
+
+
+def is_admin_action(update: object) -> bool:
+    """A command or button press from the admin."""
+    if not isinstance(update, Update) or not update.effective_user:
+        return False
+    if update.effective_user.id != config.ADMIN_USER_ID:
+        return False
+    if update.callback_query:
+        return True
+    message = update.message or update.edited_message
+    return bool(message and message.text and message.text.startswith("/"))
+
+
+class _ChatQueue:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0  # updates holding or waiting for the lock
+
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """Runs different chats' updates concurrently and each chat's updates in order."""
+
+    def __init__(self, limit: int, media_groups: Optional[MediaGroupCollector] = None):
+        super().__init__(_UNBOUNDED)
+        self.limit = max(1, limit)
+        self.media_groups = media_groups
+        self._slots = asyncio.Semaphore(self.limit)
+        self._chats: Dict[int, _ChatQueue] = {}
+        self._waiting = 0
+        metrics.QUEUE_DEPTH.set_function(lambda: self._waiting, queue="chat_updates")
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        if is_admin_action(update):
+            await coroutine
+            return
+
+        album = self.media_groups is not None and self.media_groups.accepts(update)
+        if album and not self.media_groups.add(update):
+            # A later photo of an album whose first photo holds the chat's turn
+            await coroutine
+            return
+
+        key = chat_key(update)
+        chat = self._chats.get(key)
+        if chat is None:
+            chat = self._chats[key] = _ChatQueue()
+        chat.users += 1
+        self._waiting += 1
+        started = False
+        try:
+            async with chat.lock, self._slots:
+                self._waiting -= 1
+                started = True
+                await coroutine
+        finally:
+            if not started:
+                # Cancelled while waiting (shutdown): the handler never ran
+                self._waiting -= 1
+                coroutine.close()
+            if album:
+                # In case no handler collected the album
+                self.media_groups.discard(update)
+            chat.users -= 1
+            if not chat.users:
+                del self._chats[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        if self._chats:
+            logger.info(f"Update processor stopped with {len(self._chats)} chats still busy")
@@ -0,0 +1,264 @@
+"""Dispatcher plus worker-process mode for multi-core hosts.
+
+With WORKERS=N the main process only polls Telegram: every update is
+routed to one of N worker processes by ``chat_id % N``, so one chat
+always lands on the same worker and its updates are handled in order
+(different chats on a worker run concurrently, see update_processor.py).
+Each worker runs the usual bot handlers (pipeline, database, Claude
+client) in its own interpreter. Bot API calls made by the workers are
+forwarded back to the main process and sent through its single HTTP
+connection pool; file downloads go straight from the workers.
+"""
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+from typing import Dict, List, Optional
+
+from telegram import Update
+from telegram.ext import Application, ContextTypes, TypeHandler
+from telegram.request import BaseRequest, HTTPXRequest
+
+import config
+import metrics
+from update_processor import chat_key
+
+logger = logging.getLogger(__name__)
+
+# Message kinds on the queues
+UPDATE = "update"
+RESPONSE = "response"
+
+
+class ForwardedRequestData:
+    """Picklable stand-in for RequestData with what HTTPXRequest reads."""
+
+    def __init__(self, json_parameters: Dict[str, str], multipart_data: Optional[Dict]):
+        self.json_parameters = json_parameters
+        self.multipart_data = multipart_data
+
+    @classmethod
+    def from_request_data(cls, request_data) -> Optional["ForwardedRequestData"]:
+        if request_data is None:
+            return None
+        files = {}
+        for name, value in request_data.multipart_data.items():
+            if isinstance(value, tuple):
+                # (filename, content, mime type); content may be a file handle
+                value = tuple(v.read() if hasattr(v, "read") else v for v in value)
+            files[name] = value
+        return cls(request_data.json_parameters, files or None)
+
+
+class ForwardingRequest(BaseRequest):
+    """Worker-side request that sends Bot API calls through the dispatcher."""
+
+    def __init__(self, worker: int, outbox):
+        self.worker = worker
+        self._outbox = outbox
+        self._ids = itertools.count()
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # File downloads skip the round trip through the dispatcher
+        self._files = HTTPXRequest(connection_pool_size=8)
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return self._files.read_timeout
+
+    async def initialize(self):
+        self._loop = asyncio.get_running_loop()
+        await self._files.initialize()
+
+    async def shutdown(self):
+        await self._files.shutdown()
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+
+    def resolve(self, request_id: int, status: Optional[int], body: Optional[bytes],
+                error: Optional[Exception]):
+        """Complete a forwarded call; runs on the worker's event loop."""
+        future = self._pending.pop(request_id, None)
+        if future is None or future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result((status, body))
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        timeouts = {
+            "read_timeout": read_timeout,
+            "write_timeout": write_timeout,
+            "connect_timeout": connect_timeout,
+            "pool_timeout": pool_timeout,
+        }
+        if "/file/bot" in url:
+            return await self._files.do_request(url, method, request_data, **timeouts)
+
+        request_id = next(self._ids)
+        future = self._loop.create_future()
+        self._pending[request_id] = future
+        # Only explicit timeouts are forwarded; the dispatcher applies its defaults otherwise
+        explicit = {k: v for k, v in timeouts.items() if v is not BaseRequest.DEFAULT_NONE}
+        self._outbox.put((self.worker, request_id, url, method,
+                          ForwardedRequestData.from_request_data(request_data), explicit))
+        return await future
+
+
+class Dispatcher:
+    """Routes updates to worker processes and sends their Bot API calls."""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._context = multiprocessing.get_context("spawn")
+        self._outbox = self._context.Queue()
+        self._inboxes = [self._context.Queue() for _ in range(workers)]
+        self._processes: List[Optional[multiprocessing.Process]] = [None] * workers
+        self._application: Optional[Application] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._reader: Optional[threading.Thread] = None
+
+    def worker_for(self, update: Update) -> int:
+        return chat_key(update) % self.workers
+
+    async def start(self, application: Application):
+        """post_init hook: spawn workers and start forwarding their calls."""
+        self._application = application
+        self._loop = asyncio.get_running_loop()
+
+        # Workers must hash IDs the same way, so they need a shared salt
+        if config.RECORD_FILE and not config.RECORD_SALT:
+            os.environ["RECORD_SALT"] = os.urandom(16).hex()
+
+        for index in range(self.workers):
+            self._spawn(index)
+            metrics.QUEUE_DEPTH.set_function(self._inboxes[index].qsize, queue=f"worker{index}")
+
+        self._reader = threading.Thread(target=self._read_outbox, name="dispatcher-outbox", daemon=True)
+        self._reader.start()
+        logger.info(f"Dispatching updates to {self.workers} worker processes")
+
+    async def stop(self, application: Application):
+        """post_stop hook: let workers drain their queues and exit."""
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for index, process in enumerate(self._processes):
+            if process is None:
+                continue
+            # Workers still need the dispatcher for their last replies
+            await asyncio.get_running_loop().run_in_executor(None, process.join, 30)
+            if process.is_alive():
+                logger.warning(f"Worker {index} did not stop in time, terminating")
+                process.terminate()
+        self._outbox.put(None)
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handler for every update received by the ingress process."""
+        index = self.worker_for(update)
+        process = self._processes[index]
+        if process is None or not process.is_alive():
+            logger.error(f"Worker {index} is not running (exit code "
+                         f"{process.exitcode if process else None}), restarting")
+            self._spawn(index)
+        self._inboxes[index].put((UPDATE, update.to_dict()))
+
+    def _spawn(self, index: int):
+        process = self._context.Process(
+            target=worker_main,
+            args=(index, self._inboxes[index], self._outbox),
+            name=f"bot-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        self._processes[index] = process
+
+    def _read_outbox(self):
+        while True:
+            item = self._outbox.get()
+            if item is None:
+                return
+            asyncio.run_coroutine_threadsafe(self._send(*item), self._loop)
+
+    async def _send(self, worker: int, request_id: int, url: str, method: str,
+                    request_data: Optional[ForwardedRequestData], timeouts: Dict):
+        try:
+            status, body = await self._application.bot.request.do_request(url, method, request_data, **timeouts)
+            reply = (RESPONSE, request_id, status, body, None)
+        except Exception as e:
+            reply = (RESPONSE, request_id, None, None, e)
+        self._inboxes[worker].put(reply)
+
+
+def worker_main(index: int, inbox, outbox):
+    """Entry point of a worker process."""
+    asyncio.run(_worker_loop(index, inbox, outbox))
+
+
+async def _worker_loop(index: int, inbox, outbox):
+    import bot
+
+    loop = asyncio.get_running_loop()
+    request = ForwardingRequest(index, outbox)
+    app = bot.create_app_context()
+    application = bot.build_application(app, request=request)
+    updates: asyncio.Queue = asyncio.Queue()
+
+    def read_inbox():
+        while True:
+            item = inbox.get()
+            try:
+                if item is None:
+                    # Keep reading: updates still in flight wait for their Bot API responses
+                    loop.call_soon_threadsafe(updates.put_nowait, None)
+                elif item[0] == UPDATE:
+                    loop.call_soon_threadsafe(updates.put_nowait, item[1])
+                elif item[0] == RESPONSE:
+                    loop.call_soon_threadsafe(request.resolve, *item[1:])
+            except RuntimeError:
+                return  # the worker's loop is closed
+
+    threading.Thread(target=read_inbox, name=f"worker{index}-inbox", daemon=True).start()
+
+    bot.enable_observability(application, worker=index)
+    try:
+        async with application:
+            # One poller is enough; delivery is claimed in storage anyway
+            await bot.start_background_tasks(application, poll_batches=index == 0)
+            logger.info(f"Worker {index} started (pid {os.getpid()})")
+            # Chats run concurrently, each in order (see update_processor.py)
+            in_flight = set()
+            while True:
+                data = await updates.get()
+                if data is None:
+                    break
+                task = asyncio.create_task(_process(application, index, data))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+            await asyncio.gather(*in_flight)
+            await bot.stop_background_tasks(application)
+    finally:
+        app.close()
+        bot.disable_observability()
+    logger.info(f"Worker {index} stopped")
+
+
+async def _process(application: Application, index: int, data: Dict):
+    update = Update.de_json(data, application.bot)
+    try:
+        await application.update_processor.process_update(update, application.process_update(update))
+    except Exception as e:
+        logger.error(f"Worker {index} failed to process update: {e}")
+
+
+def build_ingress_application(builder, workers: int) -> Application:
+    """Polling-only application that hands every update to a worker."""
+    dispatcher = Dispatcher(workers)
+    application = builder.post_init(dispatcher.start).post_stop(dispatcher.stop).build()
+    application.add_handler(TypeHandler(Update, dispatcher.dispatch))
+    return application